@@ -111,9 +111,15 @@ if __name__ == '__main__':
     # Создаём GUI
     main_window = ClientMainWindow(database, transport, keys)
     main_window.make_connection(transport)
+    # Обработчики подключены, можно принимать сообщения из почтового ящика
+    transport.start_delivery()
     main_window.setWindowTitle(f'Чат программа - {client_name}')
     client_app.exec_()
 
+    # Отправляем сообщения, оставшиеся в очереди потоков шифрования
+    main_window.crypto.close()
     # Раз графическая оболочка закрылась, закрываем транспорт
     transport.transport_shutdown()
     transport.join()
+    # и дописываем в базу изменения из очереди
+    database.close()
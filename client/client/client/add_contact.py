@@ -1,78 +1,97 @@
 import sys
 import logging
 
-from PyQt5.QtWidgets import QDialog, QLabel, QComboBox, QPushButton
-from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QDialog, QLabel, QComboBox, QPushButton, QLineEdit
+from PyQt5.QtCore import Qt, QTimer
 
 sys.path.append('../')
 
 LOGGER = logging.getLogger('client')
 
 
+# Задержка поиска после ввода очередного символа, мс
+SEARCH_DELAY = 300
+
+
 class AddContactDialog(QDialog):
     """
     Добавление пользователя в список контактов.
-    Предлагает пользователю список возможных контактов и
-    добавляет выбранный в контакты.
+    По мере ввода начала имени запрашивает у сервера подходящих
+    пользователей и добавляет выбранного в контакты.
     """
     def __init__(self, transport, database):
         super().__init__()
         self.transport = transport
         self.database = database
+        # Последнее найденное имя - с него начинается следующая страница
+        self.last_found = None
 
-        self.setFixedSize(330, 120)
+        self.setFixedSize(330, 150)
         self.setWindowTitle('Добавление контакта')
         self.setAttribute(Qt.WA_DeleteOnClose)
         self.setModal(True)
 
-        self.selector_label = QLabel('Выберите контакт для добавления:', self)
+        self.selector_label = QLabel('Введите начало имени контакта:', self)
         self.selector_label.setFixedSize(200, 20)
         self.selector_label.move(10, 0)
 
+        self.search = QLineEdit(self)
+        self.search.setFixedSize(200, 20)
+        self.search.move(10, 30)
+
         self.selector = QComboBox(self)
         self.selector.setFixedSize(200, 20)
-        self.selector.move(10, 30)
+        self.selector.move(10, 60)
 
-        self.btn_refresh = QPushButton('Обновить список', self)
-        self.btn_refresh.setFixedSize(100, 30)
-        self.btn_refresh.move(60, 60)
+        self.btn_more = QPushButton('Показать ещё', self)
+        self.btn_more.setFixedSize(100, 30)
+        self.btn_more.move(60, 90)
+        self.btn_more.setEnabled(False)
 
         self.btn_ok = QPushButton('Добавить', self)
         self.btn_ok.setFixedSize(70, 30)
-        self.btn_ok.move(230, 20)
+        self.btn_ok.move(230, 50)
 
         self.btn_cancel = QPushButton('Отмена', self)
         self.btn_cancel.setFixedSize(70, 30)
-        self.btn_cancel.move(230, 60)
+        self.btn_cancel.move(230, 90)
         self.btn_cancel.clicked.connect(self.close)
 
-        # Заполняем список возможных контактов
-        self.possible_contacts_update()
-        # Назначаем действие на кнопку обновить
-        self.btn_refresh.clicked.connect(self.update_possible_contacts)
+        # Поиск запускается, когда пользователь перестал набирать имя
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(SEARCH_DELAY)
+        self.search_timer.timeout.connect(self.possible_contacts_update)
+        self.search.textEdited.connect(self.search_timer.start)
+        # Назначаем действие на кнопку следующей страницы
+        self.btn_more.clicked.connect(self.update_possible_contacts)
 
     def possible_contacts_update(self):
         """
-        Функция заполнения списка возможных контактов.
-        Создаёт список всех зарегистрированных пользователей
-        за исключением уже добавленных в контакты и самого себя.
+        Функция заполнения списка возможных контактов первой страницей
+        результатов поиска по введённому началу имени.
         """
         self.selector.clear()
-        contacts_list = set(self.database.get_contacts())
-        users_list = set(self.database.get_users())
-        # далим сами себя из списка
-        users_list.remove(self.transport.username)
-        self.selector.addItems(users_list - contacts_list)
+        self.last_found = None
+        self.update_possible_contacts()
 
     def update_possible_contacts(self):
         """
-        Функция обновления списка возможных контактов. Запрашивает с сервера
-        список известных пользователей и обносляет содержимое окна.
+        Функция добавления в список следующей страницы результатов поиска.
+        Из списка исключаются уже добавленные контакты и сам пользователь.
         """
+        prefix = self.search.text()
+        if not prefix:
+            self.btn_more.setEnabled(False)
+            return
         try:
-            self.transport.user_list_request()
+            users_list, more = self.transport.search_users(prefix, self.last_found)
         except OSError:
-            pass
-        else:
-            LOGGER.debug('Обновление списка контактов с сервера выполнено')
-            self.possible_contacts_update()
+            return
+        LOGGER.debug(f'Найдено пользователей по запросу {prefix}: {len(users_list)}')
+        if users_list:
+            self.last_found = users_list[-1]
+        contacts_list = set(self.database.get_contacts())
+        contacts_list.add(self.transport.username)
+        self.selector.addItems([user for user in users_list if user not in contacts_list])
+        self.btn_more.setEnabled(more)
@@ -0,0 +1,169 @@
+import sys
+import os
+import queue
+import threading
+import logging
+from zlib import crc32
+
+from PyQt5.QtCore import pyqtSignal, QObject
+
+sys.path.append('../')
+from common.errors import ServerError
+from common.variables import MESSAGE_TEXT, SENDER, DESTINATION
+from client.encryption import MessageDecryptor
+
+LOGGER = logging.getLogger('client')
+
+# Количество потоков шифрования
+CRYPTO_WORKERS = min(4, os.cpu_count() or 1)
+# Наибольшее количество сообщений, передаваемых окну одним сигналом
+CRYPTO_BATCH_SIZE = 100
+
+
+class CryptoPool(QObject):
+    """
+    Класс - пул потоков шифрования.
+    Расшифровывает и сохраняет входящие сообщения, шифрует и отправляет
+    исходящие вне потока интерфейса, готовые сообщения передаются окну сигналами.
+    Сообщения одного собеседника обрабатывает всегда один и тот же поток,
+    поэтому порядок переписки сохраняется, а переписки с разными
+    собеседниками обрабатываются параллельно.
+    Сообщения, накопившиеся в очереди потока, передаются окну одним
+    сигналом: на каждый сигнал окно перестраивает список сообщений,
+    и при потоке сообщений сигналы по одному занимали бы его целиком.
+    """
+    # Сигналы: расшифрованные сообщения (список (отправитель, текст)), ошибка
+    # расшифровки (отправитель), отправленное сообщение (получатель, текст)
+    # и ошибка отправки (получатель, исключение)
+    messages_ready = pyqtSignal(list)
+    decrypt_failed = pyqtSignal(str)
+    message_sent = pyqtSignal(str, str)
+    send_failed = pyqtSignal(str, object)
+
+    def __init__(self, database, transport, keys, workers=CRYPTO_WORKERS):
+        super().__init__()
+        self.database = database
+        self.transport = transport
+        # Расшифровщик потокобезопасен, он общий для всех потоков
+        self.decrypter = MessageDecryptor(keys)
+        self.queues = [queue.Queue() for _ in range(workers)]
+        # Блокировка счётчиков потоков, ещё не дошедших до барьера after
+        self.barrier_lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.worker, args=(tasks,), daemon=True)
+                        for tasks in self.queues]
+        for thread in self.threads:
+            thread.start()
+
+    def queue_of(self, user):
+        """Метод возвращающий очередь потока, обрабатывающего переписку с собеседником."""
+        return self.queues[crc32(user.encode('utf8')) % len(self.queues)]
+
+    def decrypt(self, message):
+        """
+        Метод постановки входящего сообщения в очередь на расшифровку.
+        Вызывается из потока чтения транспорта и не ждёт расшифровки.
+        """
+        sender = message[SENDER]
+        self.queue_of(sender).put((self.decrypt_task, (message[MESSAGE_TEXT], sender, message[DESTINATION])))
+
+    def send(self, encryptor, recipient, text):
+        """Метод постановки сообщения в очередь на шифрование и отправку."""
+        self.queue_of(recipient).put((self.send_task, (encryptor, recipient, text)))
+
+    def after(self, callback):
+        """
+        Метод вызова callback после обработки всех уже поставленных в очередь
+        сообщений и записи их в базу. Барьер ставится в очередь каждого потока,
+        callback вызывает поток, последним дошедший до барьера.
+        """
+        remaining = [len(self.queues)]
+        for tasks in self.queues:
+            tasks.put((self.barrier_task, (remaining, callback)))
+
+    def barrier_task(self, remaining, callback):
+        """Метод прохождения потоком барьера, поставленного методом after."""
+        with self.barrier_lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        try:
+            self.database.flush()
+            callback()
+        except Exception:
+            LOGGER.exception('Ошибка обработки завершения порции сообщений')
+
+    def decrypt_task(self, message, sender, recipient):
+        """
+        Метод расшифровки входящего сообщения и его сохранения в истории.
+        Возвращает (отправитель, текст) или None, если сообщение повреждено.
+        """
+        try:
+            text = self.decrypter.decrypt(message, sender, recipient)
+        except (ValueError, TypeError):
+            LOGGER.error(f'Не удалось расшифровать сообщение от {sender}')
+            self.decrypt_failed.emit(sender)
+            return None
+        self.database.save_message(sender, 'in', text)
+        return sender, text
+
+    def send_task(self, encryptor, recipient, text):
+        """Метод шифрования и отправки сообщения, при успехе оно сохраняется в истории."""
+        try:
+            self.transport.send_message(recipient, encryptor.encrypt(text))
+        except (OSError, ServerError) as err:
+            LOGGER.error(f'Не удалось отправить сообщение для {recipient}: {err}')
+            self.send_failed.emit(recipient, err)
+            return
+        self.database.save_message(recipient, 'out', text)
+        LOGGER.debug(f'Отравлено сообщение для {recipient}: {text}')
+        self.message_sent.emit(recipient, text)
+
+    def worker(self, tasks):
+        """
+        Метод основного цикла потока шифрования. Поток забирает из очереди
+        все накопившиеся задачи, расшифрованные сообщения передаёт окну
+        одним сигналом. None в очереди завершает поток.
+        Непредвиденная ошибка задачи передаётся окну как ошибка отправки
+        или расшифровки и не останавливает поток: иначе встали бы переписки
+        со всеми собеседниками, закреплёнными за ним.
+        """
+        while True:
+            batch = [tasks.get()]
+            while batch[-1] is not None and len(batch) < CRYPTO_BATCH_SIZE:
+                try:
+                    batch.append(tasks.get_nowait())
+                except queue.Empty:
+                    break
+            received = []
+            for task in batch:
+                if task is None:
+                    break
+                function, args = task
+                if function != self.decrypt_task and received:
+                    # Входящие сообщения показываются раньше отправленных после них
+                    # и передаются окну до барьера
+                    self.messages_ready.emit(received)
+                    received = []
+                try:
+                    result = function(*args)
+                except Exception as err:
+                    # Второй аргумент обеих задач - собеседник
+                    LOGGER.exception(f'Ошибка обработки сообщения ({args[1]})')
+                    if function == self.send_task:
+                        self.send_failed.emit(args[1], err)
+                    else:
+                        self.decrypt_failed.emit(args[1])
+                    continue
+                if result:
+                    received.append(result)
+            if received:
+                self.messages_ready.emit(received)
+            if batch[-1] is None:
+                return
+
+    def close(self):
+        """Метод завершения потоков после обработки уже поставленных сообщений."""
+        for tasks in self.queues:
+            tasks.put(None)
+        for thread in self.threads:
+            thread.join()
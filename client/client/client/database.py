@@ -1,12 +1,84 @@
 import os
+import re
 import sys
-from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, DateTime, Text
-from sqlalchemy.orm import mapper, sessionmaker
+import logging
+import queue
+import threading
+import time
+from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, DateTime, Text, Index, select, \
+    tuple_, inspect, event, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import mapper, sessionmaker, scoped_session
 from sqlalchemy.sql import default_comparator
 from common.variables import *
 import datetime
 sys.path.append('../')
 
+LOGGER = logging.getLogger('client')
+
+# Время накопления изменений в одну транзакцию, сек.
+WRITE_DELAY = 0.05
+# Наибольшее количество изменений в одной транзакции
+WRITE_BATCH_SIZE = 1000
+# Время ожидания блокировки базы другим соединением, мс
+SQLITE_BUSY_TIMEOUT = 5000
+
+# Полнотекстовый индекс истории сообщений (SQLite FTS5). Индекс хранит
+# только слова, сами сообщения берутся из message_history, а триггеры
+# обновляют индекс в той же транзакции, что и историю.
+# Индексы префиксов ускоряют поиск по началу слова.
+MESSAGE_SEARCH_DDL = (
+    """CREATE VIRTUAL TABLE message_search USING fts5(
+        message, content='message_history', content_rowid='id', tokenize='unicode61', prefix='2 3')""",
+    """CREATE TRIGGER IF NOT EXISTS message_search_insert AFTER INSERT ON message_history BEGIN
+        INSERT INTO message_search(rowid, message) VALUES (new.id, new.message);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS message_search_delete AFTER DELETE ON message_history BEGIN
+        INSERT INTO message_search(message_search, rowid, message) VALUES ('delete', old.id, old.message);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS message_search_update AFTER UPDATE OF message ON message_history BEGIN
+        INSERT INTO message_search(message_search, rowid, message) VALUES ('delete', old.id, old.message);
+        INSERT INTO message_search(rowid, message) VALUES (new.id, new.message);
+    END""",
+)
+# Поиск по истории: фрагмент сообщения с найденными словами в скобках.
+# Результаты упорядочены по убыванию релевантности (rank - оценка bm25)
+# или, для частых слов, от новых к старым.
+MESSAGE_SEARCH_QUERY = """
+    SELECT message_history.id, message_history.contact, message_history.direction,
+           snippet(message_search, 0, '[', ']', '...', 12) AS fragment, message_history.date
+    FROM message_search JOIN message_history ON message_history.id = message_search.rowid
+    WHERE message_search MATCH :query {contact}
+    ORDER BY {order}
+    LIMIT :limit OFFSET :offset"""
+# Проверка, найдено ли больше SEARCH_RANK_LIMIT сообщений. Индекс
+# перебирает найденные сообщения от новых к старым без сортировки,
+# поэтому проверка не зависит от размера истории.
+MESSAGE_SEARCH_PROBE = """
+    SELECT message_search.rowid
+    FROM message_search JOIN message_history ON message_history.id = message_search.rowid
+    WHERE message_search MATCH :query {contact}
+    ORDER BY message_search.rowid DESC
+    LIMIT 1 OFFSET :rank_limit"""
+# Количество найденных сообщений, до которого они сортируются по релевантности.
+# bm25 рассчитывается для каждого найденного сообщения, а у слов, которые есть
+# в большей части истории, оценки почти равны - их результаты выдаются от новых
+# к старым, это одинаково быстро при любом размере истории.
+SEARCH_RANK_LIMIT = 200
+
+
+def search_query(search):
+    """
+    Функция преобразования строки поиска в запрос FTS5: слова ищутся
+    целиком, последнее - по началу, служебный синтаксис FTS5 не допускается.
+    Поиск по началу объединяет списки сообщений всех слов с этим началом,
+    для каждого слова запроса это было бы слишком долго.
+    """
+    words = [f'"{word}"' for word in re.findall(r'\w+', search)]
+    if words:
+        words[-1] += '*'
+    return ' '.join(words)
+
 
 class ClientDatabase:
     """
@@ -39,7 +111,7 @@ class ClientDatabase:
             self.name = contact
 
     # Конструктор класса:
-    def __init__(self, name):
+    def __init__(self, name, write_delay=WRITE_DELAY):
         # Создаём движок базы данных, т.к. разрешено несколько клиентов
         # одновременно, каждый должен иметь свою БД
         #path = os.path.dirname(os.path.realpath(__file__))
@@ -51,94 +123,301 @@ class ClientDatabase:
             pool_recycle=7200,
             connect_args={
                 'check_same_thread': False})
+        event.listen(self.database_engine, 'connect', self.configure_connection)
 
         # Создаём объект MetaData
         self.metadata = MetaData()
 
         # Создаём таблицу известных пользователей
-        users = Table('known_users', self.metadata,
+        users = self.known_users = Table('known_users', self.metadata,
                       Column('id', Integer, primary_key=True),
-                      Column('username', String)
+                      Column('username', String, index=True)
                       )
 
-        # Создаём таблицу истории сообщений
-        history = Table('message_history', self.metadata,
+        # Создаём таблицу версии справочника пользователей,
+        # с которой синхронизирована таблица известных пользователей
+        self.directory = Table('directory_version', self.metadata,
+                               Column('id', Integer, primary_key=True),
+                               Column('version', Integer)
+                               )
+
+        # Создаём таблицу истории сообщений. История читается страницами
+        # по собеседнику в порядке даты, поэтому индекс по (contact, date)
+        history = self.history = Table('message_history', self.metadata,
                         Column('id', Integer, primary_key=True),
                         Column('contact', String),
                         Column('direction', String),
                         Column('message', Text),
-                        Column('date', DateTime)
+                        Column('date', DateTime),
+                        Index('ix_message_history_contact_date', 'contact', 'date')
                         )
 
+        # Создаём таблицу открытых ключей собеседников, чтобы не запрашивать
+        # их у сервера при каждом открытии чата
+        self.public_keys = Table('public_keys', self.metadata,
+                                 Column('id', Integer, primary_key=True),
+                                 Column('username', String, unique=True),
+                                 Column('public_key', Text),
+                                 Column('fingerprint', String),
+                                 Column('checked', DateTime)
+                                 )
+
         # Создаём таблицу контактов
-        contacts = Table('contacts', self.metadata,
+        contacts = self.contacts = Table('contacts', self.metadata,
                          Column('id', Integer, primary_key=True),
                          Column('name', String, unique=True)
                          )
 
         # Создаём таблицы
         self.metadata.create_all(self.database_engine)
+        # В базах, созданных прежними версиями, таблицы уже есть,
+        # а индексы, добавленные позже, нужно создать отдельно
+        inspector = inspect(self.database_engine)
+        for table in self.metadata.sorted_tables:
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(self.database_engine)
+        self.search_enabled = self.create_search_index()
 
         # Создаём отображения
         mapper(self.KnownUsers, users)
         mapper(self.MessageHistory, history)
         mapper(self.Contacts, contacts)
 
-        # Создаём сессию
-        Session = sessionmaker(bind=self.database_engine)
-        self.session = Session()
+        # Создаём сессии. База читается потоками интерфейса и транспорта,
+        # у каждого потока своя сессия
+        self.session = scoped_session(sessionmaker(bind=self.database_engine))
 
         # Необходимо очистить таблицу контактов, т.к. при запуске они
         # подгружаются с сервера.
         self.session.query(self.Contacts).delete()
         self.session.commit()
 
+        # Изменения записываются отдельным потоком пакетами,
+        # чтобы не ждать синхронизации с диском на каждое изменение
+        self.write_delay = write_delay
+        self.write_queue = queue.Queue()
+        self.write_lock = threading.Lock()
+        self.write_pending = 0
+        self.write_thread = threading.Thread(target=self.write_worker, daemon=True)
+        self.write_thread.start()
+
+    @staticmethod
+    def configure_connection(dbapi_connection, connection_record):
+        """
+        Настройка нового соединения SQLite: журнал WAL, при котором чтение
+        не блокирует запись, и синхронизация с диском только при контрольных точках.
+        """
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}')
+        cursor.close()
+
+    def create_search_index(self):
+        """
+        Функция создания полнотекстового индекса истории сообщений.
+        Индекс, созданный для существующей истории, заполняется сразу.
+        Возвращает False, если SQLite собран без FTS5.
+        """
+        try:
+            with self.database_engine.begin() as connection:
+                if not connection.execute(text(
+                        "SELECT 1 FROM sqlite_master WHERE name = 'message_search'")).scalar():
+                    for statement in MESSAGE_SEARCH_DDL:
+                        connection.execute(text(statement))
+                    connection.execute(text("INSERT INTO message_search(message_search) VALUES ('rebuild')"))
+        except SQLAlchemyError as err:
+            LOGGER.error(f'Поиск по истории сообщений недоступен: {err}')
+            return False
+        return True
+
+    def write(self, function, *args):
+        """
+        Функция постановки изменения в очередь потока записи.
+        function(connection, *args) будет выполнена в общей транзакции.
+        """
+        with self.write_lock:
+            self.write_pending += 1
+        self.write_queue.put((function, args))
+
+    def flush(self):
+        """
+        Барьер записи: ожидает, пока все поставленные в очередь изменения
+        будут записаны в базу. Вызывается перед чтением, которое должно
+        видеть последние изменения.
+        """
+        if not self.write_pending:
+            return
+        done = threading.Event()
+        self.write_queue.put((None, done))
+        done.wait()
+
+    def write_worker(self):
+        """
+        Поток записи. Изменения, поступившие в течение write_delay после
+        первого, записываются одной транзакцией. Барьер прерывает ожидание,
+        и накопленные изменения записываются сразу.
+        Ошибка записи не останавливает поток: ожидающие барьеров
+        освобождаются в любом случае, иначе flush и close ждали бы вечно.
+        """
+        while True:
+            batch = [self.write_queue.get()]
+            deadline = time.monotonic() + self.write_delay
+            while batch[-1][0] is not None and len(batch) < WRITE_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.write_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            writes = [item for item in batch if item[0] is not None]
+            try:
+                if writes:
+                    self.write_batch(writes)
+            finally:
+                with self.write_lock:
+                    self.write_pending -= len(writes)
+                for function, done in batch:
+                    if function is None and done is not None:
+                        done.set()
+            if (None, None) in batch:
+                return
+
+    def write_batch(self, writes):
+        """
+        Функция записи пакета изменений одной транзакцией.
+        Если транзакция не удалась, изменения записываются по одному,
+        и теряется только то изменение, которое не удаётся записать.
+        """
+        try:
+            with self.database_engine.begin() as connection:
+                for function, args in writes:
+                    function(connection, *args)
+            return
+        except Exception as err:
+            LOGGER.error(f'Не удалось записать изменения в базу: {err}')
+            if len(writes) == 1:
+                return
+        for function, args in writes:
+            try:
+                with self.database_engine.begin() as connection:
+                    function(connection, *args)
+            except Exception as err:
+                LOGGER.error(f'Изменение не записано в базу: {err}')
+
+    def close(self):
+        """Функция завершения работы с базой: записывает изменения из очереди."""
+        self.write_queue.put((None, None))
+        self.write_thread.join()
+        self.session.remove()
+
     def add_contact(self, contact):
         """Функция добавления контактов"""
-        if not self.session.query(
-                self.Contacts).filter_by(
-                name=contact).count():
-            contact_row = self.Contacts(contact)
-            self.session.add(contact_row)
-            self.session.commit()
+        self.write(lambda connection: connection.execute(
+            self.contacts.insert().prefix_with('OR IGNORE').values(name=contact)))
 
     def del_contact(self, contact):
         """Функция удаления контакта"""
-        self.session.query(self.Contacts).filter_by(name=contact).delete()
+        self.write(lambda connection: connection.execute(
+            self.contacts.delete().where(self.contacts.c.name == contact)))
 
     def contacts_clear(self):
         """Метод очищающий таблицу со списком контактов."""
-        self.session.query(self.Contacts).delete()
+        self.write(lambda connection: connection.execute(self.contacts.delete()))
 
-    def add_users(self, users_list):
+    def add_users(self, users_list, version=0):
         """
         Функция добавления известных пользователей.
         Пользователи получаются только с сервера, поэтому таблица очищается.
         """
-        self.session.query(self.KnownUsers).delete()
-        for user in users_list:
-            user_row = self.KnownUsers(user)
-            self.session.add(user_row)
-        self.session.commit()
+        def add(connection):
+            connection.execute(self.known_users.delete())
+            if users_list:
+                connection.execute(self.known_users.insert(), [{'username': user} for user in users_list])
+            self.write_directory_version(connection, version)
+        self.write(add)
+
+    def update_users(self, added, removed, version):
+        """
+        Функция применения изменений справочника пользователей,
+        полученных с сервера начиная с сохранённой версии.
+        """
+        def update(connection):
+            if removed:
+                connection.execute(self.known_users.delete().where(self.known_users.c.username.in_(removed)))
+            if added:
+                known = {user[0] for user in connection.execute(select([self.known_users.c.username]).where(
+                    self.known_users.c.username.in_(added)))}
+                new = [{'username': user} for user in added if user not in known]
+                if new:
+                    connection.execute(self.known_users.insert(), new)
+            self.write_directory_version(connection, version)
+        self.write(update)
+
+    def get_directory_version(self):
+        """Функция возвращающая версию справочника известных пользователей."""
+        self.flush()
+        version = self.session.execute(select([self.directory.c.version])).scalar()
+        return version or 0
+
+    def write_directory_version(self, connection, version):
+        """Запись версии справочника, выполняется потоком записи."""
+        connection.execute(self.directory.delete())
+        connection.execute(self.directory.insert().values(version=version))
+
+    def get_public_key(self, user):
+        """
+        Функция возвращающая сохранённый открытый ключ пользователя:
+        кортеж (ключ, отпечаток, время проверки) или None.
+        """
+        self.flush()
+        return self.session.execute(select([
+            self.public_keys.c.public_key,
+            self.public_keys.c.fingerprint,
+            self.public_keys.c.checked]).where(self.public_keys.c.username == user)).first()
+
+    def save_public_key(self, user, public_key, fingerprint):
+        """Функция сохранения открытого ключа пользователя, полученного с сервера."""
+        checked = datetime.datetime.now()
+
+        def save(connection):
+            connection.execute(self.public_keys.delete().where(self.public_keys.c.username == user))
+            connection.execute(self.public_keys.insert().values(
+                username=user, public_key=public_key, fingerprint=fingerprint, checked=checked))
+        self.write(save)
+
+    def del_public_keys(self, users):
+        """Функция удаления сохранённых открытых ключей пользователей."""
+        self.write(lambda connection: connection.execute(
+            self.public_keys.delete().where(self.public_keys.c.username.in_(users))))
 
     def save_message(self, contact, direction, message):
-        """Функция сохраняющяя сообщения в БД"""
-        message_row = self.MessageHistory(contact, direction, message)
-        self.session.add(message_row)
-        self.session.commit()
+        """
+        Функция сохраняющяя сообщения в БД.
+        Сообщение записывается потоком записи вместе с соседними.
+        """
+        date = datetime.datetime.now()
+        self.write(lambda connection: connection.execute(self.history.insert().values(
+            contact=contact, direction=direction, message=message, date=date)))
 
     def get_contacts(self):
         """Функция возвращающая список всех контактов."""
+        self.flush()
         return [contact[0]
                 for contact in self.session.query(self.Contacts.name).all()]
 
     def get_users(self):
         """Функция возвращающяя список известных пользователей"""
+        self.flush()
         return [user[0]
                 for user in self.session.query(self.KnownUsers.username).all()]
 
     def check_user(self, user):
         """Функция проверяющяя наличие пользователя в известных"""
+        self.flush()
         if self.session.query(
                 self.KnownUsers).filter_by(
                 username=user).count():
@@ -148,6 +427,7 @@ class ClientDatabase:
 
     def check_contact(self, contact):
         """Функция проверяющяя существование контакта"""
+        self.flush()
         if self.session.query(self.Contacts).filter_by(name=contact).count():
             return True
         else:
@@ -155,6 +435,7 @@ class ClientDatabase:
 
     def get_history(self, contact):
         """Функция возвращающая историю переписки с определенным пользователем"""
+        self.flush()
         query = self.session.query(
             self.MessageHistory).filter_by(
             contact=contact)
@@ -163,6 +444,56 @@ class ClientDatabase:
                  history_row.message,
                  history_row.date) for history_row in query.all()]
 
+    def get_history_page(self, contact, before=None, limit=HISTORY_PAGE_SIZE, after=None):
+        """
+        Функция возвращающая страницу истории переписки с пользователем:
+        не более limit сообщений, предшествующих сообщению before
+        (кортеж (дата, id)), или последние сообщения, если before не задан.
+        Если задан after - не более limit сообщений, следующих за ним.
+        Сообщения возвращаются по возрастанию даты кортежами
+        (id, направление, сообщение, дата).
+        """
+        self.flush()
+        query = self.session.query(
+            self.MessageHistory.id,
+            self.MessageHistory.direction,
+            self.MessageHistory.message,
+            self.MessageHistory.date).filter_by(contact=contact)
+        key = tuple_(self.MessageHistory.date, self.MessageHistory.id)
+        if after:
+            query = query.filter(key > tuple_(*after))
+            query = query.order_by(self.MessageHistory.date, self.MessageHistory.id).limit(limit)
+            return [tuple(row) for row in query.all()]
+        if before:
+            # Сравнение кортежей SQLite выполняет поиском по индексу,
+            # равнозначное условие через OR просматривает всю историю
+            query = query.filter(key < tuple_(*before))
+        query = query.order_by(self.MessageHistory.date.desc(), self.MessageHistory.id.desc()).limit(limit)
+        return [tuple(row) for row in reversed(query.all())]
+
+    def search_messages(self, search, contact=None, offset=0, limit=HISTORY_SEARCH_PAGE_SIZE):
+        """
+        Функция полнотекстового поиска по истории сообщений, при заданном
+        contact - только в переписке с ним. Возвращает страницу результатов
+        по убыванию релевантности (см. SEARCH_RANK_LIMIT), кортежи (id, собеседник, направление,
+        фрагмент сообщения, дата), и признак наличия следующей страницы.
+        """
+        query = search_query(search)
+        if not query or not self.search_enabled:
+            return [], False
+        self.flush()
+        contact_filter = 'AND message_history.contact = :contact' if contact else ''
+        parameters = {'query': query, 'contact': contact, 'rank_limit': SEARCH_RANK_LIMIT,
+                      'limit': limit + 1, 'offset': offset}
+        common = self.session.execute(
+            text(MESSAGE_SEARCH_PROBE.format(contact=contact_filter)), parameters).first() is not None
+        statement = text(MESSAGE_SEARCH_QUERY.format(
+            contact=contact_filter,
+            order='message_search.rowid DESC' if common else 'rank, message_history.id DESC')).columns(
+            id=Integer, contact=String, direction=String, fragment=Text, date=DateTime)
+        rows = self.session.execute(statement, parameters).fetchall()
+        return [tuple(row) for row in rows[:limit]], len(rows) > limit
+
 
 if __name__ == '__main__':
     test_db = ClientDatabase('test_User_2')
@@ -0,0 +1,152 @@
+"""Шифрование сообщений между клиентами"""
+
+import base64
+import threading
+from collections import OrderedDict
+from hashlib import sha256
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.PublicKey import RSA
+from Crypto.Random import get_random_bytes
+
+# Признак сообщения в конверте: сеансовый ключ AES-GCM, зашифрованный RSA,
+# и текст, зашифрованный сеансовым ключом. Сообщения без признака
+# зашифрованы целиком RSA (прежний формат).
+ENVELOPE_PREFIX = 'aesgcm:'
+# Длинна сеансового ключа, одноразового числа и метки GCM, байт
+SESSION_KEY_SIZE = 32
+NONCE_SIZE = 12
+TAG_SIZE = 16
+# Количество сообщений, после которого отправитель меняет сеансовый ключ
+SESSION_KEY_MESSAGES = 1 << 20
+# Количество расшифрованных сеансовых ключей, хранимых получателем
+SESSION_KEYS_CACHE = 256
+# Количество объектов шифрования собеседникам, хранимых отправителем
+ENCRYPTORS_CACHE = 32
+
+
+def key_fingerprint(public_key):
+    """Функция возвращающая отпечаток открытого ключа."""
+    return sha256(public_key.strip().encode('ascii')).hexdigest()
+
+
+def associated_data(sender, recipient):
+    """Функция возвращающая данные, которые подтверждаются меткой GCM: отправитель и получатель."""
+    return f'{sender}:{recipient}'.encode('utf8')
+
+
+class MessageEncryptor:
+    """
+    Класс - шифрование сообщений одному собеседнику.
+    Сеансовый ключ AES создаётся и шифруется открытым ключом собеседника
+    один раз на беседу, каждое сообщение шифруется AES-GCM со случайным
+    одноразовым числом. Зашифрованный сеансовый ключ передаётся в каждом
+    сообщении, поэтому сообщения расшифровываются независимо друг от друга.
+    """
+
+    def __init__(self, public_key, sender, recipient):
+        self.rsa = PKCS1_OAEP.new(RSA.import_key(public_key))
+        self.associated = associated_data(sender, recipient)
+        self.lock = threading.Lock()
+        self.new_session_key()
+
+    def new_session_key(self):
+        """Метод создания нового сеансового ключа."""
+        self.session_key = get_random_bytes(SESSION_KEY_SIZE)
+        self.wrapped_key = self.rsa.encrypt(self.session_key)
+        self.messages = 0
+
+    def encrypt(self, text):
+        """Метод шифрования текста сообщения. Возвращает строку для передачи."""
+        with self.lock:
+            if self.messages >= SESSION_KEY_MESSAGES:
+                self.new_session_key()
+            self.messages += 1
+            session_key, wrapped_key = self.session_key, self.wrapped_key
+        nonce = get_random_bytes(NONCE_SIZE)
+        cipher = AES.new(session_key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(self.associated)
+        ciphertext, tag = cipher.encrypt_and_digest(text.encode('utf8'))
+        envelope = wrapped_key + nonce + tag + ciphertext
+        return ENVELOPE_PREFIX + base64.b64encode(envelope).decode('ascii')
+
+
+class EncryptorCache:
+    """
+    Класс - кэш объектов шифрования собеседникам по отпечатку их ключа.
+    При повторном открытии чата ключ не разбирается и сеансовый ключ
+    не шифруется заново. Давно не использованные объекты вытесняются.
+    """
+
+    def __init__(self, sender, size=ENCRYPTORS_CACHE):
+        self.sender = sender
+        self.size = size
+        # (собеседник, отпечаток ключа) -> объект шифрования
+        self.encryptors = OrderedDict()
+
+    def get(self, recipient, public_key, fingerprint):
+        """Метод возвращающий объект шифрования собеседнику, создаёт его при необходимости."""
+        key = (recipient, fingerprint)
+        encryptor = self.encryptors.get(key)
+        if encryptor is not None:
+            self.encryptors.move_to_end(key)
+            return encryptor
+        encryptor = MessageEncryptor(public_key, self.sender, recipient)
+        self.encryptors[key] = encryptor
+        if len(self.encryptors) > self.size:
+            self.encryptors.popitem(last=False)
+        return encryptor
+
+    def discard(self, recipients):
+        """Метод удаления объектов шифрования собеседникам, сменившим ключ."""
+        for key in [key for key in self.encryptors if key[0] in recipients]:
+            del self.encryptors[key]
+
+
+class MessageDecryptor:
+    """
+    Класс - расшифровка сообщений собственным закрытым ключом.
+    Расшифрованные сеансовые ключи хранятся, поэтому RSA используется
+    один раз на беседу, а не на каждое сообщение.
+    """
+
+    def __init__(self, keys):
+        self.rsa = PKCS1_OAEP.new(keys)
+        # Длинна сеансового ключа, зашифрованного нашим ключом RSA
+        self.wrapped_size = keys.size_in_bytes()
+        # Хэш зашифрованного сеансового ключа -> сеансовый ключ
+        self.session_keys = OrderedDict()
+        self.lock = threading.Lock()
+
+    def session_key(self, wrapped_key):
+        """Метод получения сеансового ключа: из кэша или расшифровкой RSA."""
+        digest = sha256(wrapped_key).digest()
+        with self.lock:
+            session_key = self.session_keys.get(digest)
+            if session_key is not None:
+                self.session_keys.move_to_end(digest)
+                return session_key
+        session_key = self.rsa.decrypt(wrapped_key)
+        with self.lock:
+            self.session_keys[digest] = session_key
+            if len(self.session_keys) > SESSION_KEYS_CACHE:
+                self.session_keys.popitem(last=False)
+        return session_key
+
+    def decrypt(self, text, sender, recipient):
+        """
+        Метод расшифровки текста сообщения.
+        Генерирует ValueError, если сообщение повреждено или подделано.
+        """
+        if not text.startswith(ENVELOPE_PREFIX):
+            return self.rsa.decrypt(base64.b64decode(text)).decode('utf8')
+        envelope = base64.b64decode(text[len(ENVELOPE_PREFIX):])
+        if len(envelope) < self.wrapped_size + NONCE_SIZE + TAG_SIZE:
+            raise ValueError('Сообщение повреждено')
+        position = self.wrapped_size
+        wrapped_key = envelope[:position]
+        nonce = envelope[position:position + NONCE_SIZE]
+        tag = envelope[position + NONCE_SIZE:position + NONCE_SIZE + TAG_SIZE]
+        ciphertext = envelope[position + NONCE_SIZE + TAG_SIZE:]
+        cipher = AES.new(self.session_key(wrapped_key), AES.MODE_GCM, nonce=nonce)
+        cipher.update(associated_data(sender, recipient))
+        return cipher.decrypt_and_verify(ciphertext, tag).decode('utf8')
@@ -0,0 +1,237 @@
+import sys
+import datetime
+from collections import OrderedDict
+
+from PyQt5.QtWidgets import QStyledItemDelegate
+from PyQt5.QtGui import QColor, QBrush, QPen, QPainter
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QRect, QSize, QPoint
+
+sys.path.append('../')
+from common.variables import HISTORY_PAGE_SIZE
+
+# Роли данных модели: направление сообщения, его текст и дата
+DIRECTION_ROLE = Qt.UserRole + 1
+MESSAGE_ROLE = Qt.UserRole + 2
+DATE_ROLE = Qt.UserRole + 3
+
+# Цвета входящих и исходящих сообщений
+IN_BRUSH = QBrush(QColor(255, 213, 213))
+OUT_BRUSH = QBrush(QColor(204, 255, 204))
+# Количество загруженных сообщений, после которого новые сообщения в конце
+# списка перезагружают модель последней страницей: при каждой вставке
+# QListView заново раскладывает все строки
+HISTORY_ROWS_LIMIT = 200
+
+
+def history_row(row_id, direction, message, date):
+    """Функция создания строки модели с готовым текстом для отображения."""
+    title = 'Входящее' if direction == 'in' else 'Исходящее'
+    return row_id, direction, message, date, f'{title} от {date.replace(microsecond=0)}:\n {message}'
+
+
+class HistoryModel(QAbstractListModel):
+    """
+    Модель истории переписки с собеседником.
+    Хранит только загруженные страницы истории: при открытии чата -
+    последнюю, при переходе к найденному сообщению - страницы вокруг него.
+    Более старые и более новые подгружаются через canFetchMore/fetchMore.
+    Новые сообщения добавляются в конец по одному, без перестроения модели.
+    """
+
+    def __init__(self, database, parent=None):
+        super().__init__(parent)
+        self.database = database
+        self.contact = None
+        # Строки (id, направление, сообщение, дата, текст) по возрастанию даты
+        self.rows = []
+        # Ключ (дата, id) самого старого загруженного сообщения
+        self.oldest = None
+        self.complete = True
+        # Загружены ли сообщения до самого нового
+        self.at_end = True
+        # Qt сам вызывает fetchMore, когда видна последняя строка, а в чате
+        # старые сообщения находятся сверху. Поэтому подгрузка разрешается
+        # только после прокрутки к началу, см. fetch_older.
+        self.older_requested = False
+
+    def set_contact(self, contact, around=None):
+        """
+        Метод загрузки истории переписки с собеседником: последней страницы
+        или, если задан around (ключ (дата, id)), страниц до и после этого сообщения.
+        """
+        self.beginResetModel()
+        self.contact = contact
+        older = newer = []
+        if contact and around:
+            date, row_id = around
+            # Сообщения не позже заданного, включая его самого
+            older = self.database.get_history_page(contact, (date, row_id + 1))
+            newer = self.database.get_history_page(contact, after=around)
+        elif contact:
+            older = self.database.get_history_page(contact)
+        self.rows = [history_row(*row) for row in older + newer]
+        self.oldest = (self.rows[0][3], self.rows[0][0]) if self.rows else None
+        self.complete = len(older) < HISTORY_PAGE_SIZE
+        self.at_end = not around or len(newer) < HISTORY_PAGE_SIZE
+        self.older_requested = False
+        self.endResetModel()
+
+    def row_of(self, row_id):
+        """Метод возвращающий номер строки сообщения по его id или None."""
+        for row, history in enumerate(self.rows):
+            if history[0] == row_id:
+                return row
+        return None
+
+    def append(self, direction, message, date=None, trim=False):
+        """
+        Метод добавления нового сообщения в конец истории.
+        Если trim и загружено больше HISTORY_ROWS_LIMIT сообщений, модель
+        перезагружается последней страницей - так делается, когда список
+        прокручен в конец и старые сообщения не видны.
+        Если самые новые сообщения не загружены, сообщение появится
+        при прокрутке к ним.
+        """
+        self.extend(direction, [message], date, trim)
+
+    def extend(self, direction, messages, date=None, trim=False):
+        """
+        Метод добавления нескольких новых сообщений в конец истории
+        одной вставкой строк, см. append.
+        """
+        if not self.at_end or not messages:
+            return
+        if trim and len(self.rows) + len(messages) > HISTORY_ROWS_LIMIT:
+            self.set_contact(self.contact)
+            return
+        date = date or datetime.datetime.now()
+        position = len(self.rows)
+        self.beginInsertRows(QModelIndex(), position, position + len(messages) - 1)
+        self.rows.extend(history_row(None, direction, message, date) for message in messages)
+        self.endInsertRows()
+
+    def fetch_older(self):
+        """
+        Метод подгрузки предыдущей страницы истории по прокрутке к началу.
+        Возвращает количество загруженных сообщений.
+        """
+        if self.complete:
+            return 0
+        self.older_requested = True
+        count = len(self.rows)
+        self.fetchMore(QModelIndex())
+        return len(self.rows) - count
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.rows):
+            return None
+        _, direction, message, date, text = self.rows[index.row()]
+        if role == Qt.DisplayRole:
+            return text
+        if role == DIRECTION_ROLE:
+            return direction
+        if role == MESSAGE_ROLE:
+            return message
+        if role == DATE_ROLE:
+            return date
+        if role == Qt.BackgroundRole:
+            return IN_BRUSH if direction == 'in' else OUT_BRUSH
+        if role == Qt.TextAlignmentRole:
+            return Qt.AlignLeft if direction == 'in' else Qt.AlignRight
+        return None
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and (self.older_requested and not self.complete or not self.at_end)
+
+    def fetchMore(self, parent):
+        if not (self.older_requested and not self.complete):
+            self.fetch_newer()
+            return
+        self.older_requested = False
+        page = self.database.get_history_page(self.contact, self.oldest)
+        self.complete = len(page) < HISTORY_PAGE_SIZE
+        if not page:
+            return
+        self.oldest = (page[0][3], page[0][0])
+        self.beginInsertRows(QModelIndex(), 0, len(page) - 1)
+        self.rows[:0] = [history_row(*row) for row in page]
+        self.endInsertRows()
+
+    def fetch_newer(self):
+        """
+        Метод подгрузки следующей страницы истории после перехода
+        к найденному сообщению. Qt вызывает его через fetchMore,
+        когда видна последняя строка.
+        """
+        newest = (self.rows[-1][3], self.rows[-1][0])
+        page = self.database.get_history_page(self.contact, after=newest)
+        self.at_end = len(page) < HISTORY_PAGE_SIZE
+        if not page:
+            return
+        position = len(self.rows)
+        self.beginInsertRows(QModelIndex(), position, position + len(page) - 1)
+        self.rows.extend(history_row(*row) for row in page)
+        self.endInsertRows()
+
+
+class MessageDelegate(QStyledItemDelegate):
+    """
+    Делегат отрисовки сообщения в виде облачка: входящие слева,
+    исходящие справа. Размеры облачков запоминаются, поэтому
+    перекомпоновка списка не пересчитывает переносы текста.
+    """
+    # Отступы облачка от края строки и текста от края облачка
+    MARGIN = 4
+    PADDING = 6
+    # Доля ширины списка, которую может занимать облачко
+    WIDTH_RATIO = 0.8
+    # Количество запоминаемых размеров
+    CACHE_SIZE = 4096
+
+    def __init__(self, view):
+        super().__init__(view)
+        self.view = view
+        # (текст, ширина) -> прямоугольник текста
+        self.text_rects = OrderedDict()
+
+    def text_rect(self, option, text):
+        """Метод расчёта прямоугольника текста сообщения с переносами."""
+        width = max(1, int(self.view.viewport().width() * self.WIDTH_RATIO) - 2 * self.PADDING)
+        key = (text, width)
+        rect = self.text_rects.get(key)
+        if rect is not None:
+            self.text_rects.move_to_end(key)
+            return rect
+        rect = option.fontMetrics.boundingRect(QRect(0, 0, width, 0), Qt.TextWordWrap, text)
+        self.text_rects[key] = rect
+        if len(self.text_rects) > self.CACHE_SIZE:
+            self.text_rects.popitem(last=False)
+        return rect
+
+    def sizeHint(self, option, index):
+        # Строка занимает всю ширину списка, облачко выравнивается внутри неё
+        rect = self.text_rect(option, index.data(Qt.DisplayRole))
+        return QSize(self.view.viewport().width(), rect.height() + 2 * (self.PADDING + self.MARGIN))
+
+    def paint(self, painter, option, index):
+        text = index.data(Qt.DisplayRole)
+        rect = self.text_rect(option, text)
+        bubble = QRect(0, 0, rect.width() + 2 * self.PADDING, rect.height() + 2 * self.PADDING)
+        if index.data(DIRECTION_ROLE) == 'in':
+            bubble.moveTopLeft(option.rect.topLeft() + QPoint(self.MARGIN, self.MARGIN))
+        else:
+            bubble.moveTopRight(option.rect.topRight() + QPoint(-self.MARGIN, self.MARGIN))
+        painter.save()
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(index.data(Qt.BackgroundRole))
+        painter.drawRoundedRect(bubble, 8, 8)
+        painter.setPen(QPen(option.palette.text().color()))
+        painter.drawText(bubble.adjusted(self.PADDING, self.PADDING, -self.PADDING, -self.PADDING),
+                         Qt.TextWordWrap, text)
+        painter.restore()
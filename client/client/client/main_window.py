@@ -1,19 +1,18 @@
-import base64
 import sys
-import json
 import logging
-from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox, QApplication, QListView
-from PyQt5.QtGui import QStandardItemModel, QStandardItem, QBrush, QColor
-from PyQt5.QtCore import pyqtSlot, QEvent, Qt
-from Crypto.Cipher import PKCS1_OAEP
-from Crypto.PublicKey import RSA
+from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox, QApplication, QListView, QAbstractItemView
+from PyQt5.QtGui import QStandardItemModel, QStandardItem
+from PyQt5.QtCore import pyqtSlot, QEvent, Qt, QTimer
 
 from client.main_window_ui import Ui_MainClientWindow
 from client.add_contact import AddContactDialog
 from client.del_contact import DelContactDialog
+from client.search_dialog import SearchDialog
+from client.encryption import EncryptorCache
+from client.crypto_pool import CryptoPool
+from client.history_model import HistoryModel, MessageDelegate
 
 from common.errors import ServerError
-from common.variables import MESSAGE_TEXT, SENDER
 
 sys.path.append('../')
 LOGGER = logging.getLogger('client')
@@ -31,8 +30,11 @@ class ClientMainWindow(QMainWindow):
         # Основные переменные
         self.database = database
         self.transport = transport
-        # объект - дешифорвщик сообщений с предзагруженным ключём
-        self.decrypter = PKCS1_OAEP.new(keys)
+        # Потоки шифрования: расшифровка входящих и отправка исходящих
+        # сообщений выполняются вне потока интерфейса
+        self.crypto = CryptoPool(database, transport, keys)
+        # Объекты шифрования собеседникам по отпечаткам их ключей
+        self.encryptors = EncryptorCache(transport.username)
         # Загрузка конфигурации из дизайнера
         self.ui = Ui_MainClientWindow()
         self.ui.setupUi(self)
@@ -46,15 +48,25 @@ class ClientMainWindow(QMainWindow):
         # Кнопки удаления контакта
         self.ui.btn_remove_contact.clicked.connect(self.delete_contact_window)
         self.ui.menu_del_contact.triggered.connect(self.delete_contact_window)
+        # Поиск по истории сообщений
+        self.ui.search_field.returnPressed.connect(self.search_window)
         # Дополнительные атрибуты
         self.contacts_model = None
-        self.history_model = None
+        # История переписки загружается страницами, сообщения рисует делегат
+        self.history_model = HistoryModel(database)
+        self.ui.list_messages.setModel(self.history_model)
+        self.ui.list_messages.setItemDelegate(MessageDelegate(self.ui.list_messages))
         self.messages = QMessageBox()
         self.current_chat = None
         self.current_chat_key = None
         self.encryptor = None
+        # Принятые сообщения, ещё не показанные в окне
+        self.received = []
         self.ui.list_messages.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.ui.list_messages.setWordWrap(True)
+        self.ui.list_messages.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        # При прокрутке к началу подгружаются более старые сообщения
+        self.ui.list_messages.verticalScrollBar().valueChanged.connect(self.history_scrolled)
 
         # Даблклик по листу контактов отправляется в обработчик
         self.ui.list_contacts.doubleClicked.connect(self.select_active_user)
@@ -67,8 +79,7 @@ class ClientMainWindow(QMainWindow):
         """Функция делающая неактивным поле ввода и кнопки отправки"""
         self.ui.label_new_message.setText('Выберите получателя, дважды кликнув на нем в окне контактов')
         self.ui.text_message.clear()
-        if self.history_model:
-            self.history_model.clear()
+        self.history_model.set_contact(None)
 
         # Поле ввода и кнопка отправки неактивны до выбора получателя.
         self.ui.btn_send.setDisabled(True)
@@ -84,37 +95,31 @@ class ClientMainWindow(QMainWindow):
         Функция заполняющая текущий диалог
         историей переписки с текущим собеседником.
         """
-        # История сообщений, отсортированная по дате
-        list = sorted(self.database.get_history(self.current_chat), key=lambda item: item[3])
-        # Если модель не создана
-        if not self.history_model:
-            self.history_model = QStandardItemModel()
-            self.ui.list_messages.setModel(self.history_model)
-
-        # Очищаем от старых записей
-        self.history_model.clear()
-        length = len(list)
-        start_index = 0
-        if length > 20:
-            start_index = length - 20
-
-        # Заполнение модели записями
-        for i in range(start_index, length):
-            item = list[i]
-            if item[1] == 'in':
-                mess = QStandardItem(f'Входящее от {item[3].replace(microsecond=0)}:\n {item[2]}')
-                mess.setEditable(False)
-                mess.setBackground(QBrush(QColor(255, 213, 213)))
-                mess.setTextAlignment(Qt.AlignLeft)
-                self.history_model.appendRow(mess)
-            else:
-                mess = QStandardItem(f'Входящее от {item[3].replace(microsecond=0)}:\n {item[2]}')
-                mess.setEditable(False)
-                mess.setTextAlignment(Qt.AlignRight)
-                mess.setBackground(QBrush(QColor(204, 255, 204)))
-                self.history_model.appendRow(mess)
+        self.history_model.set_contact(self.current_chat)
         self.ui.list_messages.scrollToBottom()
 
+    def history_scrolled(self, value):
+        """
+        Функция подгрузки предыдущей страницы истории при прокрутке
+        списка сообщений к началу. Положение прокрутки сохраняется.
+        """
+        if value != self.ui.list_messages.verticalScrollBar().minimum():
+            return
+        count = self.history_model.fetch_older()
+        if count:
+            self.ui.list_messages.scrollTo(self.history_model.index(count, 0), QAbstractItemView.PositionAtTop)
+
+    def history_append(self, direction, messages, follow=True):
+        """
+        Функция добавления новых сообщений в конец текущего диалога.
+        Список прокручивается к ним, если follow или список был в конце.
+        """
+        scroll_bar = self.ui.list_messages.verticalScrollBar()
+        follow = follow or scroll_bar.value() == scroll_bar.maximum()
+        self.history_model.extend(direction, messages, trim=follow)
+        if follow:
+            self.ui.list_messages.scrollToBottom()
+
     def select_active_user(self):
         """Функция обработки двойного клика"""
         self.current_chat = self.ui.list_contacts.currentIndex().data()
@@ -123,13 +128,15 @@ class ClientMainWindow(QMainWindow):
 
     def set_active_user(self):
         """Функция активации чата с собеседником"""
-        # Запрашиваем публичный ключ пользователя и создаём объект шифрования
+        # Получаем публичный ключ пользователя (с сервера, только если его нет
+        # в локальной базе) и объект шифрования
         try:
-            self.current_chat_key = self.transport.key_request(self.current_chat)
+            self.current_chat_key, fingerprint = self.transport.public_key(self.current_chat)
             LOGGER.debug(f'Загружен ключ для {self.current_chat}')
             if self.current_chat_key:
-                self.encryptor = PKCS1_OAEP.new(RSA.import_key(self.current_chat_key))
-        except (OSError, json.JSONDecodeError):
+                # Сеансовый ключ шифруется ключом собеседника один раз на беседу
+                self.encryptor = self.encryptors.get(self.current_chat, self.current_chat_key, fingerprint)
+        except (OSError, ValueError):
             self.current_chat_key = None
             self.encryptor = None
             LOGGER.debug(f'Не удалось загрузить ключ для {self.current_chat}')
@@ -156,6 +163,35 @@ class ClientMainWindow(QMainWindow):
             self.contacts_model.appendRow(item)
         self.ui.list_contacts.setModel(self.contacts_model)
 
+    def search_window(self):
+        """
+        Функция поиска по истории сообщений.
+        Запускает окно с результатами поиска по введённой строке.
+        """
+        global search_dialog
+        search = self.ui.search_field.text().strip()
+        if not search:
+            return
+        search_dialog = SearchDialog(self.database, search)
+        search_dialog.results.itemDoubleClicked.connect(
+            lambda item: self.open_found_message(*item.data(Qt.UserRole)))
+        search_dialog.show()
+
+    def open_found_message(self, contact, date, row_id):
+        """
+        Функция перехода к найденному сообщению: открывает переписку
+        с собеседником и показывает историю вокруг сообщения.
+        """
+        if contact != self.current_chat:
+            self.current_chat = contact
+            self.set_active_user()
+        self.history_model.set_contact(contact, around=(date, row_id))
+        row = self.history_model.row_of(row_id)
+        if row is not None:
+            index = self.history_model.index(row, 0)
+            self.ui.list_messages.scrollTo(index, QAbstractItemView.PositionAtCenter)
+            self.ui.list_messages.setCurrentIndex(index)
+
     def add_contact_window(self):
         """
         Функция добавления контактов.
@@ -236,71 +272,90 @@ class ClientMainWindow(QMainWindow):
     def send_message(self):
         """
         Функция отправки сообщения текущему собеседнику.
-        Реализует шифрование сообщения и его отправку.
+        Сообщение ставится в очередь потоков шифрования, которые шифруют
+        и отправляют его, поэтому поле ввода сразу готово к следующему.
+        В историю сообщение добавляется после отправки, см. message_sent.
         """
         # Проверка поля на пустоту. Если поле не пустое, то забираем сообщение и очищаем поле
         message_text = self.ui.text_message.toPlainText()
         self.ui.text_message.clear()
         if not message_text:
             return
-        message_text_encrypted = self.encryptor.encrypt(message_text.encode('utf8'))
-        message_text_encrypted_base64 = base64.b64encode(message_text_encrypted)
-        try:
-            self.transport.send_message(self.current_chat, message_text_encrypted_base64.decode('ascii'))
-            pass
-        except ServerError as e:
-            self.messages.critical(self, 'Ошибка сервера', e.text)
-        except OSError as e:
-            if e.errno:
-                self.messages.critical(self, 'Ошибка', 'Потеряно соединение с сервером')
-                self.close()
-            self.messages.critical(self, 'Ошибка', 'Таймаут соединения')
-        except (ConnectionResetError, ConnectionAbortedError):
+        self.crypto.send(self.encryptor, self.current_chat, message_text)
+
+    @pyqtSlot(str, str)
+    def message_sent(self, recipient, message):
+        """Слот обработчик отправленного сообщения, добавляет его в текущий диалог."""
+        if recipient == self.current_chat:
+            self.history_append('out', [message])
+
+    @pyqtSlot(str, object)
+    def send_failed(self, recipient, error):
+        """Слот обработчик ошибки отправки сообщения."""
+        if isinstance(error, ServerError):
+            self.messages.critical(self, 'Ошибка сервера', error.text)
+        elif not isinstance(error, OSError):
+            self.messages.critical(self, 'Ошибка', f'Не удалось отправить сообщение для {recipient}')
+        elif getattr(error, 'errno', None) or isinstance(error, (ConnectionResetError, ConnectionAbortedError)):
             self.messages.critical(self, 'Ошибка', 'Потеряно соединение с сервером')
             self.close()
         else:
-            self.database.save_message(self.current_chat, 'out', message_text)
-            LOGGER.debug(f'Отравлено сообщение для {self.current_chat}: {message_text}')
-            self.history_list_update()
+            self.messages.critical(self, 'Ошибка', 'Таймаут соединения')
 
     @pyqtSlot(str)
-    def message(self, message):
+    def decrypt_failed(self, sender):
+        """Слот обработчик сообщения, которое не удалось расшифровать."""
+        self.messages.warning(self, 'Ошибка', f'Не удалось декодировать сообщение от {sender}')
+
+    @pyqtSlot(list)
+    def message(self, messages):
         """
-        Слот обработчик поступаемых сообщений, выполняет дешифровку
-        поступаемых сообщений и их сохранение в истории сообщений.
-        Запрашивает пользователя если пришло сообщение не от текущего
-        собеседника. При необходимости меняет собеседника.
+        Слот обработчик поступаемых сообщений - списка (отправитель, текст).
+        Сообщения уже расшифрованы и сохранены в истории потоками шифрования.
+        Сигналы от потоков обрабатываются подряд, поэтому сообщения только
+        запоминаются, а показываются все вместе после них, см. show_received.
         """
-        encrypted_message = base64.b64encode(message[MESSAGE_TEXT])
-        try:
-            decrypted_message = self.decrypter.decrypt(encrypted_message)
-        except (ValueError, TypeError):
-            self.messages.warning(self, 'Ошибка', 'Не удалось декодировать сообщение')
-            return
-        self.database.save_message(self.current_chat, 'in', decrypted_message.decode('utf8'))
+        if not self.received:
+            QTimer.singleShot(0, self.show_received)
+        self.received.extend(messages)
 
-        sender = message[SENDER]
-        if sender == self.current_chat:
-            self.history_list_update()
+    def show_received(self):
+        """
+        Функция вывода принятых сообщений. Сообщения текущего собеседника
+        добавляются в диалог одной вставкой. Запрашивает пользователя, если
+        пришли сообщения не от текущего собеседника, - один раз на отправителя.
+        При необходимости меняет собеседника.
+        """
+        messages, self.received = self.received, []
+        current = [text for sender, text in messages if sender == self.current_chat]
+        if current:
+            self.history_append('in', current, follow=False)
+        for sender in dict.fromkeys(sender for sender, _ in messages):
+            if sender != self.current_chat:
+                self.new_message_request(sender)
+
+    def new_message_request(self, sender):
+        """
+        Функция запроса пользователя о начале чата с отправителем
+        нового сообщения.
+        """
+        # Проверяем наличие пользователя в контактах
+        if self.database.check_contact(sender):
+            # Если есть, спрашиваем и желании открыть с ним чат и открываем
+            if self.messages.question(self, 'У Вас новое сообщение',\
+                                      f'Получено сообщение от {sender}, начать чат?', QMessageBox.Yes,
+                                      QMessageBox.No) == QMessageBox.Yes:
+                self.current_chat = sender
+                self.set_active_user()
         else:
-            # Проверяем наличие пользователя в контактах
-            if self.database.check_contact(sender):
-                # Если есть, спрашиваем и желании открыть с ним чат и открываем
-                if self.messages.question(self, 'У Вас новое сообщение',\
-                                          f'Получено сообщение от {sender}, начать чат?', QMessageBox.Yes,
-                                          QMessageBox.No) == QMessageBox.Yes:
-                    self.current_chat = sender
-                    self.set_active_user()
-            else:
-                if self.messages.question(self, 'У Вас новое сообщение',\
-                                          f'Получено сообщение от {sender}. \n '
-                                          f'Пользователя нет в списке контактов. \n '
-                                          f'Добавить пользователя в контакты и начать чат?',
-                                          QMessageBox.Yes, QMessageBox.No) == QMessageBox.Yes:
-                    self.add_contact(sender)
-                    self.current_chat = sender
-                    self.database.save_message(self.current_chat, 'in', decrypted_message.decode('utf8'))
-                    self.set_active_user()
+            if self.messages.question(self, 'У Вас новое сообщение',\
+                                      f'Получено сообщение от {sender}. \n '
+                                      f'Пользователя нет в списке контактов. \n '
+                                      f'Добавить пользователя в контакты и начать чат?',
+                                      QMessageBox.Yes, QMessageBox.No) == QMessageBox.Yes:
+                self.add_contact(sender)
+                self.current_chat = sender
+                self.set_active_user()
 
     # В случае потери соединения
     @pyqtSlot()
@@ -319,11 +374,33 @@ class ClientMainWindow(QMainWindow):
         """
         if self.current_chat and not self.database.check_user(self.current_chat):
             self.messages.warning(self, 'Упс...', 'Пользователь был удален с сервера')
-            self.disabled_input()
+            self.disable_input()
             self.current_chat = None
         self.contact_list_update()
 
+    @pyqtSlot(list)
+    def keys_changed(self, names):
+        """
+        Слот обработчик смены открытых ключей пользователей.
+        Сохранённые ключи удаляются, новые будут запрошены при открытии чата.
+        Если ключ сменил текущий собеседник, ключ запрашивается сразу.
+        """
+        self.database.del_public_keys(names)
+        self.encryptors.discard(names)
+        if self.current_chat in names:
+            self.set_active_user()
+
     def make_connection(self, trans_obj):
         """Функция обеспечивающая соединение сигналов и слотов."""
-        trans_obj.new_message.connect(self.message)
+        # Входящие сообщения поток чтения сразу передаёт потокам шифрования,
+        # окно получает уже расшифрованные
+        trans_obj.new_message.connect(self.crypto.decrypt, Qt.DirectConnection)
+        # Сообщения почтового ящика подтверждаются после расшифровки и сохранения
+        trans_obj.mailbox_received.connect(self.crypto.after, Qt.DirectConnection)
+        self.crypto.messages_ready.connect(self.message)
+        self.crypto.decrypt_failed.connect(self.decrypt_failed)
+        self.crypto.message_sent.connect(self.message_sent)
+        self.crypto.send_failed.connect(self.send_failed)
         trans_obj.connection_lost.connect(self.connection_lost)
+        trans_obj.message_205.connect(self.signal_205)
+        trans_obj.keys_changed.connect(self.keys_changed)
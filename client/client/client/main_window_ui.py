@@ -27,8 +27,11 @@ class Ui_MainClientWindow(object):
         self.btn_remove_contact.setGeometry(QtCore.QRect(140, 450, 121, 31))
         self.btn_remove_contact.setObjectName("btn_remove_contact")
         self.label_history = QtWidgets.QLabel(self.centralwidget)
-        self.label_history.setGeometry(QtCore.QRect(300, 0, 391, 21))
+        self.label_history.setGeometry(QtCore.QRect(300, 0, 191, 21))
         self.label_history.setObjectName("label_history")
+        self.search_field = QtWidgets.QLineEdit(self.centralwidget)
+        self.search_field.setGeometry(QtCore.QRect(500, 0, 241, 20))
+        self.search_field.setObjectName("search_field")
         self.text_message = QtWidgets.QTextEdit(self.centralwidget)
         self.text_message.setGeometry(QtCore.QRect(300, 360, 441, 71))
         self.text_message.setObjectName("text_message")
@@ -83,6 +86,7 @@ class Ui_MainClientWindow(object):
         self.btn_add_contact.setText(_translate("MainClientWindow", "Добавить контакт"))
         self.btn_remove_contact.setText(_translate("MainClientWindow", "Удалить контакт"))
         self.label_history.setText(_translate("MainClientWindow", "Окно чата:"))
+        self.search_field.setPlaceholderText(_translate("MainClientWindow", "Поиск по истории сообщений"))
         self.label_new_message.setText(_translate("MainClientWindow", "Окно ввода сообщений:"))
         self.btn_send.setText(_translate("MainClientWindow", "Отправить сообщение"))
         self.btn_clear.setText(_translate("MainClientWindow", "Очистить поле ввода"))
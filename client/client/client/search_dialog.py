@@ -0,0 +1,64 @@
+import sys
+import logging
+
+from PyQt5.QtWidgets import QDialog, QLabel, QListWidget, QListWidgetItem, QPushButton
+from PyQt5.QtCore import Qt
+
+sys.path.append('../')
+
+LOGGER = logging.getLogger('client')
+
+
+class SearchDialog(QDialog):
+    """
+    Результаты поиска по истории сообщений.
+    Показывает найденные сообщения по убыванию релевантности страницами,
+    двойной клик по результату открывает переписку на этом сообщении.
+    """
+    def __init__(self, database, search):
+        super().__init__()
+        self.database = database
+        self.search = search
+        # Количество уже показанных результатов - с него начинается следующая страница
+        self.offset = 0
+
+        self.setFixedSize(420, 330)
+        self.setWindowTitle(f'Поиск: {search}')
+        self.setAttribute(Qt.WA_DeleteOnClose)
+
+        self.results_label = QLabel('Найденные сообщения:', self)
+        self.results_label.setFixedSize(400, 20)
+        self.results_label.move(10, 0)
+
+        self.results = QListWidget(self)
+        self.results.setFixedSize(400, 250)
+        self.results.move(10, 25)
+        self.results.setWordWrap(True)
+
+        self.btn_more = QPushButton('Показать ещё', self)
+        self.btn_more.setFixedSize(100, 30)
+        self.btn_more.move(10, 290)
+        self.btn_more.setEnabled(False)
+        self.btn_more.clicked.connect(self.update_results)
+
+        self.btn_close = QPushButton('Закрыть', self)
+        self.btn_close.setFixedSize(100, 30)
+        self.btn_close.move(310, 290)
+        self.btn_close.clicked.connect(self.close)
+
+        self.update_results()
+
+    def update_results(self):
+        """Функция добавления в список следующей страницы результатов поиска."""
+        found, more = self.database.search_messages(self.search, offset=self.offset)
+        LOGGER.debug(f'Найдено сообщений по запросу {self.search}: {len(found)}')
+        self.offset += len(found)
+        for row_id, contact, direction, fragment, date in found:
+            title = 'от' if direction == 'in' else 'для'
+            item = QListWidgetItem(f'{title} {contact}, {date.replace(microsecond=0)}:\n{fragment}')
+            # Ключ сообщения для перехода к нему в переписке
+            item.setData(Qt.UserRole, (contact, date, row_id))
+            self.results.addItem(item)
+        if not self.offset:
+            self.results_label.setText('Сообщения не найдены.')
+        self.btn_more.setEnabled(more)
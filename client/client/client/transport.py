@@ -1,25 +1,34 @@
+import selectors
 import socket
 import sys
 import time
 import threading
 import json
 import logging
+import datetime
 import hashlib
 import hmac
 import binascii
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from itertools import count
 
 from PyQt5.QtCore import pyqtSignal, QObject
-from common.utils import get_message, send_message
+from common.utils import get_message, send_message, MessageDecoder
 from common.errors import ServerError, IncorrectDataRecivedError
 from common.variables import ACTION, PRESENCE, TIME, USER, ACCOUNT_NAME, PUBLIC_KEY, RESPONSE, ERROR, DATA, \
     RESPONSE_511, MESSAGE, SENDER, DESTINATION, MESSAGE_TEXT, GET_CONTACTS, LIST_INFO, PUBLIC_KEY_REQUEST, \
-    ADD_CONTACT, REMOVE_CONTACT, EXIT, USERS_REQUEST
+    ADD_CONTACT, REMOVE_CONTACT, EXIT, USERS_REQUEST, FRAMING, FRAMING_LENGTH_PREFIX, DIRECTORY_VERSION, \
+    USERS_ADDED, USERS_REMOVED, EVENT, EVENT_TYPE, USER_ADDED, USER_REMOVED, CONTACT_CHANGED, KEY_CHANGED, \
+    DIRECTORY_SINCE, SEARCH_USERS, SEARCH_PREFIX, SEARCH_AFTER, SEARCH_LIMIT, SEARCH_MORE, SEARCH_PAGE_SIZE, \
+    REQUEST_ID, REQUEST_TIMEOUT, PUBLIC_KEY_TTL, GET_MAILBOX, MAILBOX_MESSAGES, MAILBOX_ACK
+from client.encryption import key_fingerprint
 
 sys.path.append('../')
 
 # Инициализация логгера клиента
 LOGGER = logging.getLogger('client')
-# Объект блокировки сокета и работы с базой данных
+# Объект блокировки записи в сокет
 sock_lock = threading.Lock()
 
 
@@ -29,9 +38,13 @@ class ClientTransport(threading.Thread, QObject):
     Реализует транспортную подсистему клиентского модуля.
     """
     # Сигналы новое сообщение и потеря соединения
-    new_message = pyqtSignal(str)
+    new_message = pyqtSignal(dict)
     message_205 = pyqtSignal()
     connection_lost = pyqtSignal()
+    keys_changed = pyqtSignal(list)
+    # Порция сообщений из почтового ящика передана обработчикам new_message.
+    # Аргумент - функция подтверждения, её вызывают после сохранения сообщений.
+    mailbox_received = pyqtSignal(object)
 
     def __init__(self, port, ip_address, database, username, passwd, keys):
         threading.Thread.__init__(self)
@@ -42,10 +55,25 @@ class ClientTransport(threading.Thread, QObject):
         self.username = username
         # Сокет для работы с сервером
         self.transport = None
+        # Декодер входящего потока, режим кадров согласуется при авторизации
+        self.decoder = MessageDecoder()
         # Пароль
         self.password = passwd
         # Набор ключей для шифрования
         self.keys = keys
+        # Номера запросов и запросы, ожидающие ответа сервера: номер -> Future
+        self.request_ids = count(1)
+        self.pending = OrderedDict()
+        self.pending_lock = threading.Lock()
+        # Пока поток чтения не запущен, ответы на запросы читает сам запрос
+        self.reader_running = False
+        # Сообщения сервера, не являющиеся ответами, принятые до подключения
+        # обработчиков сигналов. Передаются в process_ans в start_delivery.
+        self.pushes = deque()
+        self.pushes_lock = threading.Lock()
+        self.delivering = False
+        # Пара сокетов для пробуждения потока чтения при завершении работы
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
         # Устанавливаем соединение:
         self.connection_init(port, ip_address)
         # Обновление таблиц известных пользователей и контактов
@@ -105,27 +133,30 @@ class ClientTransport(threading.Thread, QObject):
                 USER: {
                     ACCOUNT_NAME: self.username,
                     PUBLIC_KEY: pubkey
-                }
+                },
+                FRAMING: FRAMING_LENGTH_PREFIX
             }
             LOGGER.debug(f'Приветственное сообщение: {presense}')
             # Посылаем серверу приветственное сообщение и получаем ответ что всё нормально или получаем исключение.
             try:
-                send_message(self.transport, presense)
-                ans = get_message(self.transport)
+                send_message(self.transport, presense, self.decoder.framed)
+                ans = get_message(self.transport, self.decoder)
                 LOGGER.debug(f'Ответ сервера: {ans}')
                 if RESPONSE in ans:
                     if ans[RESPONSE] == 400:
                         raise ServerError(ans[ERROR])
                     elif ans[RESPONSE] == 511:
+                        # Если сервер подтвердил потоковый протокол, дальше обмен идёт кадрами
+                        self.decoder.framed = ans.get(FRAMING) == FRAMING_LENGTH_PREFIX
                         # Если всё нормально, то продолжаем процедуру авторизации.
                         ans_data = ans[DATA]
-                        hash = hmac.new(passwd_hash_string, ans_data.encode('utf-8'))
+                        hash = hmac.new(passwd_hash_string, ans_data.encode('utf-8'), 'MD5')
                         digest = hash.digest()
                         my_ans = RESPONSE_511
                         my_ans[DATA] = binascii.b2a_base64(
                             digest).decode('ascii')
-                        send_message(self.transport, my_ans)
-                        self.process_server_ans(get_message(self.transport))
+                        send_message(self.transport, my_ans, self.decoder.framed)
+                        self.process_ans(get_message(self.transport, self.decoder))
             except (OSError, json.JSONDecodeError) as e:
                 LOGGER.critical(f'Потеряно соединение с сервером.', exc_info=e)
                 raise ServerError('Сбой соединения с сервером в процессе авторизации.')
@@ -153,9 +184,8 @@ class ClientTransport(threading.Thread, QObject):
             elif message[RESPONSE] == 400:
                 raise ServerError(f'400 : {message[ERROR]}')
             elif message[RESPONSE] == 205:
-                self.user_list_request()
-                self.contacts_list_request()
-                self.message_205.emit()
+                # Запросы нельзя ждать в потоке чтения, списки обновляются в отдельном потоке
+                threading.Thread(target=self.update_lists, daemon=True).start()
             else:
                 LOGGER.debug('Неизвестный код подтверждения')
 
@@ -167,6 +197,143 @@ class ClientTransport(threading.Thread, QObject):
 
             self.new_message.emit(message)
 
+        # Порция сообщений, поступивших пока пользователь был не в сети
+        elif ACTION in message and message[ACTION] == MAILBOX_MESSAGES and LIST_INFO in message:
+            self.process_mailbox(message[LIST_INFO])
+
+        # Уведомление сервера об изменении справочника или списка контактов
+        elif ACTION in message and message[ACTION] == EVENT and EVENT_TYPE in message and LIST_INFO in message:
+            self.process_event(message)
+
+    def process_mailbox(self, messages):
+        """
+        Функция обработки порции сообщений из почтового ящика на сервере.
+        Сервер удаляет сообщения из ящика после подтверждения, поэтому оно
+        отправляется только после сохранения сообщений в базе. Если сообщения
+        обрабатываются асинхронно, подтверждение отправляет обработчик
+        сигнала mailbox_received, иначе - эта функция после записи в базу.
+        """
+        LOGGER.debug(f'Получено сообщений из почтового ящика: {len(messages)}')
+        for message in messages:
+            self.process_ans(message)
+        if self.receivers(self.mailbox_received):
+            self.mailbox_received.emit(self.mailbox_ack)
+        else:
+            self.database.flush()
+            self.mailbox_ack()
+
+    def mailbox_ack(self):
+        """
+        Функция подтверждения серверу получения порции сообщений из почтового ящика.
+        Ответа на подтверждение нет, поэтому оно отправляется без ожидания,
+        в том числе из потока чтения и потоков шифрования.
+        """
+        with sock_lock:
+            try:
+                send_message(self.transport, {ACTION: MAILBOX_ACK, TIME: time.time(),
+                                              ACCOUNT_NAME: self.username}, self.decoder.framed)
+            except OSError as e:
+                LOGGER.error(f'Не удалось подтвердить получение сообщений: {e}')
+
+    def process_event(self, message):
+        """
+        Функция применения уведомления сервера об изменениях.
+        Уведомление содержит сами изменения, поэтому списки не запрашиваются заново.
+        """
+        LOGGER.debug(f'Получено уведомление {message[EVENT_TYPE]}: {message[LIST_INFO]}')
+        if message[EVENT_TYPE] in (USER_ADDED, USER_REMOVED):
+            # Если предыдущие изменения справочника не были получены, версия
+            # сбрасывается и при следующем запросе придёт полный список
+            version = message[DIRECTORY_VERSION]
+            if self.database.get_directory_version() < message[DIRECTORY_SINCE]:
+                version = 0
+            if message[EVENT_TYPE] == USER_ADDED:
+                self.database.update_users(message[LIST_INFO], [], version)
+            else:
+                self.database.update_users([], message[LIST_INFO], version)
+        elif message[EVENT_TYPE] == CONTACT_CHANGED:
+            self.database.contacts_clear()
+            for contact in message[LIST_INFO]:
+                self.database.add_contact(contact)
+        elif message[EVENT_TYPE] == KEY_CHANGED:
+            # Сохранённые ключи устарели и удаляются обработчиком сигнала
+            self.keys_changed.emit(message[LIST_INFO])
+            return
+        else:
+            LOGGER.debug('Неизвестный тип уведомления')
+            return
+        self.message_205.emit()
+
+    def update_lists(self):
+        """Функция обновления списков пользователей и контактов по команде сервера."""
+        try:
+            self.user_list_request()
+            self.contacts_list_request()
+        except (OSError, ServerError):
+            LOGGER.error('Не удалось обновить списки пользователей и контактов')
+            return
+        self.message_205.emit()
+
+    def request(self, message):
+        """
+        Функция отправки запроса серверу и ожидания ответа.
+        Запросу присваивается номер, сервер возвращает его в ответе.
+        Ответ принимает поток чтения, поэтому одновременно может
+        выполняться несколько запросов из разных потоков.
+        Пока поток чтения не запущен, ответ читается здесь же.
+        """
+        future = Future()
+        with self.pending_lock:
+            request_id = next(self.request_ids)
+            self.pending[request_id] = future
+        message[REQUEST_ID] = request_id
+        try:
+            with sock_lock:
+                send_message(self.transport, message, self.decoder.framed)
+            if not self.reader_running:
+                while not future.done():
+                    self.dispatch(get_message(self.transport, self.decoder))
+            return future.result(REQUEST_TIMEOUT)
+        finally:
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+
+    def dispatch(self, message):
+        """
+        Функция разбора принятого сообщения: ответ передаётся ожидающему
+        его запросу, остальные сообщения - функции process_ans.
+        """
+        if RESPONSE not in message:
+            self.process_push(message)
+            return
+        with self.pending_lock:
+            if REQUEST_ID in message:
+                future = self.pending.pop(message[REQUEST_ID], None)
+            elif self.pending:
+                # Сервер, не поддерживающий номера запросов, отвечает по порядку
+                future = self.pending.popitem(last=False)[1]
+            else:
+                future = None
+        if future is not None:
+            future.set_result(message)
+        elif REQUEST_ID not in message:
+            self.process_push(message)
+        else:
+            LOGGER.debug(f'Получен ответ на запрос, который больше не ожидается: {message}')
+
+    def process_push(self, message):
+        """
+        Функция обработки сообщения, отправленного сервером по своей инициативе.
+        До вызова start_delivery сигналы интерфейса не подключены, поэтому
+        такие сообщения, принятые при запросах во время подключения,
+        запоминаются и обрабатываются позже в том же порядке.
+        """
+        with self.pushes_lock:
+            if not self.delivering:
+                self.pushes.append(message)
+                return
+            self.process_ans(message)
+
     def contacts_list_request(self):
         """Функция генерирует запрос и обновление контакт листа с сервера"""
         self.database.contacts_clear()
@@ -177,9 +344,7 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username
         }
         LOGGER.debug(f'Сформирован запрос {req}')
-        with sock_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
+        ans = self.request(req)
         LOGGER.debug(f'Получен ответ {ans}')
         if RESPONSE in ans and ans[RESPONSE] == 202:
             for contact in ans[LIST_INFO]:
@@ -188,21 +353,47 @@ class ClientTransport(threading.Thread, QObject):
             LOGGER.error('Не удалось обновить список контактов')
 
     def user_list_request(self):
-        """Функция запроса списка известных пользователей"""
+        """
+        Функция запроса списка известных пользователей.
+        Запрашиваются только изменения после сохранённой версии справочника,
+        сервер может ответить и полным списком.
+        """
         LOGGER.debug(f'Запрос списка известных пользователей {self.username}')
         req = {
             ACTION: USERS_REQUEST,
             TIME: time.time(),
-            ACCOUNT_NAME: self.username
+            ACCOUNT_NAME: self.username,
+            DIRECTORY_VERSION: self.database.get_directory_version()
         }
-        with sock_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
-        if RESPONSE in ans and ans[RESPONSE] == 202:
-            self.database.add_users(ans[LIST_INFO])
+        ans = self.request(req)
+        if RESPONSE in ans and ans[RESPONSE] == 202 and LIST_INFO in ans:
+            self.database.add_users(ans[LIST_INFO], ans.get(DIRECTORY_VERSION, 0))
+        elif RESPONSE in ans and ans[RESPONSE] == 202 and DIRECTORY_VERSION in ans:
+            self.database.update_users(ans[USERS_ADDED], ans[USERS_REMOVED], ans[DIRECTORY_VERSION])
         else:
             LOGGER.error('Не удалось обновить список известных пользователей')
 
+    def search_users(self, prefix, after=None, limit=SEARCH_PAGE_SIZE):
+        """
+        Функция поиска пользователей на сервере по началу имени.
+        Возвращает страницу имён, следующих за after, и признак наличия следующей страницы.
+        """
+        LOGGER.debug(f'Поиск пользователей: {prefix}')
+        req = {
+            ACTION: SEARCH_USERS,
+            TIME: time.time(),
+            ACCOUNT_NAME: self.username,
+            SEARCH_PREFIX: prefix,
+            SEARCH_LIMIT: limit
+        }
+        if after is not None:
+            req[SEARCH_AFTER] = after
+        ans = self.request(req)
+        if RESPONSE in ans and ans[RESPONSE] == 202 and LIST_INFO in ans:
+            return ans[LIST_INFO], ans.get(SEARCH_MORE, False)
+        LOGGER.error(f'Не удалось выполнить поиск пользователей {prefix}')
+        return [], False
+
     def key_request(self, user):
         """Функция запрашивающая с сервера публичный ключ пользователя."""
         LOGGER.debug(f'Запрос публичного ключа для {user}')
@@ -211,14 +402,59 @@ class ClientTransport(threading.Thread, QObject):
             TIME: time.time(),
             ACCOUNT_NAME: user
         }
-        with sock_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
+        ans = self.request(req)
         if RESPONSE in ans and ans[RESPONSE] == 511:
             return ans[DATA]
         else:
             LOGGER.error(f'Не удалось получить ключ собеседника {user}.')
 
+    def public_key(self, user):
+        """
+        Функция возвращающая публичный ключ пользователя и его отпечаток.
+        Ключ берётся из локальной базы, с сервера запрашивается только
+        отсутствующий или не проверявшийся дольше PUBLIC_KEY_TTL ключ.
+        """
+        saved = self.database.get_public_key(user)
+        if saved and (datetime.datetime.now() - saved[2]).total_seconds() < PUBLIC_KEY_TTL:
+            return saved[0], saved[1]
+        try:
+            key = self.key_request(user)
+        except OSError:
+            # Если сервер недоступен, используется сохранённый ключ
+            if not saved:
+                raise
+            key = None
+        if not key:
+            return (saved[0], saved[1]) if saved else (None, None)
+        fingerprint = key_fingerprint(key)
+        self.database.save_public_key(user, key, fingerprint)
+        return key, fingerprint
+
+    def start_delivery(self):
+        """
+        Функция начала приёма сообщений сервера. Вызывается, когда к сигналам
+        транспорта подключены обработчики, иначе сообщения были бы потеряны.
+        Обрабатывает сообщения, принятые при подключении, и запрашивает
+        сообщения, поступившие пока пользователь был не в сети.
+        """
+        with self.pushes_lock:
+            self.delivering = True
+            while self.pushes:
+                try:
+                    self.process_ans(self.pushes.popleft())
+                except ServerError as e:
+                    LOGGER.error(f'Ошибка сервера: {e}')
+        LOGGER.debug('Запрос сообщений из почтового ящика')
+        req = {
+            ACTION: GET_MAILBOX,
+            TIME: time.time(),
+            ACCOUNT_NAME: self.username
+        }
+        try:
+            self.process_ans(self.request(req))
+        except (OSError, ServerError) as e:
+            LOGGER.error(f'Не удалось запросить сообщения из почтового ящика: {e}')
+
     def add_contact(self, contact):
         """Функция добавления пользователя в контакт лист"""
         LOGGER.debug(f'Создание контакта {contact}')
@@ -228,9 +464,7 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with sock_lock:
-            send_message(self.transport, req)
-            self.process_ans(get_message(self.transport))
+        self.process_ans(self.request(req))
 
     def remove_contact(self, contact):
         """Функция удаления пользователя из контакт листа"""
@@ -241,9 +475,7 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with sock_lock:
-            send_message(self.transport, req)
-            self.process_ans(get_message(self.transport))
+        self.process_ans(self.request(req))
 
     def transport_shutdown(self):
         """Функция закрытия соединения с отправкой сообщения о выходе"""
@@ -255,9 +487,11 @@ class ClientTransport(threading.Thread, QObject):
         }
         with sock_lock:
             try:
-                send_message(self.transport, message)
+                send_message(self.transport, message, self.decoder.framed)
             except OSError:
                 pass
+        # Будим поток чтения, чтобы он проверил флаг завершения
+        self.wakeup_writer.send(b'\0')
         LOGGER.debug('Завершение работы транспорта')
         time.sleep(0.5)
 
@@ -271,36 +505,59 @@ class ClientTransport(threading.Thread, QObject):
             MESSAGE_TEXT: message
         }
         LOGGER.debug(f'Сформировано сообщение: {message_dic}')
-        # Ждем сокета для отправки сообщения
-        with sock_lock:
-            send_message(self.transport, message_dic)
-            self.process_ans(get_message(self.transport))
-            LOGGER.info(f'Сообщение отправлено клиенту {to_user}')
+        self.process_ans(self.request(message_dic))
+        LOGGER.info(f'Сообщение отправлено клиенту {to_user}')
+
+    def start(self):
+        """
+        Функция запуска потока чтения. Признак работы потока ставится до
+        запуска, чтобы запрос, выполненный сразу после start, не читал
+        сокет одновременно с потоком.
+        """
+        self.reader_running = True
+        super().start()
 
     def run(self):
-        """Функция содержащая основной цикл работы транспортного потока."""
+        """
+        Функция содержащая основной цикл работы транспортного потока.
+        Поток ждёт данных от сервера в селекторе без таймаутов и блокировок,
+        ответы передаются ожидающим их запросам, сообщения пользователей
+        и уведомления - в process_ans, который передаёт их интерфейсу сигналами.
+        """
         LOGGER.debug('Запущен процесс приема сообщений с сервера')
-        while self.running:
-            time.sleep(1)
-            with sock_lock:
+        # Сообщения, принятые вместе с ответами на запросы до запуска потока
+        while self.decoder.messages:
+            self.dispatch(self.decoder.messages.popleft())
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.transport, selectors.EVENT_READ)
+            selector.register(self.wakeup_reader, selectors.EVENT_READ)
+            while self.running:
+                events = selector.select()
+                if not self.running:
+                    break
+                if not any(key.fileobj is self.transport for key, _ in events):
+                    continue
                 try:
-                    self.transport.settimeout(0.5)
-                    message = get_message(self.transport)
-                except OSError as e:
-                    if e.errno:
+                    data = self.transport.recv(self.decoder.recv_size)
+                    if not data:
+                        raise ConnectionResetError
+                    messages = self.decoder.feed(data)
+                except (OSError, json.JSONDecodeError, TypeError, IncorrectDataRecivedError):
+                    if self.running:
                         LOGGER.critical(f'Соединение с сервером потеряно')
                         self.running = False
                         self.connection_lost.emit()
-                except IncorrectDataRecivedError:
-                    LOGGER.error(f'Не удалось декодировать сообщение')
-                except (ConnectionError, ConnectionAbortedError, ConnectionResetError, json.JSONDecodeError, TypeError):
-                    LOGGER.critical(f'Соединение с сервером потеряно')
-                    self.running = False
-                    self.connection_lost.emit()
-                finally:
-                    self.transport.settimeout(1)
-
-        # Если сообщение получено, то вызываем функцию обработчик:
-        if message:
-            LOGGER.debug(f'Принято сообщение с сервера: {message}')
-            self.process_ans(message)
+                    break
+                for message in messages:
+                    LOGGER.debug(f'Принято сообщение с сервера: {message}')
+                    try:
+                        self.dispatch(message)
+                    except ServerError as e:
+                        LOGGER.error(f'Ошибка сервера: {e}')
+        self.reader_running = False
+        # Запросы, ожидающие ответа, завершаем ошибкой соединения
+        with self.pending_lock:
+            futures = list(self.pending.values())
+            self.pending.clear()
+        for future in futures:
+            future.set_exception(ConnectionResetError())
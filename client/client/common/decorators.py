@@ -40,10 +40,9 @@ def login_required(func):
             found = False
             for arg in args:
                 if isinstance(arg, socket.socket):
-                    # Проверяем, что данный сокет есть в списке names класса
-                    for client in args[0].names:
-                        if args[0].names[client] == arg:
-                            found = True
+                    # Проверяем, что на данном сокете авторизован пользователь
+                    if args[0].registry.is_authorized(arg):
+                        found = True
             # Проверяем, что передаваемые аргументы не presence
             # сообщение. Если presense, то разрешаем
             for arg in args:
@@ -9,6 +9,34 @@ DEFAULT_IP_ADDRESS = '127.0.0.1'
 MAX_CONNECTIONS = 5
 # Максимальная длинна сообщения в байтах
 MAX_PACKAGE_LENGTH = 1024
+# Размер буфера чтения из сокета при потоковом (кадровом) протоколе
+RECV_BUFFER_SIZE = 65536
+# Максимальная длинна кадра в байтах
+MAX_FRAME_LENGTH = 16 * 1024 * 1024
+# Максимальный объём очереди отправки одного клиента в памяти, байт
+OUTBOUND_LIMIT = 1024 * 1024
+# Время на прохождение авторизации после подключения, сек.
+HANDSHAKE_TIMEOUT = 5
+# Время ожидания клиентом ответа сервера на запрос, сек.
+REQUEST_TIMEOUT = 5
+# Срок хранения сообщений для пользователей не в сети, сек.
+MAILBOX_TTL = 7 * 24 * 60 * 60
+# Максимальное количество сообщений в почтовом ящике одного пользователя
+MAILBOX_LIMIT = 10000
+# Количество сообщений из почтового ящика, отправляемых клиенту за один раз
+MAILBOX_BATCH = 100
+# Время объединения уведомлений об изменениях в одно, сек.
+EVENTS_DEBOUNCE = 0.2
+# Размер страницы результатов поиска пользователей по умолчанию и максимальный
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_LIMIT = 100
+# Время, по истечении которого клиент заново проверяет сохранённый
+# открытый ключ собеседника, сек.
+PUBLIC_KEY_TTL = 24 * 60 * 60
+# Количество сообщений истории, загружаемых клиентом за один раз
+HISTORY_PAGE_SIZE = 20
+# Количество результатов поиска по истории сообщений на странице
+HISTORY_SEARCH_PAGE_SIZE = 20
 # Кодировка проекта
 ENCODING = 'utf-8'
 # Текущий уровень логирования
@@ -18,6 +46,13 @@ SERVER_DATABASE = 'sqlite:///server_base.db3'
 # Конфигурация настроек сервера:
 SERVER_CONFIG = 'server.ini'
 
+# Политики для получателей, не успевающих принимать сообщения:
+# отбросить сообщение, отключить клиента, сбросить очередь на диск
+SLOW_CONSUMER_DROP = 'drop'
+SLOW_CONSUMER_DISCONNECT = 'disconnect'
+SLOW_CONSUMER_SPILL = 'spill'
+SLOW_CONSUMER_POLICY = SLOW_CONSUMER_DISCONNECT
+
 # Прококол JIM основные ключи:
 ACTION = 'action'
 TIME = 'time'
@@ -27,6 +62,9 @@ SENDER = 'from'
 DESTINATION = 'to'
 DATA = 'bin'
 PUBLIC_KEY = 'pubkey'
+FRAMING = 'framing'
+# Номер запроса клиента, сервер возвращает его в ответе на запрос
+REQUEST_ID = 'request_id'
 
 # Прочие ключи, используемые в протоколе
 PRESENCE = 'presence'
@@ -43,6 +81,34 @@ REMOVE_CONTACT = 'remove'
 ADD_CONTACT = 'add'
 USERS_REQUEST = 'get_users'
 PUBLIC_KEY_REQUEST = 'public_key_need'
+# Версия справочника пользователей и его изменения после этой версии
+DIRECTORY_VERSION = 'directory_version'
+USERS_ADDED = 'users_added'
+USERS_REMOVED = 'users_removed'
+# Уведомления об изменениях: тип события и версия справочника, с которой начинаются изменения
+EVENT = 'event'
+EVENT_TYPE = 'event_type'
+USER_ADDED = 'user_added'
+USER_REMOVED = 'user_removed'
+CONTACT_CHANGED = 'contact_changed'
+KEY_CHANGED = 'key_changed'
+DIRECTORY_SINCE = 'directory_since'
+# Поиск пользователей по началу имени: запрос, имя после которого
+# начинается страница, размер страницы и признак наличия следующей страницы
+SEARCH_USERS = 'search_users'
+SEARCH_PREFIX = 'prefix'
+SEARCH_AFTER = 'after'
+SEARCH_LIMIT = 'limit'
+SEARCH_MORE = 'more'
+# Почтовый ящик: запрос клиента, готового принимать сообщения, порция
+# сообщений из ящика и подтверждение клиентом её получения
+GET_MAILBOX = 'get_mailbox'
+MAILBOX_MESSAGES = 'mailbox_messages'
+MAILBOX_ACK = 'mailbox_ack'
+
+# Способы разбиения потока на сообщения
+# Кадр: 4 байта длинны (big-endian) и JSON сообщение
+FRAMING_LENGTH_PREFIX = 'length_prefix'
 
 # Словари - ответы:
 # 200
@@ -0,0 +1,70 @@
+"""
+Замер скорости шифрования и расшифровки сообщений: прежний формат
+(текст целиком зашифрован RSA) и конверт с сеансовым ключом AES-GCM.
+
+Пример: python crypto_bench.py -c 2000 -l 100
+"""
+
+import sys
+import argparse
+import base64
+import time
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.PublicKey import RSA
+
+from client.encryption import MessageEncryptor, MessageDecryptor
+
+
+def create_arg_parser():
+    """Парсер аргументов командной строки."""
+    parser = argparse.ArgumentParser(description='Скорость шифрования сообщений')
+    parser.add_argument('-c', '--count', default=1000, type=int, help='количество сообщений')
+    parser.add_argument('-l', '--length', default=100, type=int, help='длинна сообщения, символов')
+    parser.add_argument('-b', '--big', default=65536, type=int,
+                        help='длинна большого сообщения, только для конверта')
+    return parser.parse_args(sys.argv[1:])
+
+
+def measure(function, messages):
+    """Функция возвращающая количество обработанных сообщений в секунду и результаты."""
+    start = time.perf_counter()
+    results = [function(message) for message in messages]
+    return len(messages) / (time.perf_counter() - start), results
+
+
+def main():
+    """Основная функция замера."""
+    namespace = create_arg_parser()
+    keys = RSA.generate(2048)
+    public_key = keys.publickey().export_key()
+    texts = [('й' * namespace.length)[:namespace.length] for _ in range(namespace.count)]
+
+    # Прежний формат, длинна текста ограничена размером ключа RSA
+    legacy_encryptor = PKCS1_OAEP.new(RSA.import_key(public_key))
+    decryptor = MessageDecryptor(keys)
+    try:
+        speed, encrypted = measure(
+            lambda text: base64.b64encode(legacy_encryptor.encrypt(text.encode('utf8'))).decode('ascii'), texts)
+    except ValueError:
+        print(f'RSA: сообщение длинной {namespace.length} символов не помещается в ключ')
+    else:
+        print(f'RSA: шифрование {speed:.0f} сообщ./с', end=', ')
+        speed, _ = measure(lambda text: decryptor.decrypt(text, 'sender', 'receiver'), encrypted)
+        print(f'расшифровка {speed:.0f} сообщ./с')
+
+    encryptor = MessageEncryptor(public_key, 'sender', 'receiver')
+    speed, encrypted = measure(encryptor.encrypt, texts)
+    print(f'AES-GCM: шифрование {speed:.0f} сообщ./с', end=', ')
+    speed, decrypted = measure(lambda text: decryptor.decrypt(text, 'sender', 'receiver'), encrypted)
+    assert decrypted == texts
+    print(f'расшифровка {speed:.0f} сообщ./с')
+
+    big = ['й' * namespace.big] * 10
+    speed, encrypted = measure(encryptor.encrypt, big)
+    speed, decrypted = measure(lambda text: decryptor.decrypt(text, 'sender', 'receiver'), encrypted)
+    assert decrypted == big
+    print(f'AES-GCM, {namespace.big} символов: расшифровка {speed:.0f} сообщ./с')
+
+
+if __name__ == '__main__':
+    main()
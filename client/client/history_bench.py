@@ -0,0 +1,133 @@
+"""
+Замер отрисовки истории переписки без графической оболочки (offscreen):
+открытие чата с большой историей, поток новых сообщений и прокрутка
+к старым сообщениям. Для сравнения замеряется прежний способ -
+перестроение QStandardItemModel из последних 20 сообщений на каждое.
+
+Пример: python history_bench.py -n 100000 -b 1000
+"""
+
+import os
+import sys
+import argparse
+import datetime
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+from PyQt5.QtWidgets import QApplication, QListView, QAbstractItemView
+from PyQt5.QtGui import QStandardItemModel, QStandardItem, QBrush, QColor
+from PyQt5.QtCore import Qt
+
+from client.database import ClientDatabase
+from client.history_model import HistoryModel, MessageDelegate
+
+# Собеседник, история переписки с которым создаётся для замера
+CONTACT = 'history_bench'
+
+
+def create_arg_parser():
+    """Парсер аргументов командной строки."""
+    parser = argparse.ArgumentParser(description='Скорость отрисовки истории переписки')
+    parser.add_argument('-n', '--messages', default=100000, type=int, help='сообщений в истории')
+    parser.add_argument('-b', '--burst', default=1000, type=int, help='новых сообщений подряд')
+    parser.add_argument('-p', '--pages', default=50, type=int, help='страниц прокрутки к старым сообщениям')
+    return parser.parse_args(sys.argv[1:])
+
+
+def fill_history(database, count):
+    """Функция создания истории переписки заданной длинны."""
+    exists = database.session.query(database.MessageHistory).filter_by(contact=CONTACT).count()
+    start = datetime.datetime.now() - datetime.timedelta(seconds=count)
+    database.session.bulk_insert_mappings(database.MessageHistory, [
+        {'contact': CONTACT, 'direction': 'in' if number % 2 else 'out',
+         'message': f'Сообщение {number} ' + 'текст ' * (number % 40),
+         'date': start + datetime.timedelta(seconds=number)} for number in range(exists, count)])
+    database.session.commit()
+
+
+def legacy_update(model, database):
+    """Прежнее обновление: модель перестраивается из последних 20 сообщений."""
+    model.clear()
+    for _, direction, message, date in database.get_history_page(CONTACT):
+        item = QStandardItem(f'Входящее от {date.replace(microsecond=0)}:\n {message}')
+        item.setEditable(False)
+        item.setBackground(QBrush(QColor(255, 213, 213) if direction == 'in' else QColor(204, 255, 204)))
+        item.setTextAlignment(Qt.AlignLeft if direction == 'in' else Qt.AlignRight)
+        model.appendRow(item)
+
+
+def create_view():
+    """Функция создания списка сообщений с размерами как в главном окне."""
+    view = QListView()
+    view.resize(441, 301)
+    view.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+    view.setWordWrap(True)
+    view.show()
+    return view
+
+
+def timed(function):
+    """Функция возвращающая время выполнения в мс."""
+    start = time.perf_counter()
+    function()
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    """Основная функция замера."""
+    namespace = create_arg_parser()
+    application = QApplication(sys.argv)
+    database = ClientDatabase('history_bench')
+    fill_history(database, namespace.messages)
+
+    view = create_view()
+    view.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+    model = HistoryModel(database)
+    view.setModel(model)
+    view.setItemDelegate(MessageDelegate(view))
+
+    def open_chat():
+        model.set_contact(CONTACT)
+        view.scrollToBottom()
+        application.processEvents()
+        view.grab()
+    print(f'Открытие чата из {namespace.messages} сообщений: {timed(open_chat):.1f} мс')
+    print(f'Отрисовка кадра: {timed(view.grab):.2f} мс')
+
+    def burst():
+        for number in range(namespace.burst):
+            model.append('in', f'Новое сообщение {number}', trim=True)
+            view.scrollToBottom()
+            application.processEvents()
+            view.viewport().repaint()
+    elapsed = timed(burst)
+    print(f'Новые сообщения: {elapsed / namespace.burst:.2f} мс на сообщение '
+          f'({namespace.burst * 1000 / elapsed:.0f} сообщ./с)')
+
+    def scroll_back():
+        for _ in range(namespace.pages):
+            count = model.fetch_older()
+            view.scrollTo(model.index(count, 0), QAbstractItemView.PositionAtTop)
+            application.processEvents()
+            view.viewport().repaint()
+    elapsed = timed(scroll_back)
+    print(f'Прокрутка к старым: {elapsed / namespace.pages:.2f} мс на страницу, '
+          f'загружено {model.rowCount()} сообщений')
+
+    legacy_view = create_view()
+    legacy_model = QStandardItemModel()
+    legacy_view.setModel(legacy_model)
+
+    def legacy_burst():
+        for number in range(namespace.burst):
+            legacy_update(legacy_model, database)
+            legacy_view.scrollToBottom()
+            application.processEvents()
+            legacy_view.viewport().repaint()
+    elapsed = timed(legacy_burst)
+    print(f'Прежний способ: {elapsed / namespace.burst:.2f} мс на сообщение '
+          f'({namespace.burst * 1000 / elapsed:.0f} сообщ./с)')
+
+
+if __name__ == '__main__':
+    main()
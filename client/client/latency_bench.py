@@ -0,0 +1,93 @@
+"""
+Замер задержки доставки сообщений между двумя клиентами без графической оболочки.
+Оба пользователя должны быть зарегистрированы на сервере.
+
+Пример: python latency_bench.py 127.0.0.1 7777 -s user1 -sp 123 -r user2 -rp 123 -c 500
+"""
+
+import sys
+import argparse
+import logging
+import threading
+import time
+from Crypto.PublicKey import RSA
+from PyQt5.QtCore import Qt
+
+import log.client_log_config
+from common.variables import DEFAULT_IP_ADDRESS, DEFAULT_PORT, MESSAGE_TEXT
+from client.database import ClientDatabase
+from client.transport import ClientTransport
+
+
+def create_arg_parser():
+    """Парсер аргументов командной строки."""
+    parser = argparse.ArgumentParser(description='Задержка доставки сообщений между двумя клиентами')
+    parser.add_argument('addr', default=DEFAULT_IP_ADDRESS, nargs='?')
+    parser.add_argument('port', default=DEFAULT_PORT, type=int, nargs='?')
+    parser.add_argument('-s', '--sender', required=True, help='имя отправителя')
+    parser.add_argument('-sp', '--sender-password', required=True)
+    parser.add_argument('-r', '--receiver', required=True, help='имя получателя')
+    parser.add_argument('-rp', '--receiver-password', required=True)
+    parser.add_argument('-c', '--count', default=200, type=int, help='количество сообщений')
+    parser.add_argument('-i', '--interval', default=0.01, type=float, help='пауза между сообщениями, сек.')
+    return parser.parse_args(sys.argv[1:])
+
+
+def percentile(values, percent):
+    """Функция возвращающая перцентиль отсортированного списка."""
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def main():
+    """
+    Основная функция замера. Отправитель посылает сообщения с номером,
+    получатель фиксирует время их прихода по сигналу new_message.
+    Задержка - время от вызова отправки до сигнала у получателя.
+    """
+    namespace = create_arg_parser()
+    # Сообщение проходит только уровень транспорта, шифрование не замеряется
+    logging.getLogger('client').setLevel(logging.WARNING)
+    keys = RSA.generate(2048)
+    # Отображения базы создаются один раз на процесс, поэтому база у клиентов общая
+    database = ClientDatabase('latency_bench')
+
+    sent = dict()
+    received = dict()
+    done = threading.Event()
+
+    def on_message(message):
+        number = int(message[MESSAGE_TEXT])
+        received[number] = time.perf_counter()
+        if len(received) == namespace.count:
+            done.set()
+
+    sender = ClientTransport(namespace.port, namespace.addr, database,
+                             namespace.sender, namespace.sender_password, keys)
+    receiver = ClientTransport(namespace.port, namespace.addr, database,
+                               namespace.receiver, namespace.receiver_password, keys)
+    # Цикла событий Qt нет, поэтому сигнал обрабатывается прямо в потоке чтения
+    receiver.new_message.connect(on_message, Qt.DirectConnection)
+    for transport in (sender, receiver):
+        transport.daemon = True
+        transport.start()
+        transport.start_delivery()
+
+    for number in range(namespace.count):
+        sent[number] = time.perf_counter()
+        sender.send_message(namespace.receiver, str(number))
+        time.sleep(namespace.interval)
+    done.wait(10)
+
+    for transport in (sender, receiver):
+        transport.transport_shutdown()
+        transport.join()
+
+    latency = sorted((received[number] - sent[number]) * 1000 for number in received)
+    print(f'Доставлено сообщений: {len(latency)} из {namespace.count}')
+    if latency:
+        print(f'Задержка, мс: p50 {percentile(latency, 50):.2f}, p95 {percentile(latency, 95):.2f}, '
+              f'p99 {percentile(latency, 99):.2f}, макс. {latency[-1]:.2f}')
+
+
+if __name__ == '__main__':
+    main()
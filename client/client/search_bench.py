@@ -0,0 +1,93 @@
+"""
+Замер полнотекстового поиска по истории сообщений: первая страница
+результатов для редкого и частого слова и начала слова, а также
+дальние страницы результатов. Последнее слово запроса ищется по началу.
+Для сравнения замеряется поиск через LIKE.
+
+Пример: python search_bench.py -n 1000000 -r 20
+"""
+
+import sys
+import argparse
+import datetime
+import random
+import time
+
+from sqlalchemy import text
+
+from client.database import ClientDatabase
+
+# Собеседники, история переписки с которыми создаётся для замера
+CONTACTS = [f'search_bench_{number}' for number in range(20)]
+# Слова сообщений: первые встречаются часто, последние - редко
+WORDS = ['привет', 'как', 'дела', 'встреча', 'завтра', 'сегодня', 'вечером', 'отчёт',
+         'проект', 'сервер', 'клиент', 'ключ', 'база', 'поиск', 'история', 'сообщение',
+         'договор', 'оплата', 'отпуск', 'презентация', 'релиз', 'тестирование']
+
+
+def create_arg_parser():
+    """Парсер аргументов командной строки."""
+    parser = argparse.ArgumentParser(description='Скорость поиска по истории сообщений')
+    parser.add_argument('-n', '--messages', default=1000000, type=int, help='сообщений в истории')
+    parser.add_argument('-r', '--repeat', default=20, type=int, help='повторов каждого запроса')
+    return parser.parse_args(sys.argv[1:])
+
+
+def fill_history(database, count):
+    """
+    Функция создания истории переписки заданной длинны.
+    Полнотекстовый индекс заполняется триггерами при вставке.
+    """
+    exists = database.session.query(database.MessageHistory).count()
+    start = datetime.datetime.now() - datetime.timedelta(seconds=count)
+    generator = random.Random(exists)
+    weights = [1 / (rank + 1) for rank in range(len(WORDS))]
+    for first in range(exists, count, 100000):
+        database.session.bulk_insert_mappings(database.MessageHistory, [
+            {'contact': CONTACTS[number % len(CONTACTS)], 'direction': 'in' if number % 2 else 'out',
+             'message': ' '.join(generator.choices(WORDS, weights, k=8)) + f' код{number}',
+             'date': start + datetime.timedelta(seconds=number)}
+            for number in range(first, min(first + 100000, count))])
+        database.session.commit()
+
+
+def timed(function, repeat):
+    """Функция возвращающая среднее время выполнения в мс."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def main():
+    """Основная функция замера."""
+    namespace = create_arg_parser()
+    database = ClientDatabase('search_bench')
+    fill_history(database, namespace.messages)
+    middle = namespace.messages // 2
+
+    queries = [
+        ('редкое слово', f'код{middle}', None, 0),
+        ('префикс', f'код{middle // 100}', None, 0),
+        ('частое слово по началу', WORDS[0], None, 0),
+        ('два частых слова', f'{WORDS[0]} {WORDS[1]}', None, 0),
+        ('слово в переписке', WORDS[-1], CONTACTS[0], 0),
+        ('частое слово по началу, 50-я страница', WORDS[0], None, 1000),
+    ]
+    for title, search, contact, offset in queries:
+        found = []
+
+        def search_page():
+            found[:] = database.search_messages(search, contact, offset)[0]
+        elapsed = timed(search_page, namespace.repeat)
+        print(f'{title} ({search}): {elapsed:.2f} мс, найдено на странице {len(found)}')
+
+    def like_search():
+        database.session.execute(text(
+            'SELECT id FROM message_history WHERE message LIKE :pattern ORDER BY date DESC LIMIT 21'),
+            {'pattern': f'%код{middle}%'}).fetchall()
+    print(f'Прежний способ, LIKE (код{middle}): {timed(like_search, 1):.2f} мс')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,38 +2,133 @@
 
 import json
 import sys
-from common.variables import ENCODING, MAX_PACKAGE_LENGTH
+import struct
+from collections import deque
+from common.variables import ENCODING, MAX_PACKAGE_LENGTH, RECV_BUFFER_SIZE, MAX_FRAME_LENGTH
 from common.decorators import log
+from common.errors import IncorrectDataRecivedError
 sys.path.append('../')
 
+# Заголовок кадра: длинна сообщения в байтах, 4 байта big-endian
+FRAME_HEADER = struct.Struct('!I')
+
+
+def decode_message(encoded_message):
+    """
+    Функция декодирования сообщения.
+    Декодирует байты JSON и проверяет что получен словарь.
+    :param encoded_message: байты сообщения.
+    :return: словарь - сообщение.
+    """
+    response = json.loads(encoded_message.decode(ENCODING))
+    if isinstance(response, dict):
+        return response
+    else:
+        raise TypeError
+
+
+def encode_message(message, framed=False):
+    """
+    Функция кодирования сообщения.
+    Кодирует словарь в формат JSON, в потоковом режиме
+    добавляет заголовок с длинной сообщения.
+    :param message: словарь для передачи
+    :param framed: признак потокового (кадрового) режима
+    :return: байты для отправки в сокет
+    """
+    encoded_message = json.dumps(message).encode(ENCODING)
+    if framed:
+        return FRAME_HEADER.pack(len(encoded_message)) + encoded_message
+    return encoded_message
+
+
+class MessageDecoder:
+    """
+    Класс - инкрементальный декодер сообщений одного соединения.
+    В потоковом режиме накапливает принятые байты в буфере и выделяет из него
+    кадры с заголовком длинны: сообщение может прийти по частям за несколько
+    чтений, а одно чтение может содержать несколько сообщений.
+    В старом режиме (без кадров) каждое чтение из сокета - одно сообщение.
+    """
+
+    def __init__(self, framed=False):
+        self.framed = framed
+        # Буфер принятых, но ещё не разобранных байтов
+        self.buffer = bytearray()
+        # Очередь полностью принятых сообщений
+        self.messages = deque()
+
+    @property
+    def recv_size(self):
+        """Размер буфера для чтения из сокета в текущем режиме."""
+        return RECV_BUFFER_SIZE if self.framed else MAX_PACKAGE_LENGTH
+
+    def decode(self, data):
+        """Метод разбирающий очередную порцию принятых байтов."""
+        if not self.framed:
+            self.messages.append(decode_message(data))
+            return
+        self.buffer += data
+        position = 0
+        while len(self.buffer) - position >= FRAME_HEADER.size:
+            length, = FRAME_HEADER.unpack_from(self.buffer, position)
+            if length > MAX_FRAME_LENGTH:
+                raise IncorrectDataRecivedError
+            end = position + FRAME_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            self.messages.append(decode_message(bytes(self.buffer[position + FRAME_HEADER.size:end])))
+            position = end
+        del self.buffer[:position]
+
+    def feed(self, data):
+        """
+        Метод добавляющий принятые байты в буфер.
+        Возвращает список полностью принятых сообщений (возможно пустой).
+        """
+        self.decode(data)
+        messages = list(self.messages)
+        self.messages.clear()
+        return messages
+
+    def read_message(self, sock):
+        """
+        Метод блокирующего чтения одного сообщения из сокета.
+        Читает из сокета до тех пор, пока не будет принято сообщение целиком.
+        """
+        while not self.messages:
+            data = sock.recv(self.recv_size)
+            if not data:
+                raise ConnectionResetError
+            self.decode(data)
+        return self.messages.popleft()
+
 
 @log
-def get_message(client):
+def get_message(client, decoder=None):
     """
     Функция приёма и декодирования сообщения.
     Принимает сообщения JSON, декодирует полученное сообщение
     и проверяет что получен словарь.
     :param client: сокет для передачи данных.
+    :param decoder: декодер соединения (MessageDecoder), если не указан -
+    одно чтение из сокета считается одним сообщением.
     :return: словарь - сообщение.
     """
+    if decoder is not None:
+        return decoder.read_message(client)
     encoded_response = client.recv(MAX_PACKAGE_LENGTH)
-    json_response = encoded_response.decode(ENCODING)
-    response = json.loads(json_response)
-    if isinstance(response, dict):
-        return response
-    else:
-        raise TypeError
+    return decode_message(encoded_response)
 
 
 @log
-def send_message(sock, message):
+def send_message(sock, message, framed=False):
     """
     Функция кодирования и отправки сообщения.
     Кодирует словарь в формат JSON и отправляет через сокет.
     :param sock: сокет для передачи
     :param message: словарь для передачи
+    :param framed: отправить сообщение кадром с заголовком длинны
     :return: ничего не возвращает
     """
-    js_message = json.dumps(message)
-    encoded_message = js_message.encode(ENCODING)
-    sock.send(encoded_message)
+    sock.sendall(encode_message(message, framed))
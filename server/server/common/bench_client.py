@@ -0,0 +1,110 @@
+"""
+Вспомогательные средства замеров сервера: запуск сервера с отдельной
+базой и клиент протокола JIM без графической оболочки и шифрования.
+"""
+
+import os
+import time
+import socket
+import hmac
+import hashlib
+import binascii
+
+from common.utils import encode_message, MessageDecoder
+from common.variables import ACTION, PRESENCE, TIME, USER, ACCOUNT_NAME, PUBLIC_KEY, RESPONSE, DATA, \
+    FRAMING, FRAMING_LENGTH_PREFIX, MESSAGE, SENDER, DESTINATION, MESSAGE_TEXT, EXIT, RECV_BUFFER_SIZE
+from server.core import Server
+from server.async_core import AsyncServer
+from server.server_database import ServerDatabase
+
+# Пароль пользователей, создаваемых для замеров
+BENCH_PASSWORD = '123'
+
+
+def password_hash(name, password=BENCH_PASSWORD):
+    """Функция вычисления хэша пароля так же, как при регистрации пользователя."""
+    return binascii.hexlify(hashlib.pbkdf2_hmac(
+        'sha512', password.encode('utf-8'), name.lower().encode('utf-8'), 10000))
+
+
+def create_database(path, users):
+    """Функция создания новой базы сервера с заданными пользователями."""
+    for file in (path, path + '-wal', path + '-shm'):
+        if os.path.exists(file):
+            os.remove(file)
+    database = ServerDatabase(path)
+    for name in users:
+        database.add_user(name, password_hash(name))
+    return database
+
+
+def free_port():
+    """Функция возвращающая свободный порт для сервера."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(engine, database, **kwargs):
+    """Функция запуска сервера в отдельном потоке. Возвращает (сервер, порт)."""
+    port = free_port()
+    server_class = AsyncServer if engine == 'asyncio' else Server
+    server = server_class('127.0.0.1', port, database, **kwargs)
+    server.daemon = True
+    server.start()
+    time.sleep(0.5)
+    return server, port
+
+
+def percentile(values, percent):
+    """Функция возвращающая перцентиль отсортированного списка."""
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class BenchClient:
+    """
+    Класс - клиент для замеров. Подключается и авторизуется в конструкторе,
+    сообщения отправляет без шифрования, ответы читает блокирующе.
+    """
+
+    def __init__(self, port, name, password=BENCH_PASSWORD, key=None, address='127.0.0.1'):
+        self.name = name
+        self.sock = socket.create_connection((address, port))
+        self.sock.settimeout(10)
+        self.decoder = MessageDecoder()
+        self.send({ACTION: PRESENCE, TIME: time.time(), FRAMING: FRAMING_LENGTH_PREFIX,
+                   USER: {ACCOUNT_NAME: name, PUBLIC_KEY: key or f'bench key {name}'}})
+        answer = self.recv()
+        if answer.get(RESPONSE) != 511:
+            raise ConnectionRefusedError(answer)
+        self.decoder.framed = answer.get(FRAMING) == FRAMING_LENGTH_PREFIX
+        digest = hmac.new(password_hash(name, password), answer[DATA].encode('ascii'), 'MD5').digest()
+        self.send({RESPONSE: 511, DATA: binascii.b2a_base64(digest).decode('ascii')})
+        answer = self.recv()
+        if answer.get(RESPONSE) != 200:
+            raise ConnectionRefusedError(answer)
+
+    def send(self, message):
+        """Метод отправки сообщения серверу."""
+        self.sock.sendall(encode_message(message, self.decoder.framed))
+
+    def recv(self):
+        """Метод ожидания следующего сообщения сервера."""
+        return self.decoder.read_message(self.sock)
+
+    def message(self, to, text):
+        """Метод отправки сообщения пользователю, ответ сервера не читается."""
+        self.send({ACTION: MESSAGE, SENDER: self.name, DESTINATION: to, TIME: time.time(), MESSAGE_TEXT: text})
+
+    def close(self):
+        """
+        Метод корректного выхода. Ждёт, пока сервер закроет соединение,
+        чтобы следующий вход под тем же именем не застал прежний сеанс.
+        """
+        try:
+            self.send({ACTION: EXIT, TIME: time.time(), ACCOUNT_NAME: self.name})
+            while self.sock.recv(RECV_BUFFER_SIZE):
+                pass
+        except OSError:
+            pass
+        self.sock.close()
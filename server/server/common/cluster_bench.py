@@ -0,0 +1,91 @@
+"""
+Замер многопроцессного режима сервера: пары клиентов обмениваются
+сообщениями, клиенты распределяются между процессами-обработчиками
+системой, поэтому часть сообщений пересылается через маршрутизатор.
+Выводит распределение клиентов по процессам, скорость и задержку доставки.
+
+Пример: python cluster_bench.py -w 2 --engine select -p 8 -n 200
+"""
+
+import sys
+import os
+import argparse
+import logging
+import threading
+import time
+from collections import Counter
+
+# Пакеты сервера лежат рядом со скриптом, пакет common - уровнем выше
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import log.server_log_config
+from common.variables import MESSAGE_TEXT
+from server.cluster import Supervisor
+from server.mailbox import Mailbox
+from bench_client import BenchClient, create_database, free_port, percentile
+
+
+def create_arg_parser():
+    """Парсер аргументов командной строки."""
+    parser = argparse.ArgumentParser(description='Доставка сообщений в многопроцессном режиме')
+    parser.add_argument('-w', '--workers', default=2, type=int, help='процессов-обработчиков')
+    parser.add_argument('--engine', default='select', choices=('select', 'asyncio'))
+    parser.add_argument('-p', '--pairs', default=8, type=int, help='пар клиентов')
+    parser.add_argument('-n', '--messages', default=200, type=int, help='сообщений от каждой пары')
+    parser.add_argument('--db', default='cluster_bench.db3', help='файл базы, создаётся заново')
+    return parser.parse_args(sys.argv[1:])
+
+
+def main():
+    """Основная функция замера."""
+    namespace = create_arg_parser()
+    logging.getLogger('server').setLevel(logging.WARNING)
+    users = [f'cluster_{number}' for number in range(namespace.pairs * 2)]
+    create_database(namespace.db, users)
+    port = free_port()
+    supervisor = Supervisor(namespace.workers, namespace.engine, '127.0.0.1', port, namespace.db,
+                            Mailbox(namespace.db + '.mailbox'))
+    supervisor.start()
+    # Процессы запускаются заново, а не копируются, это занимает время
+    deadline = time.monotonic() + 30
+    while len(supervisor.router.workers) < namespace.workers and time.monotonic() < deadline:
+        time.sleep(0.1)
+    time.sleep(0.5)
+
+    clients = [BenchClient(port, name) for name in users]
+    time.sleep(0.3)
+    presence = dict(supervisor.router.presence)
+    print('Клиентов в процессах:', dict(sorted(Counter(presence.values()).items())))
+    pairs = [(clients[number], clients[number + namespace.pairs]) for number in range(namespace.pairs)]
+    crossing = sum(presence.get(sender.name) != presence.get(receiver.name) for sender, receiver in pairs)
+    print(f'Пар в разных процессах: {crossing} из {namespace.pairs}')
+
+    latency = []
+
+    def exchange(sender, receiver):
+        for number in range(namespace.messages):
+            sent = time.perf_counter()
+            sender.message(receiver.name, str(number))
+            sender.recv()
+            message = receiver.recv()
+            latency.append((time.perf_counter() - sent) * 1000)
+            assert message[MESSAGE_TEXT] == str(number), message
+
+    threads = [threading.Thread(target=exchange, args=pair) for pair in pairs]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        client.close()
+    supervisor.stop()
+
+    latency.sort()
+    print(f'{namespace.engine}, процессов {namespace.workers}: {len(latency) / elapsed:.0f} сообщений/с, '
+          f'задержка, мс: p50 {percentile(latency, 50):.2f}, p99 {percentile(latency, 99):.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Замер выбора обработчика сообщения клиента: таблица действий сервера
+в сравнении с прежней цепочкой проверок if/elif. Обработчики пустые,
+замеряется только выбор и проверка полей сообщения.
+
+Пример: python dispatch_bench.py -n 500000 -r 5
+"""
+
+import sys
+import os
+import argparse
+import timeit
+
+# Пакеты сервера лежат рядом со скриптом, пакет common - уровнем выше
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common.variables import ACTION, PRESENCE, TIME, USER, ACCOUNT_NAME, MESSAGE, DESTINATION, SENDER, \
+    MESSAGE_TEXT, EXIT, GET_CONTACTS, ADD_CONTACT, REMOVE_CONTACT, USERS_REQUEST, PUBLIC_KEY_REQUEST
+from server.core import Server
+from server.dispatch import ActionRegistry
+
+# Имя пользователя, авторизованного на сокете, и сам сокет
+USERNAME = 'alice'
+CLIENT = object()
+NAMES = {USERNAME: CLIENT}
+
+
+def create_arg_parser():
+    """Парсер аргументов командной строки."""
+    parser = argparse.ArgumentParser(description='Скорость выбора обработчика сообщения')
+    parser.add_argument('-n', '--number', default=500000, type=int, help='выборов в одном замере')
+    parser.add_argument('-r', '--repeat', default=5, type=int, help='замеров, берётся лучший')
+    return parser.parse_args(sys.argv[1:])
+
+
+def handler(message, client):
+    """Пустой обработчик действия."""
+    return True
+
+
+class BenchActions:
+    """Класс - таблица действий, заполненная так же, как у сервера, но с пустыми обработчиками."""
+    register_action = Server.register_action
+
+    def __init__(self):
+        self.actions = ActionRegistry()
+        Server.register_actions(self)
+
+    def __getattr__(self, name):
+        return handler
+
+    def dispatch(self, message, client):
+        """Метод выбора и вызова обработчика по таблице."""
+        found = self.actions.resolve(message, USERNAME)
+        return found(message, client) if found else False
+
+
+def chain_dispatch(message, client):
+    """Функция выбора обработчика прежней цепочкой проверок."""
+    if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
+        return handler(message, client)
+    elif ACTION in message and message[ACTION] == MESSAGE and DESTINATION in message and TIME in message \
+            and SENDER in message and MESSAGE_TEXT in message and NAMES[message[SENDER]] == client:
+        return handler(message, client)
+    elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message \
+            and NAMES[message[ACCOUNT_NAME]] == client:
+        return handler(message, client)
+    elif ACTION in message and message[ACTION] == GET_CONTACTS and USER in message \
+            and NAMES[message[USER]] == client:
+        return handler(message, client)
+    elif ACTION in message and message[ACTION] == ADD_CONTACT and ACCOUNT_NAME in message and USER in message \
+            and NAMES[message[USER]] == client:
+        return handler(message, client)
+    elif ACTION in message and message[ACTION] == REMOVE_CONTACT and ACCOUNT_NAME in message and USER in message \
+            and NAMES[message[USER]] == client:
+        return handler(message, client)
+    elif ACTION in message and message[ACTION] == USERS_REQUEST and ACCOUNT_NAME in message \
+            and NAMES[message[ACCOUNT_NAME]] == client:
+        return handler(message, client)
+    elif ACTION in message and message[ACTION] == PUBLIC_KEY_REQUEST and ACCOUNT_NAME in message:
+        return handler(message, client)
+    return False
+
+
+def main():
+    """Основная функция замера."""
+    namespace = create_arg_parser()
+    table = BenchActions()
+    messages = {
+        'message': {ACTION: MESSAGE, TIME: 1, DESTINATION: 'bob', SENDER: USERNAME, MESSAGE_TEXT: 'x'},
+        'users_request': {ACTION: USERS_REQUEST, TIME: 1, ACCOUNT_NAME: USERNAME},
+        'public_key_need': {ACTION: PUBLIC_KEY_REQUEST, TIME: 1, ACCOUNT_NAME: 'bob'},
+        'bad request': {ACTION: 'unknown', TIME: 1},
+    }
+    for title, message in messages.items():
+        results = []
+        for function in (chain_dispatch, table.dispatch):
+            best = min(timeit.repeat(lambda: function(message, CLIENT),
+                                     number=namespace.number, repeat=namespace.repeat))
+            results.append(best / namespace.number * 1e9)
+        print(f'{title:16} цепочка {results[0]:6.0f} нс   таблица {results[1]:6.0f} нс')
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,12 @@ class IncorrectDataRecivedError(Exception):
         return 'Принято некорректное сообщение от удалённого компьютера.'
 
 
+class SlowConsumerError(ConnectionError):
+    """Исключение - получатель не успевает принимать данные, очередь отправки переполнена"""
+    def __str__(self):
+        return 'Очередь отправки клиента переполнена.'
+
+
 class ServerError(Exception):
     """
     Исключение - ошибка сервера
@@ -0,0 +1,133 @@
+"""
+Замер запросов базы сервера до и после миграций схемы, добавляющих индексы.
+Создаётся база без индексов миграций, заполняется пользователями, контактами
+и историей входов, затем замеряются запросы, выполняются миграции
+(их время тоже выводится) и запросы замеряются снова.
+
+Пример: python index_bench.py -u 100000 -c 1000000 -l 10000000
+"""
+
+import sys
+import os
+import re
+import argparse
+import random
+import sqlite3
+import time
+
+# Пакеты сервера лежат рядом со скриптом, пакет common - уровнем выше
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import create_engine
+
+from server.server_database import ServerDatabase
+from server.migrations import MIGRATIONS, migrate
+
+# Замеряемые запросы и генераторы их параметров (случайное число, пользователей)
+QUERIES = (
+    ('get_contacts', 'SELECT Users.name FROM Contacts JOIN Users ON Contacts.contact = Users.id '
+                     'WHERE Contacts.user = ?',
+     lambda generator, users: (generator.randint(1, users),)),
+    ('add_contact dup check', 'SELECT count(*) FROM Contacts WHERE user = ? AND contact = ?',
+     lambda generator, users: (generator.randint(1, users), generator.randint(1, users))),
+    ('counters update', 'UPDATE History SET send = send + 1 WHERE user = (SELECT id FROM Users WHERE name = ?)',
+     lambda generator, users: (f'user{generator.randint(1, users)}',)),
+    ('login_history(user)', 'SELECT Users.name, date_time, ip, port FROM Login_history '
+                            'JOIN Users ON Users.id = Login_history.name WHERE Users.name = ?',
+     lambda generator, users: (f'user{generator.randint(1, users)}',)),
+    ('delete by contact', 'DELETE FROM Contacts WHERE contact = ?',
+     lambda generator, users: (generator.randint(1, users),)),
+)
+
+
+def create_arg_parser():
+    """Парсер аргументов командной строки."""
+    parser = argparse.ArgumentParser(description='Запросы базы сервера до и после миграций с индексами')
+    parser.add_argument('-u', '--users', default=100000, type=int, help='пользователей')
+    parser.add_argument('-c', '--contacts', default=1000000, type=int, help='записей контактов')
+    parser.add_argument('-l', '--logins', default=10000000, type=int, help='записей истории входов')
+    parser.add_argument('-r', '--repeat', default=200, type=int, help='повторов запроса после миграций')
+    parser.add_argument('--db', default='index_bench.db3', help='файл базы, создаётся заново')
+    return parser.parse_args(sys.argv[1:])
+
+
+def create_unindexed(path):
+    """
+    Функция создания базы в состоянии до миграций: таблицы создаются
+    сервером, индексы миграций удаляются, версия схемы сбрасывается.
+    """
+    for file in (path, path + '-wal', path + '-shm'):
+        if os.path.exists(file):
+            os.remove(file)
+    ServerDatabase(path).close()
+    connection = sqlite3.connect(path)
+    for _, _, statements in MIGRATIONS:
+        for statement in statements:
+            index = re.search(r'INDEX IF NOT EXISTS (\w+)', statement)
+            if index:
+                connection.execute(f'DROP INDEX IF EXISTS {index.group(1)}')
+    connection.execute('DELETE FROM Schema_version')
+    connection.commit()
+    return connection
+
+
+def fill(connection, namespace):
+    """Функция заполнения базы случайными контактами и историей входов."""
+    generator = random.Random(1)
+    users = namespace.users
+    connection.execute('PRAGMA synchronous=OFF')
+    connection.executemany('INSERT INTO Users (id, name, passwd_hash) VALUES (?, ?, ?)',
+                           ((number, f'user{number}', 'hash') for number in range(1, users + 1)))
+    connection.executemany('INSERT INTO History (user, send, accepted) VALUES (?, 0, 0)',
+                           ((number,) for number in range(1, users + 1)))
+    connection.executemany('INSERT INTO Contacts (user, contact) VALUES (?, ?)',
+                           ((generator.randint(1, users), generator.randint(1, users))
+                            for _ in range(namespace.contacts)))
+    connection.executemany('INSERT INTO Login_history (name, date_time, ip, port) VALUES (?, ?, ?, ?)',
+                           ((generator.randint(1, users), '2026-01-01 00:00:00', '127.0.0.1', 7777)
+                            for _ in range(namespace.logins)))
+    connection.commit()
+
+
+def measure(path, users, repeat):
+    """
+    Функция замера запросов. Возвращает среднее время каждого запроса в мс.
+    Изменения откатываются, чтобы замеры до и после миграций были сравнимы.
+    """
+    connection = sqlite3.connect(path)
+    generator = random.Random(2)
+    results = []
+    for _, query, arguments in QUERIES:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            connection.execute(query, arguments(generator, users)).fetchall()
+        connection.rollback()
+        results.append((time.perf_counter() - start) * 1000 / repeat)
+    connection.close()
+    return results
+
+
+def main():
+    """Основная функция замера."""
+    namespace = create_arg_parser()
+    connection = create_unindexed(namespace.db)
+    start = time.perf_counter()
+    fill(connection, namespace)
+    connection.close()
+    print(f'База заполнена за {time.perf_counter() - start:.0f} с, '
+          f'{os.path.getsize(namespace.db) >> 20} МиБ')
+
+    # Без индексов запросы просматривают таблицы целиком, хватает нескольких повторов
+    before = measure(namespace.db, namespace.users, 3)
+    start = time.perf_counter()
+    applied = migrate(create_engine(f'sqlite:///{namespace.db}'))
+    print(f'Миграции {applied} выполнены за {time.perf_counter() - start:.1f} с')
+    after = measure(namespace.db, namespace.users, namespace.repeat)
+
+    print(f'{"запрос":24}{"до, мс":>12}{"после, мс":>12}')
+    for (title, _, _), old, new in zip(QUERIES, before, after):
+        print(f'{title:24}{old:12.3f}{new:12.3f}')
+
+
+if __name__ == '__main__':
+    main()
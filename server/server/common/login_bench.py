@@ -0,0 +1,96 @@
+"""
+Замер скорости авторизации: клиенты входят и выходят в цикле, ещё один
+клиент периодически подключается и не отвечает на запрос авторизации.
+Одновременно пара клиентов обменивается сообщениями - выводится
+количество входов в секунду и задержка сообщений.
+
+Пример: python login_bench.py --engine asyncio -c 20 -s 0.2 -t 5
+"""
+
+import sys
+import os
+import argparse
+import logging
+import threading
+import time
+import socket
+
+# Пакеты сервера лежат рядом со скриптом, пакет common - уровнем выше
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import log.server_log_config
+from common.utils import encode_message
+from common.variables import ACTION, PRESENCE, TIME, USER, ACCOUNT_NAME, PUBLIC_KEY
+from bench_client import BenchClient, create_database, start_server, percentile
+
+
+def create_arg_parser():
+    """Парсер аргументов командной строки."""
+    parser = argparse.ArgumentParser(description='Скорость авторизации при зависающих клиентах')
+    parser.add_argument('--engine', default='select', choices=('select', 'asyncio'))
+    parser.add_argument('-c', '--clients', default=20, type=int, help='клиентов, входящих в цикле')
+    parser.add_argument('-s', '--stall', default=0.2, type=float,
+                        help='пауза между подключениями, не отвечающими на авторизацию, сек.')
+    parser.add_argument('--handshake-timeout', default=2, type=float, help='время на авторизацию, сек.')
+    parser.add_argument('-t', '--time', default=5, type=float, help='длительность, сек.')
+    parser.add_argument('--db', default='login_bench.db3', help='файл базы, создаётся заново')
+    return parser.parse_args(sys.argv[1:])
+
+
+def main():
+    """Основная функция замера."""
+    namespace = create_arg_parser()
+    logging.getLogger('server').setLevel(logging.WARNING)
+    users = [f'login_{number}' for number in range(namespace.clients)]
+    database = create_database(namespace.db, ['login_a', 'login_b'] + users)
+    server, port = start_server(namespace.engine, database, handshake_timeout=namespace.handshake_timeout)
+    sender = BenchClient(port, 'login_a')
+    receiver = BenchClient(port, 'login_b')
+
+    running = True
+    logins = [0]
+    stalled = []
+
+    def churn(name):
+        while running:
+            BenchClient(port, name).close()
+            logins[0] += 1
+
+    def stall():
+        # Запрос авторизации без ответа на него
+        while running:
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.sendall(encode_message({ACTION: PRESENCE, TIME: time.time(),
+                                         USER: {ACCOUNT_NAME: users[0], PUBLIC_KEY: 'bench key'}}))
+            stalled.append(sock)
+            time.sleep(namespace.stall)
+
+    threads = [threading.Thread(target=churn, args=(name,), daemon=True) for name in users]
+    threads.append(threading.Thread(target=stall, daemon=True))
+    for thread in threads:
+        thread.start()
+
+    latency = []
+    start = time.monotonic()
+    while time.monotonic() - start < namespace.time:
+        sent = time.perf_counter()
+        sender.message('login_b', 'x')
+        receiver.recv()
+        sender.recv()
+        latency.append((time.perf_counter() - sent) * 1000)
+    running = False
+    elapsed = time.monotonic() - start
+    for thread in threads:
+        thread.join(3)
+    for sock in stalled:
+        sock.close()
+    server.stop()
+
+    latency.sort()
+    print(f'Входов в секунду: {logins[0] / elapsed:.0f}, зависших подключений: {len(stalled)}')
+    print(f'Сообщений: {len(latency)}, задержка, мс: p50 {percentile(latency, 50):.2f}, '
+          f'p99 {percentile(latency, 99):.2f}')
+
+
+if __name__ == '__main__':
+    main()
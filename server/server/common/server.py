@@ -5,9 +5,13 @@ import logging
 import argparse
 import log.server_log_config
 from common.decorators import log
-from common.variables import DEFAULT_PORT
+from common.variables import DEFAULT_PORT, OUTBOUND_LIMIT, SLOW_CONSUMER_POLICY, HANDSHAKE_TIMEOUT, \
+    MAILBOX_TTL, MAILBOX_LIMIT
 from server.core import Server
-from server.server_database import ServerDatabase
+from server.async_core import AsyncServer
+from server.server_database import ServerDatabase, LOGIN_HISTORY_RETENTION
+from server.mailbox import Mailbox
+from server.cluster import Supervisor
 from server.main_window import MainWindow
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtCore import Qt
@@ -17,7 +21,7 @@ LOGGER = logging.getLogger('server')
 
 
 @log
-def create_arg_parser(default_address, default_port):
+def create_arg_parser(default_address, default_port, default_engine, default_workers):
     """ Парсер аргументов коммандной строки """
     LOGGER.debug(
         f'Инициализация парсера аргументов коммандной строки: {sys.argv}')
@@ -30,11 +34,19 @@ def create_arg_parser(default_address, default_port):
         type=int,
         nargs='?')
     parser.add_argument('--no_gui', action='store_true')
+    parser.add_argument(
+        '--engine',
+        default=default_engine,
+        choices=('select', 'asyncio'),
+        nargs='?')
+    parser.add_argument('--workers', default=default_workers, type=int, nargs='?')
     namespace = parser.parse_args(sys.argv[1:])
     listen_address = namespace.addr
     listen_port = namespace.port
     gui_flag = namespace.no_gui
-    return listen_address, listen_port, gui_flag
+    engine = namespace.engine
+    workers = namespace.workers
+    return listen_address, listen_port, gui_flag, engine, workers
 
 
 @log
@@ -47,15 +59,30 @@ def config_load():
     config.read(f"{dir_path}/{'server.ini'}")
     # Если конфиг файл загружен правильно, запускаемся, иначе конфиг по
     # умолчанию.
-    if 'SETTINGS' in config:
-        return config
-    else:
+    if 'SETTINGS' not in config:
         config.add_section('SETTINGS')
         config.set('SETTINGS', 'Default_port', str(DEFAULT_PORT))
         config.set('SETTINGS', 'Listen_Address', '')
         config.set('SETTINGS', 'Database_path', '')
         config.set('SETTINGS', 'Database_file', 'server_base.db3')
-        return config
+    # Параметры, отсутствующие в старых файлах конфигурации, дополняем
+    # значениями по умолчанию.
+    defaults = (
+        ('Engine', 'select'),
+        ('Workers', '1'),
+        ('Outbound_limit', str(OUTBOUND_LIMIT)),
+        ('Slow_consumer_policy', SLOW_CONSUMER_POLICY),
+        ('Handshake_timeout', str(HANDSHAKE_TIMEOUT)),
+        ('Mailbox_file', 'server_mailbox.log'),
+        ('Mailbox_ttl', str(MAILBOX_TTL)),
+        ('Mailbox_limit', str(MAILBOX_LIMIT)),
+        ('Login_history_retention', str(LOGIN_HISTORY_RETENTION)),
+        ('Login_history_archive', 'login_history'),
+    )
+    for key, value in defaults:
+        if key not in config['SETTINGS']:
+            config.set('SETTINGS', key, value)
+    return config
 
 
 @log
@@ -65,15 +92,55 @@ def main():
     config = config_load()
 
     # Проверяем параметры командной строки
-    listen_address, listen_port, gui_flag = create_arg_parser(
-        config['SETTINGS']['Listen_Address'], config['SETTINGS']['Default_port'])
+    listen_address, listen_port, gui_flag, engine, workers = create_arg_parser(
+        config['SETTINGS']['Listen_Address'], config['SETTINGS']['Default_port'],
+        config['SETTINGS']['Engine'], config['SETTINGS']['Workers'])
 
-    database = ServerDatabase(os.path.join(
+    database_path = os.path.join(
         config['SETTINGS']['Database_path'],
-        config['SETTINGS']['Database_file']))
+        config['SETTINGS']['Database_file'])
+    # История входов старше срока хранения переносится в архив рядом с базой данных
+    database = ServerDatabase(
+        database_path,
+        login_retention=int(config['SETTINGS']['Login_history_retention']),
+        archive_path=os.path.join(
+            config['SETTINGS']['Database_path'], config['SETTINGS']['Login_history_archive']))
+
+    # Почтовые ящики пользователей не в сети хранятся рядом с базой данных
+    mailbox = Mailbox(
+        os.path.join(config['SETTINGS']['Database_path'], config['SETTINGS']['Mailbox_file']),
+        ttl=float(config['SETTINGS']['Mailbox_ttl']),
+        limit=int(config['SETTINGS']['Mailbox_limit']))
+
+    settings = dict(
+        outbound_limit=int(config['SETTINGS']['Outbound_limit']),
+        slow_consumer_policy=config['SETTINGS']['Slow_consumer_policy'],
+        handshake_timeout=float(config['SETTINGS']['Handshake_timeout']))
+
+    # Многопроцессный режим: несколько процессов-обработчиков на общем порту.
+    # Графический интерфейс работает с сервером своего процесса,
+    # поэтому в этом режиме доступна только консоль.
+    if workers > 1:
+        supervisor = Supervisor(
+            workers, engine, listen_address, listen_port, database_path, mailbox, **settings)
+        supervisor.start()
+        while True:
+            command = input('Введите exit для завершения работы сервера.')
+            if command == 'exit':
+                supervisor.stop()
+                break
+        database.close()
+        return
 
-    # Создание экземпляра класса - сервера и его запуск:
-    server = Server(listen_address, listen_port, database)
+    # Создание экземпляра класса - сервера и его запуск.
+    # Вариант на asyncio не опрашивает сокеты по таймауту.
+    server_class = AsyncServer if engine == 'asyncio' else Server
+    server = server_class(
+        listen_address,
+        listen_port,
+        database,
+        mailbox=mailbox,
+        **settings)
     server.daemon = True
     server.start()
 
@@ -82,7 +149,7 @@ def main():
             command = input('Введите exit для завершения работы сервера.')
             if command == 'exit':
                 # Если выход, то завршаем основной цикл сервера.
-                server.running = False
+                server.stop()
                 server.join()
                 break
     else:
@@ -93,7 +160,10 @@ def main():
         # Запуск графического интерфейса
         server_app.exec_()
         # По закрытию окон останавливаем обработчик сообщений
-        server.running = False
+        server.stop()
+        server.join()
+    # Записываем накопленную статистику сообщений
+    database.close()
 
 
 if __name__ == '__main__':
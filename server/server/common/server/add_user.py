@@ -80,8 +80,8 @@ class RegisterUser(QDialog):
                 binascii.hexlify(passwd_hash))
             self.messages.information(
                 self, 'Успех', 'Пользователь успешно зарегистрирован.')
-            # Рассылаем клиентам сообщение о необходимости обновить справичники
-            self.server.service_update_lists()
+            # Уведомляем клиентов о новом пользователе
+            self.server.notify_directory_changed()
             self.close()
 
 
@@ -0,0 +1,165 @@
+import asyncio
+import threading
+import time
+import logging
+import json
+from common.errors import IncorrectDataRecivedError
+from server.core import Server
+
+# Инициализация логгера сервера
+LOGGER = logging.getLogger('server')
+
+
+class AsyncServer(Server):
+    """
+    Сервер на основе цикла событий asyncio.
+    Приём соединений и чтение из сокетов выполняются без опроса:
+    на каждое соединение запускается отдельная сопрограмма.
+    Обработка сообщений полностью совпадает с классом Server,
+    что позволяет сравнивать оба варианта на одной нагрузке.
+    """
+
+    def __init__(self, listen_address, listen_port, database, **kwargs):
+        # Цикл событий создаётся в потоке сервера
+        self.loop = None
+        # Сопрограммы обслуживания клиентов
+        self.tasks = dict()
+        super().__init__(listen_address, listen_port, database, **kwargs)
+
+    def run(self):
+        """Метод основной цикл потока"""
+        self.start_socket()
+        self.main_socket.setblocking(False)
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.create_task(self.accept_clients())
+        for sock, callback in self.service_sockets.items():
+            self.loop.add_reader(sock, callback)
+        try:
+            if self.running:
+                self.loop.run_forever()
+        finally:
+            # Останавливаем сопрограммы клиентов и закрываем сокеты
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+            for client in self.registry.sockets():
+                client.close()
+            self.main_socket.close()
+
+    def stop(self):
+        """Метод завершения цикла событий сервера. Может вызываться из другого потока."""
+        self.running = False
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def accept_clients(self):
+        """Сопрограмма приёма новых соединений."""
+        while self.running:
+            try:
+                client, client_address = await self.loop.sock_accept(self.main_socket)
+            except OSError as e:
+                LOGGER.error(f'Ошибка сокетов: {e}')
+                continue
+            LOGGER.info(f'Клиент {client_address} подключился.')
+            self.add_client(client, client_address)
+            self.tasks[client] = self.loop.create_task(self.serve_client(client))
+
+    async def read_messages(self, client):
+        """
+        Сопрограмма чтения данных из сокета клиента.
+        Возвращает список полностью принятых сообщений.
+        У отключённого клиента сообщений нет.
+        """
+        connection = self.registry.get(client)
+        if connection is None:
+            return []
+        decoder = connection.decoder
+        data = await self.loop.sock_recv(client, decoder.recv_size)
+        if not data:
+            raise ConnectionResetError
+        return decoder.feed(data)
+
+    async def serve_client(self, client):
+        """Сопрограмма обслуживания одного клиента."""
+        while self.running and client.fileno() != -1:
+            try:
+                for message in await self.read_messages(client):
+                    # Клиент мог быть отключён при обработке предыдущего сообщения
+                    if client.fileno() == -1:
+                        break
+                    self.handle_message(message, client)
+            except (OSError, json.JSONDecodeError, TypeError, IncorrectDataRecivedError) as e:
+                LOGGER.debug(f'Получение данных из исключения клиента.', exc_info=e)
+                self.remove_client(client)
+                return
+
+    def add_service_socket(self, sock, callback):
+        """Метод подключения служебного сокета к циклу событий."""
+        super().add_service_socket(sock, callback)
+        if self.loop:
+            self.loop.add_reader(sock, callback)
+
+    def remove_service_socket(self, sock):
+        """Метод отключения служебного сокета от цикла событий."""
+        super().remove_service_socket(sock)
+        if self.loop and sock.fileno() != -1:
+            self.loop.remove_reader(sock)
+
+    def schedule_handshake_deadline(self, client, deadline):
+        """Метод планирования проверки срока авторизации клиента в цикле событий."""
+        self.loop.call_at(self.loop.time() + deadline - time.monotonic(), self.handshake_expired, client)
+
+    def schedule_events(self):
+        """Метод планирования отправки уведомлений в цикле событий."""
+        if self.events_deadline is None:
+            super().schedule_events()
+            if self.loop and self.loop.is_running():
+                self.loop.call_soon_threadsafe(self.loop.call_later, self.events_debounce, self.send_events)
+
+    def output_ready(self, client):
+        """
+        Метод, вызываемый при появлении данных в очереди отправки клиента.
+        Подписывает сокет на событие готовности к записи.
+        Может вызываться из другого потока (например из графического интерфейса).
+        """
+        if threading.current_thread() is self:
+            self.loop.add_writer(client, self.flush_client, client)
+        elif self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.output_ready, client)
+
+    def flush_client(self, client):
+        """
+        Метод отправки данных из очереди клиента по готовности сокета к записи.
+        Когда очередь опустеет, подписка на событие снимается.
+        """
+        if super().flush_client(client) and client.fileno() != -1:
+            self.loop.remove_writer(client)
+            return True
+        return False
+
+    def remove_client(self, client):
+        """
+        Функция обработчик клиента с которым прервана связь.
+        При вызове из другого потока выполнение передаётся в цикл событий.
+        """
+        if threading.current_thread() is self or not (self.loop and self.loop.is_running()):
+            super().remove_client(client)
+        else:
+            self.loop.call_soon_threadsafe(self.remove_client, client)
+
+    def drop_client(self, client):
+        """
+        Метод закрывающий соединение с клиентом.
+        Снимает подписки сокета в цикле событий и останавливает сопрограмму клиента.
+        """
+        task = self.tasks.pop(client, None)
+        if client.fileno() != -1 and self.loop:
+            self.loop.remove_reader(client)
+            self.loop.remove_writer(client)
+        if task and task is not asyncio.current_task(self.loop):
+            task.cancel()
+        super().drop_client(client)
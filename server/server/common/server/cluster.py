@@ -0,0 +1,428 @@
+"""Многопроцессный режим сервера"""
+
+import logging
+import multiprocessing
+import os
+import select
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+from common.utils import encode_message, MessageDecoder
+from common.errors import IncorrectDataRecivedError
+from common.variables import DESTINATION, RECV_BUFFER_SIZE, OUTBOUND_LIMIT, SLOW_CONSUMER_SPILL
+from server.core import Server
+from server.async_core import AsyncServer
+from server.outbound import OutboundQueue
+from server.server_database import ServerDatabase
+
+# Инициализация логгера сервера
+LOGGER = logging.getLogger('server')
+
+# Служебные сообщения между процессами-обработчиками и маршрутизатором
+IPC = 'ipc'
+# Представление процесса маршрутизатору
+IPC_HELLO = 'hello'
+# Полная таблица присутствия, отправляется процессу при подключении
+IPC_SNAPSHOT = 'snapshot'
+# Вход и выход пользователя, изменение таблицы присутствия
+IPC_LOGIN = 'login'
+IPC_LOGOUT = 'logout'
+IPC_PRESENCE = 'presence'
+# Пересылка сообщения пользователю другого процесса и его доставка
+IPC_ROUTE = 'route'
+IPC_DELIVER = 'deliver'
+# Отключение пользователя, одновременно вошедшего через другой процесс
+IPC_KICK = 'kick'
+# Вызов метода почтовых ящиков
+IPC_MAILBOX = 'mailbox'
+# Смена открытого ключа пользователя, рассылается остальным процессам
+IPC_KEY = 'key'
+
+# Методы почтовых ящиков, доступные процессам-обработчикам
+MAILBOX_CALLS = ('put', 'pending', 'peek', 'acknowledge', 'discard')
+
+
+class RouterLink:
+    """Класс - соединение маршрутизатора с процессом-обработчиком."""
+    __slots__ = ('sock', 'worker', 'role', 'decoder', 'outbound')
+
+    def __init__(self, sock):
+        self.sock = sock
+        # Номер процесса и назначение соединения, известны после IPC_HELLO
+        self.worker = None
+        self.role = None
+        self.decoder = MessageDecoder(framed=True)
+        self.outbound = OutboundQueue(OUTBOUND_LIMIT, SLOW_CONSUMER_SPILL)
+
+
+class Router(threading.Thread):
+    """
+    Маршрутизатор сообщений между процессами-обработчиками.
+    Работает в управляющем процессе и слушает unix-сокет.
+    Хранит таблицу присутствия (имя пользователя - номер процесса)
+    и рассылает её изменения всем процессам, пересылает сообщения
+    пользователям других процессов и обслуживает почтовые ящики.
+    Запись в сокеты процессов неблокирующая, поэтому маршрутизатор
+    не может заблокироваться на медленном процессе.
+    """
+
+    def __init__(self, path, mailbox=None):
+        self.path = path
+        self.mailbox = mailbox
+        # Сокет -> соединение с процессом
+        self.links = dict()
+        # Номер процесса -> соединение для пересылки сообщений
+        self.workers = dict()
+        # Имя пользователя -> номер процесса
+        self.presence = dict()
+        self.running = True
+        self.listen_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listen_socket.bind(path)
+        self.listen_socket.listen()
+        super().__init__(daemon=True)
+
+    def run(self):
+        """Метод основной цикл маршрутизатора."""
+        while self.running:
+            try:
+                recv_lst, send_lst, _ = select.select(
+                    [self.listen_socket] + list(self.links),
+                    [sock for sock, link in self.links.items() if link.outbound], [], 0.5)
+            except OSError as e:
+                LOGGER.error(f'Ошибка сокетов маршрутизатора: {e}')
+                continue
+            for sock in recv_lst:
+                if sock is self.listen_socket:
+                    worker_sock, _ = self.listen_socket.accept()
+                    worker_sock.setblocking(False)
+                    self.links[worker_sock] = RouterLink(worker_sock)
+                else:
+                    self.read(sock)
+            for sock in send_lst:
+                if sock in self.links:
+                    self.flush(self.links[sock])
+        for sock in list(self.links):
+            sock.close()
+        self.listen_socket.close()
+
+    def stop(self):
+        """Метод завершения работы маршрутизатора."""
+        self.running = False
+
+    def read(self, sock):
+        """Метод чтения служебных сообщений процесса."""
+        link = self.links.get(sock)
+        if link is None:
+            return
+        try:
+            data = sock.recv(RECV_BUFFER_SIZE)
+            if not data:
+                raise ConnectionResetError
+            for message in link.decoder.feed(data):
+                self.handle(link, message)
+        except (OSError, ValueError, KeyError, IncorrectDataRecivedError) as e:
+            LOGGER.debug(f'Потеряна связь с процессом {link.worker}.', exc_info=e)
+            self.remove_link(link)
+
+    def send(self, link, message):
+        """Метод отправки служебного сообщения процессу."""
+        link.outbound.put(encode_message(message, True))
+        self.flush(link)
+
+    def flush(self, link):
+        """Метод отправки данных из очереди соединения с процессом."""
+        try:
+            link.outbound.flush(link.sock)
+        except OSError:
+            self.remove_link(link)
+
+    def broadcast(self, message):
+        """Метод рассылки служебного сообщения всем процессам."""
+        for link in list(self.workers.values()):
+            self.send(link, message)
+
+    def handle(self, link, message):
+        """Метод обработки служебного сообщения процесса."""
+        kind = message[IPC]
+        if kind == IPC_HELLO:
+            link.worker = message['worker']
+            link.role = message['role']
+            if link.role == IPC_ROUTE:
+                self.workers[link.worker] = link
+                self.send(link, {IPC: IPC_SNAPSHOT, 'presence': self.presence})
+        elif kind == IPC_LOGIN:
+            username = message['user']
+            owner = self.presence.get(username)
+            # Пользователь одновременно вошёл через два процесса - второй вход отменяется
+            if owner is not None and owner != link.worker:
+                self.send(link, {IPC: IPC_KICK, 'user': username})
+                return
+            self.presence[username] = link.worker
+            self.broadcast({IPC: IPC_PRESENCE, 'user': username, 'worker': link.worker})
+        elif kind == IPC_LOGOUT:
+            username = message['user']
+            if self.presence.get(username) == link.worker:
+                del self.presence[username]
+                self.broadcast({IPC: IPC_PRESENCE, 'user': username, 'worker': None})
+        elif kind == IPC_KEY:
+            for worker_link in list(self.workers.values()):
+                if worker_link is not link:
+                    self.send(worker_link, message)
+        elif kind == IPC_ROUTE:
+            self.route(message['message'])
+        elif kind == IPC_MAILBOX:
+            result = None
+            if self.mailbox is not None and message['call'] in MAILBOX_CALLS:
+                result = getattr(self.mailbox, message['call'])(*message['args'])
+            self.send(link, {IPC: IPC_MAILBOX, 'result': result})
+
+    def route(self, message):
+        """
+        Метод пересылки сообщения процессу, к которому подключен получатель.
+        Если получатель успел отключиться, сообщение сохраняется в его почтовый ящик.
+        """
+        link = self.workers.get(self.presence.get(message[DESTINATION]))
+        if link is not None:
+            self.send(link, {IPC: IPC_DELIVER, 'message': message})
+        elif self.mailbox is not None and self.mailbox.put(message[DESTINATION], message):
+            LOGGER.info(f'Сообщение для пользователя {message[DESTINATION]} сохранено до его подключения.')
+        else:
+            LOGGER.error(f'Пользователь {message[DESTINATION]} отключился, сообщение не доставлено.')
+
+    def remove_link(self, link):
+        """Метод закрытия соединения с процессом. Пользователи процесса считаются вышедшими."""
+        if self.links.pop(link.sock, None) is None:
+            return
+        link.outbound.close()
+        link.sock.close()
+        if link.role == IPC_ROUTE and self.workers.get(link.worker) is link:
+            del self.workers[link.worker]
+            for username in [name for name, worker in self.presence.items() if worker == link.worker]:
+                del self.presence[username]
+                self.broadcast({IPC: IPC_PRESENCE, 'user': username, 'worker': None})
+
+
+class RemoteMailbox:
+    """
+    Класс - почтовые ящики в процессе-обработчике.
+    Повторяет интерфейс класса Mailbox, вызовы передаются маршрутизатору,
+    которому принадлежит файл почтовых ящиков.
+    """
+
+    def __init__(self, router_path, worker_id):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(router_path)
+        self.decoder = MessageDecoder(framed=True)
+        self.lock = threading.Lock()
+        self.sock.sendall(encode_message({IPC: IPC_HELLO, 'worker': worker_id, 'role': IPC_MAILBOX}, True))
+
+    def call(self, name, *args):
+        """Метод вызова метода почтовых ящиков в маршрутизаторе."""
+        with self.lock:
+            self.sock.sendall(encode_message({IPC: IPC_MAILBOX, 'call': name, 'args': args}, True))
+            return self.decoder.read_message(self.sock)['result']
+
+    def put(self, username, message):
+        return self.call('put', username, message)
+
+    def pending(self, username):
+        return self.call('pending', username)
+
+    def peek(self, username, count):
+        messages, taken = self.call('peek', username, count)
+        return messages, taken
+
+    def acknowledge(self, username, count):
+        return self.call('acknowledge', username, count)
+
+    def discard(self, username):
+        return self.call('discard', username)
+
+
+class WorkerMixin:
+    """
+    Примесь к классу сервера для работы в процессе-обработчике.
+    Все процессы слушают один порт (SO_REUSEPORT), входы и выходы
+    пользователей сообщаются маршрутизатору, а сообщения пользователям
+    других процессов пересылаются через него.
+    """
+
+    def __init__(self, *args, worker_id=0, router_path=None, **kwargs):
+        super().__init__(*args, reuse_port=True, **kwargs)
+        self.worker_id = worker_id
+        self.router_path = router_path
+        # Соединение с маршрутизатором
+        self.router = None
+        self.router_decoder = MessageDecoder(framed=True)
+        # Реплика таблицы присутствия: имя пользователя - номер процесса
+        self.presence = dict()
+
+    def start_socket(self):
+        """Метод инициализатор сокетов: слушающего и соединения с маршрутизатором."""
+        super().start_socket()
+        self.router = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.router.connect(self.router_path)
+        self.send_router({IPC: IPC_HELLO, 'worker': self.worker_id, 'role': IPC_ROUTE})
+        self.add_service_socket(self.router, self.read_router)
+
+    def send_router(self, message):
+        """Метод отправки служебного сообщения маршрутизатору."""
+        try:
+            self.router.sendall(encode_message(message, True))
+        except OSError as e:
+            LOGGER.error(f'Ошибка связи с маршрутизатором: {e}')
+
+    def read_router(self):
+        """Метод чтения служебных сообщений маршрутизатора."""
+        try:
+            data = self.router.recv(RECV_BUFFER_SIZE)
+            if not data:
+                raise ConnectionResetError
+            messages = self.router_decoder.feed(data)
+        except (OSError, ValueError, IncorrectDataRecivedError):
+            LOGGER.critical(f'Потеряна связь с маршрутизатором, процесс {self.worker_id} завершается.')
+            self.remove_service_socket(self.router)
+            self.stop()
+            return
+        for message in messages:
+            self.handle_router_message(message)
+
+    def handle_router_message(self, message):
+        """Метод обработки служебного сообщения маршрутизатора."""
+        kind = message[IPC]
+        if kind == IPC_SNAPSHOT:
+            self.presence = message['presence']
+        elif kind == IPC_PRESENCE:
+            if message['worker'] is None:
+                self.presence.pop(message['user'], None)
+            else:
+                self.presence[message['user']] = message['worker']
+                # При входе через другой процесс мог измениться публичный ключ
+                if message['worker'] != self.worker_id:
+                    self.database.users_cache.invalidate(message['user'])
+        elif kind == IPC_DELIVER:
+            super().process_message(message['message'])
+        elif kind == IPC_KEY:
+            # Ключ сменил пользователь другого процесса, клиенты этого процесса
+            # тоже должны удалить сохранённый прежний ключ
+            self.database.users_cache.invalidate(message['user'])
+            super().notify_key_changed(message['user'])
+        elif kind == IPC_KICK:
+            connection = self.registry.find(message['user'])
+            if connection is not None:
+                LOGGER.info(f'Пользователь {message["user"]} уже подключен через другой процесс.')
+                self.remove_client(connection.sock)
+
+    def is_online(self, username):
+        """Метод проверяющий что пользователь подключен к любому из процессов."""
+        return super().is_online(username) or username in self.presence
+
+    def user_connected(self, username):
+        self.send_router({IPC: IPC_LOGIN, 'user': username})
+
+    def user_disconnected(self, username):
+        self.send_router({IPC: IPC_LOGOUT, 'user': username})
+
+    def notify_key_changed(self, username):
+        """
+        Метод уведомления клиентов об изменении открытого ключа пользователя.
+        Клиентов других процессов уведомляют их процессы по сообщению маршрутизатора.
+        """
+        super().notify_key_changed(username)
+        self.send_router({IPC: IPC_KEY, 'user': username})
+
+    def process_message(self, message):
+        """
+        Функция адресной отправки сообщения. Пользователям других процессов
+        сообщение пересылается через маршрутизатор.
+        """
+        if self.registry.find(message[DESTINATION]) is None \
+                and self.presence.get(message[DESTINATION]) is not None:
+            self.send_router({IPC: IPC_ROUTE, 'message': message})
+        else:
+            super().process_message(message)
+
+
+class WorkerServer(WorkerMixin, Server):
+    """Сервер процесса-обработчика на основе select."""
+
+
+class AsyncWorkerServer(WorkerMixin, AsyncServer):
+    """Сервер процесса-обработчика на основе asyncio."""
+
+
+def run_worker(worker_id, router_path, engine, listen_address, listen_port, database_path, settings):
+    """Функция - точка входа процесса-обработчика."""
+    database = ServerDatabase(database_path, clear_active=False)
+    mailbox = RemoteMailbox(router_path, worker_id)
+    server_class = AsyncWorkerServer if engine == 'asyncio' else WorkerServer
+    server = server_class(
+        listen_address,
+        listen_port,
+        database,
+        worker_id=worker_id,
+        router_path=router_path,
+        mailbox=mailbox,
+        **settings)
+    # Управляющий процесс останавливает обработчики сигналом SIGTERM,
+    # перед выходом записываем накопленную статистику
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    server.start()
+    server.join()
+    database.close()
+
+
+class Supervisor:
+    """
+    Класс - управляющий процесс многопроцессного режима.
+    Запускает маршрутизатор и workers процессов-обработчиков,
+    которые принимают соединения на общем порту.
+    """
+
+    def __init__(self, workers, engine, listen_address, listen_port, database_path, mailbox=None, **settings):
+        self.workers = workers
+        self.engine = engine
+        self.listen_address = listen_address
+        self.listen_port = listen_port
+        self.database_path = database_path
+        self.mailbox = mailbox
+        # Параметры сервера, передаваемые процессам-обработчикам
+        self.settings = settings
+        self.directory = None
+        self.router = None
+        self.processes = []
+
+    def start(self):
+        """Метод запуска маршрутизатора и процессов-обработчиков."""
+        self.directory = tempfile.mkdtemp(prefix='messenger-')
+        router_path = os.path.join(self.directory, 'router.sock')
+        self.router = Router(router_path, self.mailbox)
+        self.router.start()
+        # Процессы запускаются заново, а не копируются, так как отображения
+        # базы данных можно создать только один раз в процессе
+        context = multiprocessing.get_context('spawn')
+        for worker_id in range(self.workers):
+            process = context.Process(
+                target=run_worker,
+                args=(worker_id, router_path, self.engine, self.listen_address,
+                      self.listen_port, self.database_path, self.settings),
+                daemon=True)
+            process.start()
+            self.processes.append(process)
+        LOGGER.info(f'Запущено процессов-обработчиков: {self.workers}.')
+
+    def stop(self):
+        """Метод остановки процессов-обработчиков и маршрутизатора."""
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join(5)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        self.processes = []
+        self.router.stop()
+        self.router.join()
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -6,19 +6,28 @@ import json
 import hmac
 import binascii
 import os
+import time
+from collections import deque
 from common.metaclasses import ServerVerifier
 from common.descriptors import Port, Address
-from common.utils import get_message, send_message
+from common.utils import encode_message, MessageDecoder
+from common.errors import IncorrectDataRecivedError, SlowConsumerError
 from common.decorators import login_required
-from common.variables import MAX_CONNECTIONS, DESTINATION, SENDER, PRESENCE, TIME, USER, ACTION, ACCOUNT_NAME, \
+from common.variables import MAX_CONNECTIONS, DESTINATION, SENDER, PRESENCE, TIME, USER, ACCOUNT_NAME, \
     RESPONSE_200, RESPONSE_400, ERROR, MESSAGE, MESSAGE_TEXT, EXIT, GET_CONTACTS, RESPONSE_202, LIST_INFO, \
-    REMOVE_CONTACT, USERS_REQUEST, PUBLIC_KEY_REQUEST, RESPONSE_511, DATA, RESPONSE, PUBLIC_KEY, RESPONSE_205, \
-    ADD_CONTACT
+    REMOVE_CONTACT, USERS_REQUEST, PUBLIC_KEY_REQUEST, RESPONSE_511, DATA, RESPONSE, PUBLIC_KEY, \
+    ADD_CONTACT, FRAMING, FRAMING_LENGTH_PREFIX, OUTBOUND_LIMIT, SLOW_CONSUMER_POLICY, SLOW_CONSUMER_DROP, \
+    HANDSHAKE_TIMEOUT, MAILBOX_BATCH, DIRECTORY_VERSION, USERS_ADDED, USERS_REMOVED, ACTION, EVENT, EVENT_TYPE, \
+    USER_ADDED, USER_REMOVED, CONTACT_CHANGED, KEY_CHANGED, DIRECTORY_SINCE, EVENTS_DEBOUNCE, SEARCH_USERS, SEARCH_PREFIX, \
+    SEARCH_AFTER, SEARCH_LIMIT, SEARCH_MORE, SEARCH_PAGE_SIZE, SEARCH_PAGE_LIMIT, REQUEST_ID, GET_MAILBOX, \
+    MAILBOX_MESSAGES, MAILBOX_ACK
+from server.outbound import OutboundQueue
+from server.registry import Connection, ConnectionRegistry, AUTH_WAIT_PRESENCE, AUTH_WAIT_DIGEST, AUTH_DONE
+from server.dispatch import ActionRegistry
 
 # Инициализация логгера сервера
 LOGGER = logging.getLogger('server')
 
-
 class Server(threading.Thread):
     """
     Основной класс сервера. Принимает содинения, словари - пакеты
@@ -29,22 +38,52 @@ class Server(threading.Thread):
     port = Port()
     address = Address()
 
-    def __init__(self, listen_address, listen_port, database):
+    def __init__(self, listen_address, listen_port, database,
+                 outbound_limit=OUTBOUND_LIMIT, slow_consumer_policy=SLOW_CONSUMER_POLICY,
+                 handshake_timeout=HANDSHAKE_TIMEOUT, mailbox=None, reuse_port=False,
+                 events_debounce=EVENTS_DEBOUNCE):
         # Параментры подключения
         self.listen_address = listen_address
         self.listen_port = listen_port
         self.database = database
+        # Лимит очереди отправки клиента и политика при её переполнении
+        self.outbound_limit = outbound_limit
+        self.slow_consumer_policy = slow_consumer_policy
+        # Время на прохождение авторизации
+        self.handshake_timeout = handshake_timeout
+        # Почтовые ящики пользователей не в сети
+        self.mailbox = mailbox
         # Сокет, через который будет осуществляться работа
         self.main_socket = None
-        # Устанавливаем список клиентов и очередь сообщений
-        self.clients = []
+        # Разрешить нескольким процессам слушать один порт
+        self.reuse_port = reuse_port
+        # Служебные сокеты (не клиентские) и их обработчики
+        self.service_sockets = dict()
+        # Реестр соединений: сокеты, имена пользователей и состояние соединений
+        self.registry = ConnectionRegistry()
         # Сокеты
         self.listen_sockets = None
         self.error_sockets = None
         # Флаг продолжения работы
         self.running = True
-        # Словарь имен пользователей и соответствующие им сокеты
-        self.names = dict()
+        # Сокеты в порядке истечения срока авторизации
+        self.handshake_deadlines = deque()
+        # Сокеты клиентов, отключение которых запрошено из других потоков
+        # (например из графического интерфейса), отключаются основным циклом
+        self.removals = deque()
+        # Уведомления клиентов об изменениях справочника и списков контактов.
+        # Изменения, сделанные за время events_debounce, отправляются одним уведомлением.
+        self.events_debounce = events_debounce
+        self.events_lock = threading.Lock()
+        self.events_deadline = None
+        self.events_directory = False
+        self.events_contacts = set()
+        self.events_keys = set()
+        # Версия справочника пользователей, о которой уже уведомлены клиенты
+        self.directory_version = database.users_version()
+        # Обработчики действий протокола
+        self.actions = ActionRegistry()
+        self.register_actions()
         # Конструктор предка
         super().__init__()
 
@@ -55,36 +94,72 @@ class Server(threading.Thread):
 
         # Основной цикл программы сервера
         while self.running:
-            try:
-                client, client_address = self.main_socket.accept()
-            except OSError:
-                pass
-            else:
-                LOGGER.info(f'Клиент {client_address} подключился.')
-                client.settimeout(5)
-                self.clients.append(client)
-
             recv_lst = []
-            send_lst = []
-            err_lst = []
+            self.listen_sockets = []
 
-            # Проверка на наличие ждущих клиентов
+            # Ждём новых подключений, данных от клиентов и готовности к записи
+            # тех клиентов, у которых есть неотправленные сообщения
             try:
-                if self.clients:
-                    recv_lst, self.listen_sockets, self.error_sockets = select.select(
-                        self.clients, self.clients, [], 0)
+                recv_lst, self.listen_sockets, self.error_sockets = select.select(
+                    [self.main_socket] + self.registry.sockets() + list(self.service_sockets),
+                    [connection.sock for connection in list(self.registry.connections()) if connection.outbound],
+                    [], 0.5)
             except OSError as e:
                 LOGGER.error(f'Ошибка сокетов: {e}')
 
+            if self.main_socket in recv_lst:
+                recv_lst.remove(self.main_socket)
+                try:
+                    client, client_address = self.main_socket.accept()
+                except OSError:
+                    pass
+                else:
+                    LOGGER.info(f'Клиент {client_address} подключился.')
+                    self.add_client(client, client_address)
+
             # Принимаем сообщения и если они есть, то заполняем словарь, если
             # ошибка - отключаем клиента
             if recv_lst:
                 for client_with_msg in recv_lst:
+                    # Служебные сокеты читаются своими обработчиками
+                    if client_with_msg in self.service_sockets:
+                        self.service_sockets[client_with_msg]()
+                        continue
+                    # Клиент мог быть отключён при обработке сообщений других
+                    # клиентов этого прохода, например как медленный получатель
+                    if client_with_msg not in self.registry:
+                        continue
                     try:
-                        self.process_client_message(get_message(client_with_msg), client_with_msg)
-                    except (OSError, json.JSONDecodeError, TypeError) as e:
+                        for message in self.read_messages(client_with_msg):
+                            # Клиент мог быть отключён при обработке предыдущего сообщения
+                            if client_with_msg not in self.registry:
+                                break
+                            self.handle_message(message, client_with_msg)
+                    except (OSError, json.JSONDecodeError, TypeError, IncorrectDataRecivedError) as e:
                         LOGGER.debug(f'Получение данных из исключения клиента.', exc_info=e)
-                        self.clients.remove(client_with_msg)
+                        self.remove_client(client_with_msg)
+
+            # Отправляем накопленные сообщения клиентам, готовым к записи
+            for client in self.listen_sockets:
+                if client in self.registry:
+                    self.flush_client(client)
+
+            # Отключаем клиентов, не успевших авторизоваться
+            now = time.monotonic()
+            while self.handshake_deadlines and self.handshake_deadlines[0][0] <= now:
+                self.handshake_expired(self.handshake_deadlines.popleft()[1])
+
+            # Отключаем клиентов по запросам из других потоков
+            while self.removals:
+                self.remove_client(self.removals.popleft())
+
+            # Рассылаем накопленные уведомления об изменениях
+            if self.events_deadline is not None and self.events_deadline <= now:
+                self.send_events()
+
+    def stop(self):
+        """Метод завершения основного цикла сервера."""
+        self.running = False
 
     def start_socket(self):
         """Метод инициализатор сокета."""
@@ -94,172 +169,469 @@ class Server(threading.Thread):
         )
         # Готовим сокет
         transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.reuse_port:
+            transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         transport.bind((self.listen_address, self.listen_port))
         transport.settimeout(0.5)
         # Слушаем порт
         self.main_socket = transport
         self.main_socket.listen(MAX_CONNECTIONS)
 
+    def read_messages(self, client):
+        """
+        Метод чтения данных из сокета клиента.
+        Возвращает список полностью принятых сообщений.
+        У отключённого клиента сообщений нет.
+        """
+        connection = self.registry.get(client)
+        if connection is None:
+            return []
+        decoder = connection.decoder
+        data = client.recv(decoder.recv_size)
+        if not data:
+            raise ConnectionResetError
+        return decoder.feed(data)
+
+    def add_client(self, client, client_address):
+        """Метод регистрации нового соединения."""
+        client.setblocking(False)
+        deadline = time.monotonic() + self.handshake_timeout
+        self.registry.add(Connection(
+            client,
+            client_address,
+            MessageDecoder(),
+            OutboundQueue(self.outbound_limit, self.slow_consumer_policy),
+            deadline))
+        self.schedule_handshake_deadline(client, deadline)
+
+    def schedule_handshake_deadline(self, client, deadline):
+        """
+        Метод планирования проверки срока авторизации клиента.
+        Срок у всех клиентов одинаковый, поэтому очередь упорядочена по времени.
+        """
+        self.handshake_deadlines.append((deadline, client))
+
+    def handshake_expired(self, client):
+        """Метод отключающий клиента, не завершившего авторизацию в срок."""
+        connection = self.registry.get(client)
+        if connection is not None and connection.auth_state != AUTH_DONE:
+            LOGGER.info(f'Клиент не завершил авторизацию за {self.handshake_timeout} сек. и отключён.')
+            self.drop_client(client)
+
+    def handle_message(self, message, client):
+        """
+        Метод передачи принятого сообщения обработчику.
+        Ответ на запрос авторизации обрабатывается автоматом состояний авторизации,
+        остальные сообщения - методом process_client_message.
+        """
+        connection = self.registry.get(client)
+        if connection.auth_state == AUTH_WAIT_DIGEST:
+            self.auth_verify(connection.presence, client, connection.digest, message)
+        else:
+            self.process_client_message(message, client)
+
+    def send_message(self, client, message):
+        """
+        Метод постановки сообщения в очередь отправки клиента
+        в согласованном с ним формате. Сообщение будет отправлено,
+        когда сокет клиента будет готов к записи.
+        При переполнении очереди сообщение отбрасывается, либо генерируется
+        исключение SlowConsumerError, в зависимости от политики сервера.
+        В ответы на запрос клиента добавляется номер этого запроса.
+        """
+        connection = self.registry.get(client)
+        if connection is None:
+            raise ConnectionResetError
+        if connection.request_id is not None and RESPONSE in message:
+            message = dict(message)
+            message[REQUEST_ID] = connection.request_id
+        if not connection.outbound.put(encode_message(message, connection.decoder.framed)):
+            if self.slow_consumer_policy == SLOW_CONSUMER_DROP:
+                LOGGER.warning(f'Очередь отправки клиента переполнена, сообщение отброшено.')
+                return
+            raise SlowConsumerError
+        self.output_ready(client)
+
+    def output_ready(self, client):
+        """
+        Метод, вызываемый при появлении данных в очереди отправки клиента.
+        Основной цикл проверяет очереди сам, поэтому здесь ничего не делается.
+        """
+        pass
+
+    def flush_client(self, client):
+        """
+        Метод отправки данных из очереди клиента.
+        Возвращает True если очередь отправлена полностью.
+        """
+        connection = self.registry.get(client)
+        try:
+            drained = connection.outbound.flush(client)
+        except OSError as e:
+            LOGGER.debug(f'Ошибка отправки данных клиенту.', exc_info=e)
+            self.remove_client(client)
+            return False
+        return drained
+
+    def deliver_mailbox(self, client):
+        """
+        Метод отправки клиенту очередной порции сообщений из его почтового ящика
+        одним сообщением mailbox_messages. Сообщения удаляются из ящика, только
+        когда клиент подтвердит получение порции, после этого отправляется
+        следующая. Поэтому сообщения не теряются при обрыве соединения,
+        а большой ящик не задерживает обслуживание других клиентов.
+        """
+        connection = self.registry.get(client)
+        while True:
+            messages, taken = self.mailbox.peek(connection.username, MAILBOX_BATCH)
+            if messages or not taken:
+                break
+            # Порция состоит только из просроченных сообщений
+            self.mailbox.acknowledge(connection.username, taken)
+        if not messages:
+            return
+        connection.mailbox_sent = taken
+        try:
+            self.send_message(client, {ACTION: MAILBOX_MESSAGES, TIME: time.time(), LIST_INFO: messages})
+        except OSError:
+            self.remove_client(client)
+            return
+        LOGGER.debug(f'Пользователю {connection.username} отправлено {len(messages)} сообщений из почтового ящика.')
+
+    def queue_depth(self, client):
+        """Метод возвращающий количество сообщений, ожидающих отправки клиенту."""
+        connection = self.registry.get(client)
+        return len(connection.outbound) if connection is not None else 0
+
+    def queue_depths(self):
+        """Метод возвращающий словарь: имя пользователя - глубина очереди отправки."""
+        return {name: len(connection.outbound) for name, connection in list(self.registry.by_name.items())}
+
+    def drop_client(self, client):
+        """
+        Метод закрывающий соединение с клиентом.
+        Перед закрытием пытается отправить оставшиеся в очереди сообщения.
+        """
+        connection = self.registry.remove(client)
+        if connection is not None:
+            try:
+                connection.outbound.flush(client)
+            except OSError:
+                pass
+            connection.outbound.close()
+        client.close()
+
     def remove_client(self, client):
         """
         Функция обработчик клиента с которым прервана связь.
-        Ищет клиента и удаляет его из списков и базы:
+        Ищет клиента и удаляет его из списков и базы.
+        При вызове из другого потока клиент отключается основным циклом,
+        так как реестр соединений изменяется только в нём.
         :param client:
         :return:
         """
-        LOGGER.info(f'Клиент {client.getpeername()} отключился от сервера.')
-        for name in self.names:
-            if self.names[name] == client:
-                self.database.user_logout(name)
-                del self.names[name]
-                break
-        self.clients.remove(client)
-        client.close()
+        if threading.current_thread() is not self and self.is_alive():
+            self.removals.append(client)
+            return
+        connection = self.registry.get(client)
+        if connection is not None:
+            LOGGER.info(f'Клиент {connection.address} отключился от сервера.')
+            if connection.username is not None:
+                # Запись об активности удаляется по адресу соединения: при работе
+                # в несколько процессов она может принадлежать другому сеансу
+                self.database.user_logout(connection.username, *connection.address)
+        self.drop_client(client)
+        if connection is not None and connection.username is not None:
+            self.user_disconnected(connection.username)
+
+    def add_service_socket(self, sock, callback):
+        """
+        Метод подключения служебного сокета к основному циклу.
+        Когда в сокете появятся данные, будет вызван callback().
+        """
+        self.service_sockets[sock] = callback
+
+    def remove_service_socket(self, sock):
+        """Метод отключения служебного сокета от основного цикла."""
+        self.service_sockets.pop(sock, None)
+
+    def is_online(self, username):
+        """Метод проверяющий что пользователь подключен к серверу."""
+        return self.registry.find(username) is not None
+
+    def user_connected(self, username):
+        """Метод, вызываемый после авторизации пользователя."""
+        pass
+
+    def user_disconnected(self, username):
+        """Метод, вызываемый после отключения авторизованного пользователя."""
+        pass
 
     def process_message(self, message):
         """
         Функция адресной отправки сообщения определённому клиенту. Принимает словарь сообщение,
         список зарегистрированых пользователей и слушающие сокеты. Ничего не возвращает.
         """
-        if message[DESTINATION] in self.names and self.names[message[DESTINATION]] in self.listen_sockets:
+        recipient = self.registry.find(message[DESTINATION])
+        if recipient is not None:
             try:
-                send_message(self.names[message[DESTINATION]], message)
+                self.send_message(recipient.sock, message)
                 LOGGER.info(
                     f'Отправлено сообщение пользователю {message[DESTINATION]} '
                     f'от пользователя {message[SENDER]}.')
             except OSError:
-                self.remove_client(self.names[message[DESTINATION]])
-
-        elif message[DESTINATION] in self.names and self.names[message[DESTINATION]] not in self.listen_sockets:
-            LOGGER.error(
-                f'Связь с пользователем {message[DESTINATION]} потеряна. '
-                f'Соединение закрыто, отправка сообщения невозможна.')
-            self.remove_client(self.names[message[DESTINATION]])
+                LOGGER.error(
+                    f'Пользователь {message[DESTINATION]} не принимает сообщения. '
+                    f'Соединение закрыто, отправка сообщения невозможна.')
+                self.remove_client(recipient.sock)
         else:
             LOGGER.error(
                 f'Пользователь {message[DESTINATION]} не зарегистрирован на сервере, '
                 f'отправка сообщения невозможна.')
 
+    def register_actions(self):
+        """Метод регистрации обработчиков стандартных действий протокола."""
+        self.register_action(PRESENCE, self.autorized_user, (TIME, USER))
+        self.register_action(MESSAGE, self.action_message, (TIME, DESTINATION, MESSAGE_TEXT), owner=SENDER)
+        self.register_action(EXIT, self.action_exit, owner=ACCOUNT_NAME)
+        self.register_action(GET_CONTACTS, self.action_get_contacts, owner=USER)
+        self.register_action(ADD_CONTACT, self.action_add_contact, (ACCOUNT_NAME,), owner=USER)
+        self.register_action(REMOVE_CONTACT, self.action_remove_contact, (ACCOUNT_NAME,), owner=USER)
+        self.register_action(USERS_REQUEST, self.action_users_request, owner=ACCOUNT_NAME)
+        self.register_action(PUBLIC_KEY_REQUEST, self.action_public_key_request, (ACCOUNT_NAME,))
+        self.register_action(SEARCH_USERS, self.action_search_users, (SEARCH_PREFIX,), owner=ACCOUNT_NAME)
+        self.register_action(GET_MAILBOX, self.action_get_mailbox, owner=ACCOUNT_NAME)
+        self.register_action(MAILBOX_ACK, self.action_mailbox_ack, owner=ACCOUNT_NAME)
+
+    def register_action(self, action, handler, fields=(), owner=None):
+        """
+        Метод подключения обработчика действия.
+        :param action: значение поля action сообщения.
+        :param handler: функция handler(message, client).
+        :param fields: обязательные поля сообщения.
+        :param owner: поле, в котором клиент передаёт своё имя.
+        Сообщение принимается только от сокета, на котором авторизован этот пользователь.
+        """
+        self.actions.register(action, handler, fields, owner)
+
     @login_required
     def process_client_message(self, message, client):
         """ Обработчик сообщений от клиентов """
         LOGGER.debug(f'Разбор сообщения от клиента : {message}')
-        # Если это сообщение о присутствии, принимаем и отвечаем
-        if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
-            # Если сообщение о присутствии то вызываем функцию авторизации.
-            self.autorized_user(message, client)
-
-        # Если это сообщение, то добавляем его в очередь
-        elif ACTION in message and message[ACTION] == MESSAGE and TIME in message and DESTINATION in message \
-                and SENDER in message and MESSAGE_TEXT in message and self.names[message[SENDER]] == client:
-            if message[DESTINATION] in self.names:
-                self.database.process_message(message[SENDER], message[DESTINATION])
-                self.process_message(message)
-                try:
-                    send_message(client, RESPONSE_200)
-                except OSError:
-                    self.remove_client(client)
+        connection = self.registry.get(client)
+        connection.request_id = message.get(REQUEST_ID)
+        try:
+            handler = self.actions.resolve(message, connection.username)
+            if handler is not None:
+                handler(message, client)
+            # Иначе отдаём Bad request
             else:
                 response = RESPONSE_400
-                response[ERROR] = 'Пользователь не зарегистрирован.'
+                response[ERROR] = 'Запрос некорректен.'
                 try:
-                    send_message(client, response)
+                    self.send_message(client, response)
                 except OSError:
-                    pass
-            return
-
-        # Если клиент выходит
-        elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message and \
-                self.names[message[ACCOUNT_NAME]] == client:
-            self.remove_client(client)
-            LOGGER.info(f'Клиент {message[ACCOUNT_NAME]} коректно вышел')
+                    self.remove_client(client)
+        finally:
+            connection.request_id = None
 
-        # Если запрос контактов
-        elif ACTION in message and message[ACTION] == GET_CONTACTS and USER in message and \
-                self.names[message[USER]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = self.database.get_contacts(message[USER])
+    def action_message(self, message, client):
+        """Обработчик сообщения пользователю: пересылает его адресату."""
+        # Номер запроса отправителя получателю не передаётся
+        if REQUEST_ID in message:
+            message = dict(message)
+            del message[REQUEST_ID]
+        if self.is_online(message[DESTINATION]):
+            self.database.process_message(message[SENDER], message[DESTINATION])
+            self.process_message(message)
             try:
-                send_message(client, response)
+                self.send_message(client, RESPONSE_200)
             except OSError:
                 self.remove_client(client)
-
-        # Если запрос на добавление контакта
-        elif ACTION in message and message[ACTION] == ADD_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.add_contact(message[USER], message[ACCOUNT_NAME])
+        # Получатель не в сети - сохраняем сообщение в его почтовый ящик
+        elif self.mailbox is not None and self.database.check_user(message[DESTINATION]):
+            if self.mailbox.put(message[DESTINATION], message):
+                self.database.process_message(message[SENDER], message[DESTINATION])
+                LOGGER.info(
+                    f'Сообщение для пользователя {message[DESTINATION]} '
+                    f'сохранено до его подключения.')
+                response = RESPONSE_200
+            else:
+                response = RESPONSE_400
+                response[ERROR] = 'Почтовый ящик пользователя переполнен.'
             try:
-                send_message(client, RESPONSE_200)
+                self.send_message(client, response)
             except OSError:
                 self.remove_client(client)
-
-        # Если запрос на удаление контакта
-        elif ACTION in message and message[ACTION] == REMOVE_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
+        else:
+            response = RESPONSE_400
+            response[ERROR] = 'Пользователь не зарегистрирован.'
             try:
-                send_message(client, RESPONSE_200)
+                self.send_message(client, response)
             except OSError:
-                self.remove_client(client)
+                pass
+
+    def action_exit(self, message, client):
+        """Обработчик выхода клиента."""
+        self.remove_client(client)
+        LOGGER.info(f'Клиент {message[ACCOUNT_NAME]} коректно вышел')
+
+    def action_get_contacts(self, message, client):
+        """Обработчик запроса списка контактов."""
+        response = RESPONSE_202
+        response[LIST_INFO] = self.database.get_contacts(message[USER])
+        try:
+            self.send_message(client, response)
+        except OSError:
+            self.remove_client(client)
+
+    def action_add_contact(self, message, client):
+        """Обработчик запроса на добавление контакта."""
+        self.database.add_contact(message[USER], message[ACCOUNT_NAME])
+        try:
+            self.send_message(client, RESPONSE_200)
+        except OSError:
+            self.remove_client(client)
+
+    def action_remove_contact(self, message, client):
+        """Обработчик запроса на удаление контакта."""
+        self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
+        try:
+            self.send_message(client, RESPONSE_200)
+        except OSError:
+            self.remove_client(client)
+
+    def action_users_request(self, message, client):
+        """
+        Обработчик запроса известных пользователей.
+        Если клиент передал версию своего справочника, отправляются только
+        пользователи, добавленные и удалённые после неё, иначе полный список.
+        """
+        delta = None
+        if message.get(DIRECTORY_VERSION):
+            delta = self.database.users_delta(message[DIRECTORY_VERSION])
+        if delta:
+            version, added, removed = delta
+            response = {RESPONSE: 202, DIRECTORY_VERSION: version, USERS_ADDED: added, USERS_REMOVED: removed}
+        else:
+            version = self.database.users_version()
+            response = {RESPONSE: 202, DIRECTORY_VERSION: version,
+                        LIST_INFO: [user[0] for user in self.database.users_list()]}
+        try:
+            self.send_message(client, response)
+        except OSError:
+            self.remove_client(client)
+
+    def action_search_users(self, message, client):
+        """
+        Обработчик поиска пользователей по началу имени.
+        Отвечает страницей не более SEARCH_PAGE_LIMIT имён, следующих
+        за именем из поля after, и признаком наличия следующей страницы.
+        """
+        prefix = message[SEARCH_PREFIX]
+        after = message.get(SEARCH_AFTER)
+        limit = message.get(SEARCH_LIMIT, SEARCH_PAGE_SIZE)
+        if not isinstance(prefix, str) or not isinstance(after, (str, type(None))) or not isinstance(limit, int):
+            response = dict(RESPONSE_400)
+            response[ERROR] = 'Запрос некорректен.'
+        else:
+            names, more = self.database.search_users(prefix, after, max(1, min(limit, SEARCH_PAGE_LIMIT)))
+            response = {RESPONSE: 202, LIST_INFO: names, SEARCH_MORE: more}
+        try:
+            self.send_message(client, response)
+        except OSError:
+            self.remove_client(client)
 
-        # Если запрос известных пользователей
-        elif ACTION in message and message[ACTION] == USERS_REQUEST and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = [user[0] for user in self.database.users_list()]
+    def action_get_mailbox(self, message, client):
+        """
+        Обработчик запроса клиента, готового принимать сообщения:
+        начинает отправку сообщений из почтового ящика.
+        Клиент отправляет запрос, когда подключены все его обработчики
+        сообщений, поэтому сообщения не приходят ему раньше времени.
+        """
+        try:
+            self.send_message(client, RESPONSE_200)
+        except OSError:
+            self.remove_client(client)
+            return
+        if self.mailbox is not None and not self.registry.get(client).mailbox_sent:
+            self.deliver_mailbox(client)
+
+    def action_mailbox_ack(self, message, client):
+        """
+        Обработчик подтверждения получения порции сообщений из почтового ящика.
+        Доставленные сообщения удаляются из ящика, отправляется следующая порция.
+        Ответ на подтверждение не отправляется.
+        """
+        connection = self.registry.get(client)
+        if self.mailbox is None or not connection.mailbox_sent:
+            return
+        self.mailbox.acknowledge(connection.username, connection.mailbox_sent)
+        connection.mailbox_sent = 0
+        self.deliver_mailbox(client)
+
+    def action_public_key_request(self, message, client):
+        """Обработчик запроса публичного ключа пользователя."""
+        response = RESPONSE_511
+        response[DATA] = self.database.get_public_key(message[ACCOUNT_NAME])
+        if response[DATA]:
             try:
-                send_message(client, response)
+                self.send_message(client, response)
             except OSError:
                 self.remove_client(client)
-
-        # Если запрос публичного ключа пользователя
-        elif ACTION in message and message[ACTION] == PUBLIC_KEY_REQUEST and ACCOUNT_NAME in message:
-            response = RESPONSE_511
-            response[DATA] = self.database.get_public_key(message[ACCOUNT_NAME])
-            if response[DATA]:
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.remove_client(client)
-            else:
-                response = RESPONSE_400
-                response[ERROR] = 'Публичный ключ не найден для данного пользователя.'
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.remove_client(client)
-
-        # Иначе отдаём Bad request
         else:
             response = RESPONSE_400
-            response[ERROR] = 'Запрос некорректен.'
+            response[ERROR] = 'Публичный ключ не найден для данного пользователя.'
             try:
-                send_message(client, response)
+                self.send_message(client, response)
             except OSError:
                 self.remove_client(client)
 
     def autorized_user(self, message, client):
         """
         Функция реализующая авторизацию пользователей.
+        Отправляет клиенту запрос 511 и, не дожидаясь ответа, переводит
+        соединение в состояние ожидания ответа. Ответ обрабатывается
+        методом auth_verify при его поступлении.
         :param message:
         :param client:
         :return:
         """
+        connection = self.registry.get(client)
+        if connection.auth_state != AUTH_WAIT_PRESENCE:
+            response = RESPONSE_400
+            response[ERROR] = 'Клиент уже авторизован.'
+            try:
+                self.send_message(client, response)
+            except OSError:
+                self.remove_client(client)
+            return
+        digest = self.auth_challenge(message, client)
+        if digest is not None:
+            connection.auth_state = AUTH_WAIT_DIGEST
+            connection.presence = message
+            connection.digest = digest
 
+    def auth_challenge(self, message, client):
+        """
+        Первый этап авторизации: проверка имени пользователя и отправка
+        клиенту запроса 511 со случайной строкой.
+        Возвращает серверную версию хэша для сравнения с ответом клиента
+        или None, если авторизация невозможна (соединение при этом закрыто).
+        """
         # Если имя пользователя уже занято то возвращаем 400
         LOGGER.debug(f'Авторизация для пользователя: {message[USER]}')
 
-        if message[USER][ACCOUNT_NAME] not in self.names.keys():
+        if self.is_online(message[USER][ACCOUNT_NAME]):
             response = RESPONSE_400
             response[ERROR] = 'Имя пользователя уже занято.'
             try:
                 LOGGER.debug(f'Имя занято {response}')
-                send_message(client, response)
+                self.send_message(client, response)
             except OSError:
                 LOGGER.debug(f'Ошибка системы')
                 pass
-            self.clients.remove(client)
-            client.close()
+            self.drop_client(client)
 
         # Проверяем что пользователь зарегистрирован на сервере.
         elif not self.database.check_user(message[USER][ACCOUNT_NAME]):
@@ -267,66 +639,167 @@ class Server(threading.Thread):
             response[ERROR] = 'Пользователь не зарегистрирован.'
             try:
                 LOGGER.debug(f'Неизвестное имя пользователя {response}')
-                send_message(client, response)
+                self.send_message(client, response)
             except OSError:
                 pass
-            self.clients.remove(client)
-            client.close()
+            self.drop_client(client)
         else:
             LOGGER.debug('Имя пользователя корректно. Проверяем пароль.')
             # Словарь - заготовка
-            message_auth = RESPONSE_511
+            message_auth = dict(RESPONSE_511)
+            # Если клиент поддерживает потоковый протокол, подтверждаем переход на него
+            framed = message.get(FRAMING) == FRAMING_LENGTH_PREFIX
+            if framed:
+                message_auth[FRAMING] = FRAMING_LENGTH_PREFIX
             # Набор байтов в hex представлении
             random_str = binascii.hexlify(os.urandom(64))
             # В словарь байты нельзя, декодируем (json.dumps -> TypeError)
             message_auth[DATA] = random_str.decode('ascii')
             # Создаём хэш пароля и связки с рандомной строкой, сохраняем
             # серверную версию ключа
-            hash = hmac.new(self.database.get_hash(message[USER][ACCOUNT_NAME]), random_str)
-            digest = hash.digest()
+            hash = hmac.new(self.database.get_hash(message[USER][ACCOUNT_NAME]), random_str, 'MD5')
             LOGGER.debug(f'Auth message = {message_auth}')
             try:
-                # Обмен с клиентом
-                send_message(client, message_auth)
-                ans = get_message(client)
+                self.send_message(client, message_auth)
             except OSError as err:
                 LOGGER.debug('Ошибка авторизации:', exc_info=err)
-                client.close()
-                return
-            client_digest = binascii.a2b_base64(ans[DATA])
-            # Если ответ клиента корректный, то сохраняем его в список
-            # пользователей.
-            if RESPONSE in ans and ans[RESPONSE] == 511 and hmac.compare_digest(digest, client_digest):
-                self.names[message[USER][ACCOUNT_NAME]] = client
-                client_ip, client_port = client.getpeername()
+                self.drop_client(client)
+                return None
+            # Ответ на presence отправляется без кадра, дальше - только кадрами
+            if framed:
+                self.registry.get(client).decoder.framed = True
+            return hash.digest()
+        return None
+
+    def auth_verify(self, message, client, digest, ans):
+        """
+        Второй этап авторизации: сравнение ответа клиента с серверной
+        версией хэша. При успехе регистрирует пользователя в списке активных.
+        """
+        try:
+            client_digest = binascii.a2b_base64(ans[DATA]) if RESPONSE in ans and ans[RESPONSE] == 511 else b''
+        except (KeyError, TypeError, binascii.Error):
+            client_digest = b''
+        # Если ответ клиента корректный, то сохраняем его в список
+        # пользователей.
+        if client_digest and hmac.compare_digest(digest, client_digest):
+            # Пока ожидался ответ, имя могло быть занято другим соединением
+            if self.is_online(message[USER][ACCOUNT_NAME]):
+                response = RESPONSE_400
+                response[ERROR] = 'Имя пользователя уже занято.'
                 try:
-                    send_message(client, RESPONSE_200)
+                    self.send_message(client, response)
                 except OSError:
-                    self.remove_client(message[USER][ACCOUNT_NAME])
-                # добавляем пользователя в список активных и если у него изменился открытый ключ
-                # сохраняем новый
-                self.database.user_login(
+                    pass
+                self.drop_client(client)
+                return
+            connection = self.registry.authorize(client, message[USER][ACCOUNT_NAME])
+            self.user_connected(connection.username)
+            client_ip, client_port = connection.address
+            try:
+                self.send_message(client, RESPONSE_200)
+            except OSError:
+                self.remove_client(client)
+                return
+            # добавляем пользователя в список активных и если у него изменился открытый ключ
+            # сохраняем новый и уведомляем клиентов, сохранивших прежний
+            if self.database.user_login(
                     message[USER][ACCOUNT_NAME],
                     client_ip,
                     client_port,
-                    message[USER][PUBLIC_KEY])
-            else:
-                response = RESPONSE_400
-                response[ERROR] = 'Неверный пароль.'
-                try:
-                    send_message(client, response)
-                except OSError:
-                    pass
-                self.clients.remove(client)
-                client.close()
+                    message[USER][PUBLIC_KEY]):
+                self.notify_key_changed(connection.username)
+            # Сообщения, поступившие пока пользователь был не в сети, отправляются
+            # по запросу клиента get_mailbox, см. action_get_mailbox
+        else:
+            response = RESPONSE_400
+            response[ERROR] = 'Неверный пароль.'
+            try:
+                self.send_message(client, response)
+            except OSError:
+                pass
+            self.drop_client(client)
 
-    def service_update_lists(self):
+    def notify_directory_changed(self):
         """
-        Функция реализующая отправку сервисного сообщения "205" клиентам.
-        :return:
+        Метод уведомления клиентов об изменении справочника пользователей.
+        Может вызываться из другого потока, уведомление будет отправлено
+        потоком сервера по истечении events_debounce.
+        """
+        with self.events_lock:
+            self.events_directory = True
+            self.schedule_events()
+
+    def notify_contacts_changed(self, usernames):
+        """
+        Метод уведомления пользователей об изменении их списков контактов.
+        Может вызываться из другого потока.
+        """
+        with self.events_lock:
+            self.events_contacts.update(usernames)
+            self.schedule_events()
+
+    def notify_key_changed(self, username):
         """
-        for client in self.names:
+        Метод уведомления клиентов об изменении открытого ключа пользователя.
+        Может вызываться из другого потока.
+        """
+        with self.events_lock:
+            self.events_keys.add(username)
+            self.schedule_events()
+
+    def schedule_events(self):
+        """
+        Метод планирования отправки уведомлений, вызывается под events_lock.
+        Срок отсчитывается от первого изменения и не продлевается последующими.
+        """
+        if self.events_deadline is None:
+            self.events_deadline = time.monotonic() + self.events_debounce
+
+    def send_events(self):
+        """
+        Метод отправки накопленных уведомлений.
+        Изменения справочника рассылаются всем подключенным клиентам
+        событиями user_added и user_removed вместе с именами пользователей,
+        поэтому клиентам не нужно запрашивать справочник заново.
+        Событие contact_changed с новым списком контактов получают только
+        пользователи, чьи списки изменились. Событие key_changed с именами
+        пользователей, сменивших открытый ключ, рассылается всем.
+        """
+        with self.events_lock:
+            directory, self.events_directory = self.events_directory, False
+            contacts, self.events_contacts = self.events_contacts, set()
+            keys, self.events_keys = self.events_keys, set()
+            self.events_deadline = None
+
+        events = []
+        if directory:
+            delta = self.database.users_delta(self.directory_version)
+            if delta:
+                version, added, removed = delta
+                for event_type, names in ((USER_ADDED, added), (USER_REMOVED, removed)):
+                    if names:
+                        events.append({ACTION: EVENT, TIME: time.time(), EVENT_TYPE: event_type, LIST_INFO: names,
+                                       DIRECTORY_SINCE: self.directory_version, DIRECTORY_VERSION: version})
+                self.directory_version = version
+        if keys:
+            events.append({ACTION: EVENT, TIME: time.time(), EVENT_TYPE: KEY_CHANGED, LIST_INFO: sorted(keys)})
+        if events:
+            for connection in list(self.registry.by_name.values()):
+                for event in events:
+                    try:
+                        self.send_message(connection.sock, event)
+                    except OSError:
+                        self.remove_client(connection.sock)
+                        break
+
+        for username in contacts:
+            connection = self.registry.find(username)
+            if connection is None:
+                continue
+            event = {ACTION: EVENT, TIME: time.time(), EVENT_TYPE: CONTACT_CHANGED,
+                     LIST_INFO: self.database.get_contacts(username)}
             try:
-                send_message(self.names[client], RESPONSE_205)
+                self.send_message(connection.sock, event)
             except OSError:
-                self.remove_client(self.names[client])
+                self.remove_client(connection.sock)
@@ -0,0 +1,67 @@
+"""Таблица обработчиков действий сервера"""
+
+from common.variables import ACTION
+
+
+def compile_validator(fields, owner=None):
+    """
+    Функция построения проверки сообщения для действия.
+    Проверка собирается один раз при регистрации действия в функцию
+    из цепочки проверок "поле in message", такую же, как была записана
+    вручную для каждого действия: без циклов, кортежей и перехвата
+    исключений, которые на каждом сообщении обходились дороже самих проверок.
+    Поле action не проверяется: по нему сообщение уже найдено в таблице.
+    :param fields: обязательные поля сообщения, строковые константы протокола.
+    :param owner: поле, в котором должно быть имя пользователя,
+    авторизованного на сокете отправителя, или None.
+    :return: функция validate(message, username) -> bool.
+    """
+    checks = [f'{field!r} in message' for field in fields]
+    if owner is not None:
+        checks.append(f'{owner!r} in message and message[{owner!r}] == username')
+    return eval(f'lambda message, username: {" and ".join(checks) or "True"}')
+
+
+class ActionRegistry:
+    """
+    Класс - таблица обработчиков действий.
+    Обработчик выбирается по значению поля action одним обращением к словарю,
+    поэтому стоимость выбора не зависит от количества и порядка действий.
+    """
+
+    def __init__(self):
+        # Действие -> (обработчик, проверка сообщения)
+        self.actions = dict()
+
+    def __contains__(self, action):
+        return action in self.actions
+
+    def register(self, action, handler, fields=(), owner=None):
+        """
+        Метод регистрации обработчика действия.
+        Повторная регистрация заменяет обработчик.
+        :param action: значение поля action.
+        :param handler: функция handler(message, client).
+        :param fields: обязательные поля сообщения.
+        :param owner: поле с именем пользователя-отправителя.
+        """
+        self.actions[action] = (handler, compile_validator(fields, owner))
+
+    def unregister(self, action):
+        """Метод удаления обработчика действия."""
+        self.actions.pop(action, None)
+
+    def resolve(self, message, username):
+        """
+        Метод поиска обработчика для сообщения.
+        Возвращает обработчик или None, если действие неизвестно
+        или сообщение не прошло проверку.
+        """
+        try:
+            entry = self.actions.get(message.get(ACTION))
+        except TypeError:
+            # Значение action не может быть ключом словаря
+            return None
+        if entry is None or not entry[1](message, username):
+            return None
+        return entry[0]
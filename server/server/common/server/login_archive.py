@@ -0,0 +1,83 @@
+"""Архив истории входов пользователей"""
+
+import csv
+import datetime
+import gzip
+import os
+import threading
+from itertools import groupby
+from operator import itemgetter
+
+# Шаблон имени файла архива, файл заводится на каждый месяц
+ARCHIVE_FILE = 'login_history_{:%Y-%m}.csv.gz'
+# Тот же шаблон для разбора месяца из имени файла
+ARCHIVE_FILE_FORMAT = 'login_history_%Y-%m.csv.gz'
+
+
+class LoginArchive:
+    """
+    Класс - архив истории входов.
+    Записи старше срока хранения переносятся из базы в сжатые gzip файлы
+    CSV формата (имя, время входа, адрес, порт), по одному файлу на месяц.
+    Файлы только дописываются: каждая дозапись - отдельный член gzip,
+    при чтении они разжимаются как один поток.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        # Архив дописывается потоком обслуживания базы, а читается графическим интерфейсом
+        self.lock = threading.Lock()
+
+    def files(self, since=None, until=None):
+        """
+        Метод возвращающий пути файлов архива в порядке времени.
+        Если задан интервал [since, until), возвращаются только файлы
+        месяцев, пересекающихся с ним.
+        """
+        files = []
+        for name in sorted(os.listdir(self.path)):
+            try:
+                month = datetime.datetime.strptime(name, ARCHIVE_FILE_FORMAT)
+            except ValueError:
+                continue
+            next_month = (month + datetime.timedelta(days=32)).replace(day=1)
+            if (since and next_month <= since) or (until and month >= until):
+                continue
+            files.append(os.path.join(self.path, name))
+        return files
+
+    def append(self, rows):
+        """
+        Метод дозаписи в архив.
+        Принимает записи (имя, время входа, адрес, порт).
+        """
+        rows = sorted(rows, key=itemgetter(1))
+        with self.lock:
+            for month, month_rows in groupby(rows, key=lambda row: row[1].replace(
+                    day=1, hour=0, minute=0, second=0, microsecond=0)):
+                file_path = os.path.join(self.path, ARCHIVE_FILE.format(month))
+                with gzip.open(file_path, 'at', encoding='utf-8', newline='') as file:
+                    writer = csv.writer(file)
+                    for name, date_time, ip, port in month_rows:
+                        writer.writerow((name, date_time.isoformat(' '), ip, port))
+
+    def read(self, username=None, since=None, until=None):
+        """
+        Метод чтения архива, всего или по одному пользователю.
+        Если задан интервал [since, until), разжимаются только файлы
+        месяцев, пересекающихся с ним, и возвращаются только записи из него.
+        """
+        history = []
+        with self.lock:
+            for file_path in self.files(since, until):
+                with gzip.open(file_path, 'rt', encoding='utf-8', newline='') as file:
+                    for name, date_time, ip, port in csv.reader(file):
+                        if username and name != username:
+                            continue
+                        date_time = datetime.datetime.fromisoformat(date_time)
+                        if (since and date_time < since) or (until and date_time >= until):
+                            continue
+                        history.append((name, date_time, ip, port))
+        history.sort(key=itemgetter(1))
+        return history
@@ -0,0 +1,175 @@
+"""Почтовые ящики пользователей, находящихся не в сети"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from itertools import islice
+from common.utils import FRAME_HEADER
+from common.variables import ENCODING, MAILBOX_TTL, MAILBOX_LIMIT
+
+# Минимальное количество ненужных записей журнала для его перезаписи
+COMPACT_THRESHOLD = 1000
+
+
+class Mailbox:
+    """
+    Класс - почтовые ящики пользователей, находящихся не в сети.
+    Сообщения хранятся в файле-журнале, в который записи только добавляются:
+    записи о помещении сообщения в ящик и записи о выдаче сообщений из ящика.
+    В памяти хранится индекс: для каждого пользователя очередь
+    (смещение, длинна, срок хранения) его сообщений в журнале.
+    При запуске индекс восстанавливается чтением журнала.
+    Когда выданных и просроченных записей становится больше, чем
+    хранящихся, журнал перезаписывается.
+    """
+
+    def __init__(self, path, ttl=MAILBOX_TTL, limit=MAILBOX_LIMIT):
+        self.path = path
+        # Срок хранения сообщения, сек. и лимит сообщений в ящике
+        self.ttl = ttl
+        self.limit = limit
+        # Имя пользователя -> очередь (смещение, длинна, срок хранения)
+        self.index = dict()
+        # Количество записей журнала, которые больше не нужны
+        self.garbage = 0
+        # Ящики используются потоком сервера и графическим интерфейсом
+        self.lock = threading.Lock()
+        self.file = open(path, 'a+b')
+        self.load()
+
+    def __len__(self):
+        """Количество сообщений во всех ящиках."""
+        return sum(len(queue) for queue in self.index.values())
+
+    def load(self):
+        """Метод восстановления индекса по журналу."""
+        self.index.clear()
+        self.garbage = 0
+        self.file.seek(0)
+        position = 0
+        while True:
+            header = self.file.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                break
+            length, = FRAME_HEADER.unpack(header)
+            try:
+                record = json.loads(self.file.read(length).decode(ENCODING))
+            except ValueError:
+                break
+            self.apply(record, position + FRAME_HEADER.size, length)
+            position = self.file.tell()
+        # Обрезаем запись, не дописанную при аварийном завершении
+        self.file.truncate(position)
+
+    def apply(self, record, offset, length):
+        """Метод применения записи журнала к индексу."""
+        if 'message' in record:
+            self.index.setdefault(record['user'], deque()).append((offset, length, record['expires']))
+        else:
+            queue = self.index.get(record['user'], deque())
+            count = min(record['ack'], len(queue))
+            for _ in range(count):
+                queue.popleft()
+            if not queue:
+                self.index.pop(record['user'], None)
+            # Ненужными становятся выданные сообщения и сама запись о выдаче
+            self.garbage += count + 1
+
+    def append(self, record):
+        """Метод дозаписи в журнал. Возвращает смещение и длинну записи."""
+        data = json.dumps(record).encode(ENCODING)
+        self.file.seek(0, os.SEEK_END)
+        offset = self.file.tell() + FRAME_HEADER.size
+        self.file.write(FRAME_HEADER.pack(len(data)) + data)
+        self.file.flush()
+        return offset, len(data)
+
+    def ack(self, username, count):
+        """Метод удаления первых count сообщений из ящика пользователя."""
+        if count:
+            self.append({'user': username, 'ack': count})
+            self.apply({'user': username, 'ack': count}, None, None)
+            if self.garbage >= COMPACT_THRESHOLD and self.garbage > len(self):
+                self.compact()
+
+    def expired(self, username, now):
+        """Метод подсчёта просроченных сообщений в начале ящика."""
+        count = 0
+        for _, _, expires in self.index.get(username, ()):
+            if expires > now:
+                break
+            count += 1
+        return count
+
+    def put(self, username, message):
+        """
+        Метод помещения сообщения в ящик пользователя.
+        Возвращает False, если ящик переполнен.
+        """
+        with self.lock:
+            now = time.time()
+            if len(self.index.get(username, ())) >= self.limit:
+                self.ack(username, self.expired(username, now))
+                if len(self.index.get(username, ())) >= self.limit:
+                    return False
+            record = {'user': username, 'expires': now + self.ttl, 'message': message}
+            offset, length = self.append(record)
+            self.index.setdefault(username, deque()).append((offset, length, record['expires']))
+            return True
+
+    def pending(self, username):
+        """Метод возвращающий количество сообщений в ящике пользователя."""
+        return len(self.index.get(username, ()))
+
+    def peek(self, username, count):
+        """
+        Метод чтения не более count первых сообщений из ящика пользователя.
+        Сообщения остаются в ящике до подтверждения методом acknowledge.
+        Возвращает список не просроченных сообщений и количество
+        прочитанных записей ящика, включая просроченные.
+        """
+        with self.lock:
+            now = time.time()
+            messages = []
+            taken = 0
+            for offset, length, expires in islice(self.index.get(username, ()), count):
+                taken += 1
+                if expires <= now:
+                    continue
+                self.file.seek(offset)
+                messages.append(json.loads(self.file.read(length).decode(ENCODING))['message'])
+            return messages, taken
+
+    def acknowledge(self, username, count):
+        """Метод удаления из ящика первых count сообщений, доставленных пользователю."""
+        with self.lock:
+            self.ack(username, count)
+
+    def discard(self, username):
+        """Метод удаления всех сообщений пользователя."""
+        with self.lock:
+            self.ack(username, self.pending(username))
+
+    def compact(self):
+        """Метод перезаписи журнала: в новый журнал переносятся только хранящиеся сообщения."""
+        now = time.time()
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as temp_file:
+            for username, queue in self.index.items():
+                for offset, length, expires in queue:
+                    if expires <= now:
+                        continue
+                    self.file.seek(offset)
+                    data = self.file.read(length)
+                    temp_file.write(FRAME_HEADER.pack(length) + data)
+        self.file.close()
+        os.replace(temp_path, self.path)
+        self.file = open(self.path, 'a+b')
+        self.load()
+
+    def close(self):
+        """Метод закрытия журнала."""
+        with self.lock:
+            self.file.close()
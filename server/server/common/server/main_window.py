@@ -78,8 +78,11 @@ class MainWindow(QMainWindow):
     def create_gui_model(self):
         """Функция заполняющая таблицу активных пользователей."""
         users_list_active = self.database.active_users_list()
+        # Глубина очередей отправки показывает медленных получателей
+        queue_depths = self.server_thread.queue_depths()
         list = QStandardItemModel()
-        list.setHorizontalHeaderLabels(['Имя пользователя', 'IP адрес', 'Порт', 'время подключения'])
+        list.setHorizontalHeaderLabels(
+            ['Имя пользователя', 'IP адрес', 'Порт', 'время подключения', 'Очередь отправки'])
         for row in users_list_active:
             user, ip, port, time = row
             user = QStandardItem(user)
@@ -90,7 +93,9 @@ class MainWindow(QMainWindow):
             port.setEditable(False)
             time = QStandardItem(str(time.replace(microsecond=0)))
             time.setEditable(False)
-            list.appendRow([user, ip, port, time])
+            queue = QStandardItem(str(queue_depths.get(user.text(), 0)))
+            queue.setEditable(False)
+            list.appendRow([user, ip, port, time, queue])
         self.active_clients_table.setModel(list)
         self.active_clients_table.resizeColumnsToContents()
         self.active_clients_table.resizeRowsToContents()
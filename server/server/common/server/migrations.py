@@ -0,0 +1,85 @@
+"""Миграции схемы базы данных сервера"""
+
+import datetime
+import logging
+
+# Инициализация логгера сервера
+LOGGER = logging.getLogger('server')
+
+# Миграции: номер версии схемы, описание и SQL запросы.
+# Запросы написаны так, чтобы их повторное выполнение ничего не меняло.
+MIGRATIONS = (
+    (1, 'Индексы списков контактов', (
+        # Перед созданием уникального индекса удаляем дубликаты контактов
+        'DELETE FROM Contacts WHERE id NOT IN '
+        '(SELECT MIN(id) FROM Contacts GROUP BY user, contact)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_contacts_user_contact ON Contacts (user, contact)',
+        'CREATE INDEX IF NOT EXISTS ix_contacts_contact ON Contacts (contact)',
+    )),
+    (2, 'Индекс статистики сообщений', (
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_history_user ON History (user)',
+    )),
+    (3, 'Индекс истории входов', (
+        'CREATE INDEX IF NOT EXISTS ix_login_history_name_date ON Login_history (name, date_time)',
+    )),
+    (4, 'Архив истории входов', (
+        # Перенос в архив выбирает записи по времени входа
+        'CREATE INDEX IF NOT EXISTS ix_login_history_date ON Login_history (date_time)',
+        # Сворачивание в количество входов по дням дополняет существующую запись дня
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_login_daily_user_day ON Login_daily (user, day)',
+    )),
+    (5, 'Журнал изменений справочника пользователей', (
+        # Пользователи, зарегистрированные до появления журнала, попадают в первые версии
+        'INSERT INTO Users_directory (name, removed) SELECT name, 0 FROM Users ORDER BY id',
+    )),
+)
+
+
+def schema_version(cursor):
+    """Функция возвращающая текущую версию схемы базы."""
+    cursor.execute(
+        'CREATE TABLE IF NOT EXISTS Schema_version ('
+        'version INTEGER PRIMARY KEY, description VARCHAR, applied DATETIME)')
+    cursor.execute('SELECT MAX(version) FROM Schema_version')
+    return cursor.fetchone()[0] or 0
+
+
+def migrate(engine, migrations=MIGRATIONS):
+    """
+    Функция обновления схемы базы до последней версии.
+    Выполняет миграции, которые ещё не были применены, и записывает их
+    в таблицу Schema_version. Все миграции выполняются в одной транзакции,
+    поэтому несколько процессов сервера могут запускать её одновременно.
+    :return: список номеров применённых миграций.
+    """
+    applied = []
+    connection = engine.raw_connection()
+    # Транзакцией управляем сами, а не драйвер sqlite3
+    dbapi_connection = connection.connection
+    isolation_level = dbapi_connection.isolation_level
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    try:
+        # Захватываем блокировку записи до чтения версии схемы
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            version = schema_version(cursor)
+            for number, description, statements in migrations:
+                if number <= version:
+                    continue
+                LOGGER.info(f'Миграция базы данных {number}: {description}.')
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.execute(
+                    'INSERT INTO Schema_version (version, description, applied) VALUES (?, ?, ?)',
+                    (number, description, datetime.datetime.now()))
+                applied.append(number)
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+    finally:
+        cursor.close()
+        dbapi_connection.isolation_level = isolation_level
+        connection.close()
+    return applied
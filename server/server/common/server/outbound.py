@@ -0,0 +1,109 @@
+import tempfile
+from collections import deque
+from common.utils import FRAME_HEADER
+from common.variables import SLOW_CONSUMER_SPILL
+
+
+class OutboundQueue:
+    """
+    Класс - очередь исходящих данных одного соединения.
+    Сообщения ставятся в очередь уже закодированными и отправляются
+    неблокирующей записью, когда сокет готов к записи.
+    Размер очереди в памяти ограничен. Если получатель не успевает
+    принимать данные, при политике spill сообщения сбрасываются во
+    временный файл и возвращаются в очередь по мере её освобождения,
+    иначе put возвращает False и решение принимает сервер.
+    """
+
+    def __init__(self, limit, policy):
+        # Максимальный объём данных в памяти, байт
+        self.limit = limit
+        self.policy = policy
+        # Закодированные сообщения и смещение в первом из них
+        self.chunks = deque()
+        self.offset = 0
+        # Объём данных в памяти, байт
+        self.size = 0
+        # Временный файл для сброса сообщений, позиции чтения и записи в нём
+        self.spill_file = None
+        self.spill_read = 0
+        self.spill_write = 0
+        # Количество сообщений в файле
+        self.spilled = 0
+        # Счётчик отброшенных сообщений
+        self.dropped = 0
+
+    def __len__(self):
+        """Глубина очереди - количество ожидающих отправки сообщений."""
+        return len(self.chunks) + self.spilled
+
+    def put(self, data):
+        """
+        Метод постановки сообщения в очередь.
+        Возвращает False если очередь переполнена и сообщение не принято.
+        """
+        # Пока в файле есть сообщения, новые пишем туда же, чтобы сохранить порядок
+        if self.spill_file is None and (not self.chunks or self.size + len(data) <= self.limit):
+            self.chunks.append(data)
+            self.size += len(data)
+            return True
+        if self.policy == SLOW_CONSUMER_SPILL:
+            self.spill(data)
+            return True
+        self.dropped += 1
+        return False
+
+    def spill(self, data):
+        """Метод записи сообщения во временный файл."""
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile()
+            self.spill_read = self.spill_write = 0
+        self.spill_file.seek(self.spill_write)
+        self.spill_file.write(FRAME_HEADER.pack(len(data)))
+        self.spill_file.write(data)
+        self.spill_write = self.spill_file.tell()
+        self.spilled += 1
+
+    def unspill(self):
+        """Метод возвращающий сообщения из временного файла в очередь, в пределах лимита."""
+        self.spill_file.seek(self.spill_read)
+        while self.spilled and (not self.chunks or self.size < self.limit):
+            length, = FRAME_HEADER.unpack(self.spill_file.read(FRAME_HEADER.size))
+            data = self.spill_file.read(length)
+            self.chunks.append(data)
+            self.size += length
+            self.spilled -= 1
+        self.spill_read = self.spill_file.tell()
+        if not self.spilled:
+            self.spill_file.close()
+            self.spill_file = None
+
+    def flush(self, sock):
+        """
+        Метод отправки данных из очереди в неблокирующий сокет.
+        Отправляет столько, сколько примет сокет.
+        Возвращает True, если очередь полностью отправлена.
+        """
+        while self.chunks:
+            chunk = self.chunks[0]
+            try:
+                sent = sock.send(memoryview(chunk)[self.offset:])
+            except BlockingIOError:
+                return False
+            self.offset += sent
+            self.size -= sent
+            if self.offset < len(chunk):
+                return False
+            self.chunks.popleft()
+            self.offset = 0
+            if not self.chunks and self.spill_file is not None:
+                self.unspill()
+        return True
+
+    def close(self):
+        """Метод освобождения ресурсов очереди."""
+        self.chunks.clear()
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+        self.spilled = 0
@@ -0,0 +1,102 @@
+"""Реестр соединений сервера"""
+
+# Состояния авторизации соединения: ожидание presence,
+# ожидание ответа на запрос 511, клиент авторизован
+AUTH_WAIT_PRESENCE = 'wait_presence'
+AUTH_WAIT_DIGEST = 'wait_digest'
+AUTH_DONE = 'done'
+
+
+class Connection:
+    """
+    Класс - состояние соединения с клиентом.
+    Хранит сокет, адрес клиента, имя пользователя, этап авторизации,
+    а также декодер входящего потока и очередь исходящих сообщений.
+    """
+    __slots__ = ('sock', 'address', 'username', 'auth_state', 'deadline',
+                 'presence', 'digest', 'decoder', 'outbound', 'mailbox_sent', 'request_id')
+
+    def __init__(self, sock, address, decoder, outbound, deadline):
+        self.sock = sock
+        self.address = address
+        self.username = None
+        # Этап авторизации и крайний срок её завершения
+        self.auth_state = AUTH_WAIT_PRESENCE
+        self.deadline = deadline
+        # Сообщение presence и серверная версия хэша пароля
+        self.presence = None
+        self.digest = None
+        self.decoder = decoder
+        self.outbound = outbound
+        # Количество записей почтового ящика в порции, отправленной клиенту
+        # и ещё не подтверждённой им
+        self.mailbox_sent = 0
+        # Номер обрабатываемого запроса клиента, возвращается в ответах на него
+        self.request_id = None
+
+
+class ConnectionRegistry:
+    """
+    Класс - реестр соединений сервера.
+    Индексирует соединения по сокету и по имени пользователя,
+    все операции поиска выполняются за O(1).
+    """
+
+    def __init__(self):
+        # Сокет -> соединение
+        self.by_socket = dict()
+        # Имя авторизованного пользователя -> соединение
+        self.by_name = dict()
+
+    def __len__(self):
+        return len(self.by_socket)
+
+    def __contains__(self, sock):
+        return sock in self.by_socket
+
+    def sockets(self):
+        """Метод возвращающий список сокетов всех соединений."""
+        return list(self.by_socket)
+
+    def connections(self):
+        """Метод возвращающий все соединения."""
+        return self.by_socket.values()
+
+    def add(self, connection):
+        """Метод регистрации нового соединения."""
+        self.by_socket[connection.sock] = connection
+
+    def get(self, sock):
+        """Метод возвращающий соединение по сокету или None."""
+        return self.by_socket.get(sock)
+
+    def find(self, username):
+        """Метод возвращающий соединение авторизованного пользователя или None."""
+        return self.by_name.get(username)
+
+    def username(self, sock):
+        """Метод возвращающий имя пользователя, авторизованного на сокете, или None."""
+        connection = self.by_socket.get(sock)
+        return connection.username if connection is not None else None
+
+    def is_authorized(self, sock):
+        """Метод проверяющий что на сокете авторизован пользователь."""
+        connection = self.by_socket.get(sock)
+        return connection is not None and connection.auth_state == AUTH_DONE
+
+    def authorize(self, sock, username):
+        """Метод привязки имени пользователя к соединению после авторизации."""
+        connection = self.by_socket[sock]
+        connection.username = username
+        connection.auth_state = AUTH_DONE
+        connection.presence = connection.digest = None
+        self.by_name[username] = connection
+        return connection
+
+    def remove(self, sock):
+        """Метод удаления соединения из реестра. Возвращает удалённое соединение или None."""
+        connection = self.by_socket.pop(sock, None)
+        if connection is not None and connection.username is not None \
+                and self.by_name.get(connection.username) is connection:
+            del self.by_name[connection.username]
+        return connection
@@ -44,11 +44,15 @@ class DeleteUser(QDialog):
 
     def remove_user(self):
         """ Функция обрабатывающая удаления пользователя """
-        self.database.remove_user(self.selector.currentText())
-        if self.selector.currentText() in self.server.names:
-            sock = self.server.names[self.selector.currentText()]
-            del self.server.names[self.selector.currentText()]
-            self.server.remove_client(sock)
-        # Рассылаем клиентам сообщение о необходимости обновления списков
-        self.server.service_update_lists()
+        owners = self.database.remove_user(self.selector.currentText())
+        if self.server.mailbox is not None:
+            self.server.mailbox.discard(self.selector.currentText())
+        connection = self.server.registry.find(self.selector.currentText())
+        if connection is not None:
+            # Соединение закрывается в потоке сервера при следующем проходе цикла
+            self.server.remove_client(connection.sock)
+        # Уведомляем клиентов об удалении пользователя, а тех, у кого он
+        # был в контактах - об изменении списка контактов
+        self.server.notify_directory_changed()
+        self.server.notify_contacts_changed(owners)
         self.close()
@@ -1,9 +1,141 @@
 import datetime
-
-from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, DateTime, Text
-from sqlalchemy.orm import mapper, sessionmaker
+import logging
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, namedtuple
+from itertools import islice
+
+from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, DateTime, Date, \
+    Text, Boolean, select, bindparam, event, func, text
+from sqlalchemy.orm import mapper, sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
+from server.migrations import migrate
+from server.login_archive import LoginArchive
+from common.variables import SEARCH_PAGE_SIZE
 from sqlalchemy.sql import default_comparator
 
+# Инициализация логгера сервера
+LOGGER = logging.getLogger('server')
+
+# Период записи счётчиков сообщений в базу, сек.
+COUNTERS_FLUSH_INTERVAL = 1.0
+# Количество сообщений, после которого счётчики записываются не дожидаясь периода
+COUNTERS_FLUSH_EVERY = 500
+# Количество пользователей в кэше
+USERS_CACHE_SIZE = 1024
+# Время ожидания блокировки базы другим соединением, мс
+SQLITE_BUSY_TIMEOUT = 5000
+# Размер кэша страниц SQLite одного соединения, КиБ
+SQLITE_CACHE_SIZE = 8192
+# Срок хранения истории входов в базе, дней
+LOGIN_HISTORY_RETENTION = 90
+# Период переноса старой истории входов в архив, сек.
+LOGIN_HISTORY_COMPACT_INTERVAL = 3600.0
+# Количество записей истории входов, переносимых в архив одной транзакцией
+LOGIN_HISTORY_BATCH = 5000
+
+# Запись кэша пользователей
+UserRecord = namedtuple('UserRecord', ('id', 'passwd_hash', 'public_key'))
+# Статистика кэша, аналогично functools.lru_cache
+CacheInfo = namedtuple('CacheInfo', ('hits', 'misses', 'maxsize', 'currsize'))
+
+
+class UsersCache:
+    """
+    Класс - кэш пользователей: имя -> (id, хэш пароля, публичный ключ).
+    Размер ограничен, при переполнении вытесняется запись,
+    к которой дольше всего не обращались.
+    """
+
+    def __init__(self, maxsize=USERS_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.records = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Кэшем пользуются поток сервера и графический интерфейс
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """Метод получения записи по имени или None."""
+        with self.lock:
+            record = self.records.get(name)
+            if record is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.records.move_to_end(name)
+            return record
+
+    def put(self, name, record):
+        """Метод добавления записи в кэш."""
+        with self.lock:
+            self.records[name] = record
+            self.records.move_to_end(name)
+            if len(self.records) > self.maxsize:
+                self.records.popitem(last=False)
+
+    def invalidate(self, name):
+        """Метод удаления записи пользователя из кэша."""
+        with self.lock:
+            self.records.pop(name, None)
+
+    def cache_info(self):
+        """Метод возвращающий статистику кэша."""
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self.records))
+
+
+class UsersIndex:
+    """
+    Класс - упорядоченный индекс имён пользователей для поиска по началу имени.
+    Имена хранятся отсортированными по ключу без учёта регистра, поэтому
+    все имена с заданным началом идут подряд и находятся двоичным поиском.
+    """
+
+    def __init__(self, names=()):
+        # Отсортированный список пар (имя без учёта регистра, имя)
+        self.entries = sorted((name.casefold(), name) for name in names)
+        # Индекс изменяется графическим интерфейсом, а читается потоком сервера
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, name):
+        """Метод добавления имени в индекс."""
+        entry = (name.casefold(), name)
+        with self.lock:
+            position = bisect_left(self.entries, entry)
+            if position == len(self.entries) or self.entries[position] != entry:
+                self.entries.insert(position, entry)
+
+    def remove(self, name):
+        """Метод удаления имени из индекса."""
+        entry = (name.casefold(), name)
+        with self.lock:
+            position = bisect_left(self.entries, entry)
+            if position < len(self.entries) and self.entries[position] == entry:
+                del self.entries[position]
+
+    def search(self, prefix, after=None, limit=SEARCH_PAGE_SIZE):
+        """
+        Метод поиска имён, начинающихся с prefix, без учёта регистра.
+        Возвращает не более limit имён, следующих за именем after,
+        и признак того, что есть следующая страница.
+        """
+        key = prefix.casefold()
+        with self.lock:
+            position = bisect_left(self.entries, (key,))
+            if after is not None:
+                position = max(position, bisect_right(self.entries, (after.casefold(), after)))
+            names = []
+            for folded, name in islice(self.entries, position, position + limit + 1):
+                if not folded.startswith(key):
+                    break
+                names.append(name)
+        return names[:limit], len(names) > limit
+
 
 class ServerDatabase:
     '''
@@ -59,15 +191,30 @@ class ServerDatabase:
             self.send = 0
             self.accepted = 0
 
-    def __init__(self, path):
-        # Создаём движок базы данных
+    def __init__(self, path, clear_active=True,
+                 flush_interval=COUNTERS_FLUSH_INTERVAL, flush_every=COUNTERS_FLUSH_EVERY,
+                 cache_size=USERS_CACHE_SIZE, login_retention=None, archive_path=None):
+        # Создаём движок базы данных.
+        # Соединения хранятся в пуле и выдаются сессиям потоков.
         print(path)
         self.database_engine = create_engine(
             f'sqlite:///{path}',
             echo=False,
             pool_recycle=7200,
+            poolclass=QueuePool,
+            connect_args={
+                'check_same_thread': False})
+        event.listen(self.database_engine, 'connect', self.configure_connection)
+        # Отдельный движок для запросов графического интерфейса и статистики:
+        # соединения только для чтения, в режиме WAL они не блокируют запись
+        self.read_engine = create_engine(
+            f'sqlite:///{path}',
+            echo=False,
+            pool_recycle=7200,
+            poolclass=QueuePool,
             connect_args={
                 'check_same_thread': False})
+        event.listen(self.read_engine, 'connect', self.configure_read_connection)
         self.metadata = MetaData()
         # Создаём таблицу пользователей
         users_table = Table('Users', self.metadata,
@@ -93,6 +240,24 @@ class ServerDatabase:
                                    Column('ip', String),
                                    Column('port', String)
                                    )
+        # Создаём таблицу количества входов пользователей по дням.
+        # В неё сворачивается история входов, перенесённая в архив.
+        self.login_daily = Table('Login_daily', self.metadata,
+                                 Column('id', Integer, primary_key=True),
+                                 Column('user', ForeignKey('Users.id')),
+                                 Column('day', Date),
+                                 Column('logins', Integer),
+                                 Column('first_login', DateTime),
+                                 Column('last_login', DateTime)
+                                 )
+        # Создаём журнал изменений справочника пользователей.
+        # Номер записи журнала - версия справочника, по ней клиенты
+        # запрашивают только изменения со своей версии.
+        self.users_directory = Table('Users_directory', self.metadata,
+                                     Column('version', Integer, primary_key=True),
+                                     Column('name', String),
+                                     Column('removed', Boolean)
+                                     )
         # Создаём таблицу контактов пользователей
         contacts = Table('Contacts', self.metadata,
                          Column('id', Integer, primary_key=True),
@@ -108,20 +273,115 @@ class ServerDatabase:
                                     Column('accepted', Integer)
                                     )
 
-        # Создание таблиц
+        # Создание таблиц и обновление схемы существующей базы
         self.metadata.create_all(self.database_engine)
+        migrate(self.database_engine)
+        # Запрос увеличения счётчиков сообщений пользователя на накопленные значения
+        self.counters_update = users_history_table.update().where(
+            users_history_table.c.user == select([users_table.c.id]).where(
+                users_table.c.name == bindparam('username')).as_scalar()).values(
+            send=users_history_table.c.send + bindparam('send_delta'),
+            accepted=users_history_table.c.accepted + bindparam('accepted_delta'))
+        # Запросы переноса истории входов старше срока хранения:
+        # выборка очередной порции, сворачивание порции в количество входов
+        # по дням и удаление порции из таблицы
+        self.login_history_batch = select([
+            user_login_history.c.id,
+            users_table.c.name,
+            user_login_history.c.date_time,
+            user_login_history.c.ip,
+            user_login_history.c.port]).select_from(user_login_history.join(users_table)).where(
+            user_login_history.c.date_time < bindparam('cutoff')).order_by(
+            user_login_history.c.id).limit(bindparam('batch'))
+        self.login_history_rollup = text(
+            'INSERT INTO Login_daily (user, day, logins, first_login, last_login) '
+            'SELECT name, date(date_time), COUNT(*), MIN(date_time), MAX(date_time) '
+            'FROM Login_history WHERE date_time < :cutoff AND id <= :last_id '
+            'GROUP BY name, date(date_time) '
+            'ON CONFLICT (user, day) DO UPDATE SET '
+            'logins = logins + excluded.logins, '
+            'first_login = MIN(first_login, excluded.first_login), '
+            'last_login = MAX(last_login, excluded.last_login)').bindparams(
+            bindparam('cutoff', type_=DateTime))
+        self.login_history_delete = user_login_history.delete().where(
+            user_login_history.c.date_time < bindparam('cutoff')).where(
+            user_login_history.c.id <= bindparam('last_id'))
         # Создание отображений
         mapper(self.AllUsers, users_table)
         mapper(self.ActiveUsers, active_users_table)
         mapper(self.LoginHistory, user_login_history)
         mapper(self.UserContactList, contacts)
         mapper(self.UsersHistory, users_history_table)
-        # Создание сессии
-        Session = sessionmaker(bind=self.database_engine)
-        self.session = Session()
-
-        self.session.query(self.ActiveUsers).delete()
-        self.session.commit()
+        # Создание сессий: у каждого потока своя сессия
+        self.session = scoped_session(sessionmaker(bind=self.database_engine))
+        self.read_session = scoped_session(sessionmaker(bind=self.read_engine))
+
+        # Список активных пользователей очищается при запуске сервера.
+        # В многопроцессном режиме это делает только управляющий процесс.
+        if clear_active:
+            self.session.query(self.ActiveUsers).delete()
+            self.session.commit()
+
+        # Кэш пользователей для поиска по имени
+        self.users_cache = UsersCache(cache_size)
+        # Индекс имён пользователей для поиска по началу имени
+        self.users_index = UsersIndex(user[0] for user in self.read(self.read_session.query(self.AllUsers.name)))
+
+        # Счётчики сообщений, ещё не записанные в базу:
+        # имя пользователя -> [отправлено, получено]
+        self.counters = dict()
+        self.counters_pending = 0
+        self.flush_every = flush_every
+        # Счётчики изменяются потоком сервера, а читаются и записываются
+        # графическим интерфейсом и потоком записи
+        self.counters_lock = threading.Lock()
+        # Запись счётчиков в базу идёт без блокировки счётчиков, чтобы не
+        # задерживать поток сервера. Эта блокировка не даёт читать статистику,
+        # пока снятые счётчики не записаны в базу или не возвращены обратно.
+        self.flush_lock = threading.Lock()
+
+        # Архив истории входов. Перенос в архив выполняет только процесс,
+        # которому задан срок хранения, в многопроцессном режиме - управляющий.
+        self.login_archive = LoginArchive(archive_path) if archive_path else None
+        self.login_retention = login_retention if self.login_archive else None
+        self.login_compacted = 0.0
+
+        self.flush_stop = threading.Event()
+        # Событие досрочной записи счётчиков после flush_every сообщений
+        self.flush_wakeup = threading.Event()
+        self.flush_thread = threading.Thread(
+            target=self.flush_worker, args=(flush_interval,), daemon=True)
+        self.flush_thread.start()
+
+    @staticmethod
+    def configure_connection(dbapi_connection, connection_record):
+        """
+        Настройка нового соединения SQLite: журнал WAL, при котором чтение
+        не блокирует запись, и синхронизация с диском только при контрольных точках.
+        """
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}')
+        cursor.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE}')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.close()
+
+    @staticmethod
+    def configure_read_connection(dbapi_connection, connection_record):
+        """Настройка соединения SQLite только для чтения."""
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}')
+        cursor.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE}')
+        cursor.execute('PRAGMA query_only=ON')
+        cursor.close()
+
+    def read(self, query):
+        """Метод выполнения запроса на чтение. Соединение сразу возвращается в пул."""
+        try:
+            return query.all()
+        finally:
+            self.read_session.remove()
 
     # При входе пользователя проверяем если пользователь есть, записываем в базу факт входа,
     # если нет, то создаем нового пользователя в БД и фиксируем факт входа
@@ -129,6 +389,7 @@ class ServerDatabase:
         """
         Метод выполняющийся при входе пользователя, записывает в базу факт входа
         Обновляет открытый ключ пользователя при его изменении.
+        Возвращает True, если ключ изменился.
         """
         is_user_exist = self.session.query(
             self.AllUsers).filter_by(
@@ -138,30 +399,46 @@ class ServerDatabase:
         if is_user_exist.count():
             user = is_user_exist.first()
             user.last_login = datetime.datetime.now()
+            # Ключ, сохранённый при первом входе, сменой не считается
+            key_changed = user.public_key is not None and user.public_key != key
             if user.public_key != key:
                 user.public_key = key
         else:
             raise ValueError('Пользователь не зарегистрирован')
 
-        # Создаем запись в таблицу активных пользователей о факте входа
-        new_active_user = self.ActiveUsers(
-            user.id, ip_address, port, datetime.datetime.now())
-        self.session.add(new_active_user)
+        # Создаем запись в таблицу активных пользователей о факте входа.
+        # При работе в несколько процессов запись может уже принадлежать сеансу
+        # того же пользователя в другом процессе: маршрутизатор оставит тот
+        # сеанс, а этот отключит, поэтому существующая запись не заменяется.
+        if not self.session.query(self.ActiveUsers).filter_by(user=user.id).count():
+            new_active_user = self.ActiveUsers(
+                user.id, ip_address, port, datetime.datetime.now())
+            self.session.add(new_active_user)
 
         history = self.LoginHistory(
             user.id, datetime.datetime.now(), ip_address, port)
         self.session.add(history)
 
         self.session.commit()
+        # Публичный ключ мог измениться
+        self.users_cache.invalidate(username)
+        return key_changed
 
     # Если пользователь вышел, удаляем его из таблицы активных пользователей
-    def user_logout(self, username):
-        """Метод фиксирующий отключения пользователя."""
-        user = self.session.query(
-            self.AllUsers).filter_by(
-            name=username).first()
+    def user_logout(self, username, ip_address=None, port=None):
+        """
+        Метод фиксирующий отключения пользователя.
+        Если указан адрес соединения, удаляется только запись этого соединения.
+        """
+        user = self.get_user_record(username)
+        # Пользователь мог быть удалён из базы вместе с записью об активности
+        if not user:
+            return
 
-        self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
+        query = self.session.query(self.ActiveUsers).filter_by(user=user.id)
+        if ip_address is not None:
+            query = query.filter_by(ip_address=ip_address, port=port)
+        query.delete()
         self.session.commit()
 
     # Функция регистрации пользователя в базе
@@ -172,17 +449,27 @@ class ServerDatabase:
         """
         user_row = self.AllUsers(name, passwd_hash)
         self.session.add(user_row)
+        self.session.execute(self.users_directory.insert().values(name=name, removed=False))
         self.session.commit()
         history_row = self.UsersHistory(user_row.id)
         self.session.add(history_row)
         self.session.commit()
+        self.users_cache.invalidate(name)
+        self.users_index.add(name)
 
     # Функция удаления пользователя из базы
     def remove_user(self, name):
-        """Метод удаляющий пользователя из базы."""
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
+        """
+        Метод удаляющий пользователя из базы.
+        Возвращает имена пользователей, у которых он был в контактах.
+        """
+        user = self.get_user_record(name)
+        owners = [owner[0] for owner in self.session.query(self.AllUsers.name).join(
+            self.UserContactList, self.UserContactList.user == self.AllUsers.id).filter(
+            self.UserContactList.contact == user.id)]
         self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
         self.session.query(self.LoginHistory).filter_by(name=user.id).delete()
+        self.session.execute(self.login_daily.delete().where(self.login_daily.c.user == user.id))
         self.session.query(
             self.UserContactList).filter_by(
             user=user.id).delete()
@@ -191,58 +478,149 @@ class ServerDatabase:
             contact=user.id).delete()
         self.session.query(self.UsersHistory).filter_by(user=user.id).delete()
         self.session.query(self.AllUsers).filter_by(name=name).delete()
+        self.session.execute(self.users_directory.insert().values(name=name, removed=True))
         self.session.commit()
+        self.users_cache.invalidate(name)
+        self.users_index.remove(name)
+        return owners
+
+    # Функция поиска пользователя по имени
+    def get_user_record(self, name):
+        """
+        Метод возвращающий запись пользователя (id, хэш пароля, публичный ключ)
+        или None, если пользователь не найден. Записи кэшируются.
+        """
+        record = self.users_cache.get(name)
+        if record is None:
+            user = self.session.query(self.AllUsers).filter_by(name=name).first()
+            if user is None:
+                return None
+            record = UserRecord(user.id, user.passwd_hash, user.public_key)
+            self.users_cache.put(name, record)
+        return record
 
     # Функция получения хэша пароля
     def get_hash(self, name):
         """Метод получения хэша пароля пользователя."""
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        return user.passwd_hash
+        return self.get_user_record(name).passwd_hash
 
     # Функция получения публичного ключа пользователя
     def get_public_key(self, name):
         """Метод получения публичного ключа пользователя."""
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        return user.public_key
+        return self.get_user_record(name).public_key
 
     # Функция проверки существования пользователя
     def check_user(self, name):
         """Метод проверяющий существование пользователя."""
-        if self.session.query(self.AllUsers).filter_by(name=name).count():
-            return True
-        else:
-            return False
+        return self.get_user_record(name) is not None
 
     # Функция фиксирует передачу сообщения и делает соответствующие отметки в
     # БД
     def process_message(self, sender, recipient):
-        """Метод записывающий в таблицу статистики факт передачи сообщения."""
-        # Получение ID отправителя и получателя
-        sender = self.session.query(
-            self.AllUsers).filter_by(
-            name=sender).first().id
-        recipient = self.session.query(
-            self.AllUsers).filter_by(
-            name=recipient).first().id
-        # Запрашиваем строки из истории и увеличиваем счётчики
-        sender_row = self.session.query(
-            self.UsersHistory).filter_by(
-            user=sender).first()
-        sender_row.send += 1
-        recipient_row = self.session.query(
-            self.UsersHistory).filter_by(
-            user=recipient).first()
-        recipient_row.accepted += 1
-
-        self.session.commit()
+        """
+        Метод учитывающий в статистике факт передачи сообщения.
+        Счётчики накапливаются в памяти и записываются в базу пакетом
+        потоком записи по таймеру или после flush_every сообщений.
+        """
+        with self.counters_lock:
+            self.counters.setdefault(sender, [0, 0])[0] += 1
+            self.counters.setdefault(recipient, [0, 0])[1] += 1
+            self.counters_pending += 1
+            pending = self.counters_pending
+        if pending == self.flush_every:
+            self.flush_wakeup.set()
+
+    def flush_counters(self):
+        """
+        Метод записи накопленных счётчиков сообщений в базу одной транзакцией.
+        Счётчики снимаются под блокировкой и заменяются пустыми, запись идёт
+        без неё. Если запись не удалась, снятые счётчики возвращаются обратно.
+        """
+        with self.flush_lock:
+            with self.counters_lock:
+                if not self.counters:
+                    return
+                counters, pending = self.counters, self.counters_pending
+                self.counters, self.counters_pending = dict(), 0
+            try:
+                with self.database_engine.begin() as connection:
+                    connection.execute(self.counters_update, [
+                        {'username': name, 'send_delta': sent, 'accepted_delta': accepted}
+                        for name, (sent, accepted) in counters.items()])
+            except Exception:
+                with self.counters_lock:
+                    for name, (sent, accepted) in counters.items():
+                        values = self.counters.setdefault(name, [0, 0])
+                        values[0] += sent
+                        values[1] += accepted
+                    self.counters_pending += pending
+                raise
+
+    def flush_worker(self, interval):
+        """
+        Поток периодической записи счётчиков сообщений.
+        Он же раз в LOGIN_HISTORY_COMPACT_INTERVAL переносит в архив старую историю входов.
+        Ошибка базы (например, база заблокирована или закончилось место на диске)
+        не останавливает поток, запись повторяется в следующем цикле.
+        """
+        while True:
+            self.flush_wakeup.wait(interval)
+            self.flush_wakeup.clear()
+            if self.flush_stop.is_set():
+                break
+            try:
+                self.flush_counters()
+                if self.login_retention is not None and \
+                        time.monotonic() - self.login_compacted >= LOGIN_HISTORY_COMPACT_INTERVAL:
+                    self.compact_login_history()
+                    self.login_compacted = time.monotonic()
+            except Exception:
+                LOGGER.exception('Ошибка записи статистики в базу')
+
+    def compact_login_history(self, now=None, batch=LOGIN_HISTORY_BATCH):
+        """
+        Метод переноса истории входов старше срока хранения в архив.
+        Записи переносятся порциями за целые дни: порция дописывается в архив,
+        сворачивается в таблицу Login_daily и удаляется из базы в одной транзакции.
+        При аварийном завершении между записью в архив и фиксацией транзакции
+        порция попадёт в архив повторно, но не потеряется.
+        :return: количество перенесённых записей.
+        """
+        now = now or datetime.datetime.now()
+        cutoff = datetime.datetime.combine(
+            now.date() - datetime.timedelta(days=self.login_retention), datetime.time.min)
+        moved = 0
+        try:
+            while True:
+                rows = self.session.execute(
+                    self.login_history_batch, {'cutoff': cutoff, 'batch': batch}).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                self.login_archive.append([tuple(row)[1:] for row in rows])
+                self.session.execute(self.login_history_rollup, {'cutoff': cutoff, 'last_id': last_id})
+                self.session.execute(self.login_history_delete, {'cutoff': cutoff, 'last_id': last_id})
+                self.session.commit()
+                moved += len(rows)
+        finally:
+            self.session.remove()
+        return moved
+
+    def close(self):
+        """Метод завершения работы с базой: записывает накопленные счётчики."""
+        self.flush_stop.set()
+        self.flush_wakeup.set()
+        self.flush_thread.join()
+        self.flush_counters()
+        self.session.remove()
+        self.database_engine.dispose()
+        self.read_engine.dispose()
 
     # Функция добавления контактов пользователя
     def add_contact(self, user, contact):
         """Метод добавления контакта для пользователя."""
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(
-            self.AllUsers).filter_by(
-            name=contact).first()
+        user = self.get_user_record(user)
+        contact = self.get_user_record(contact)
 
         if not contact or self.session.query(
                 self.UserContactList).filter_by(
@@ -257,10 +635,8 @@ class ServerDatabase:
     # Функция удаления контактов пользователя
     def remove_contact(self, user, contact):
         """Метод удаления контакта пользователя."""
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(
-            self.AllUsers).filter_by(
-            name=contact).first()
+        user = self.get_user_record(user)
+        contact = self.get_user_record(contact)
         # Проверяем что контакт может существовать
         if not contact:
             return
@@ -274,39 +650,112 @@ class ServerDatabase:
     # входа.
     def users_list(self):
         """Метод возвращающий список известных пользователей со временем последнего входа."""
-        query = self.session.query(
+        query = self.read_session.query(
             self.AllUsers.name,
             self.AllUsers.last_login)
-        return query.all()
+        return self.read(query)
+
+    # Функция поиска пользователей по началу имени
+    def search_users(self, prefix, after=None, limit=SEARCH_PAGE_SIZE):
+        """
+        Метод поиска пользователей по началу имени без учёта регистра.
+        Возвращает страницу имён после имени after и признак наличия следующей страницы.
+        """
+        return self.users_index.search(prefix, after, limit)
+
+    # Функция возвращает текущую версию справочника пользователей
+    def users_version(self):
+        """Метод возвращающий текущую версию справочника пользователей."""
+        query = self.read_session.query(func.max(self.users_directory.c.version))
+        return self.read(query)[0][0] or 0
+
+    # Функция возвращает изменения справочника пользователей
+    def users_delta(self, version):
+        """
+        Метод возвращающий изменения справочника пользователей после версии version:
+        кортеж (текущая версия, добавленные, удалённые).
+        Если версия неизвестна серверу, возвращается None.
+        """
+        current = self.users_version()
+        if version > current:
+            return None
+        query = self.read_session.query(
+            self.users_directory.c.name,
+            self.users_directory.c.removed).filter(
+            self.users_directory.c.version > version,
+            self.users_directory.c.version <= current).order_by(
+            self.users_directory.c.version)
+        # Для каждого имени важно только последнее изменение
+        changes = dict(self.read(query))
+        added = [name for name, removed in changes.items() if not removed]
+        removed = [name for name, removed in changes.items() if removed]
+        return current, added, removed
 
     # Функция возвращает список активных пользователей
     def active_users_list(self):
         """Метод возвращающий список активных пользователей."""
-        query = self.session.query(self.AllUsers.name,
-                                   self.ActiveUsers.ip_address,
-                                   self.ActiveUsers.port,
-                                   self.ActiveUsers.login_time
-                                   ).join(self.AllUsers)
-        return query.all()
+        query = self.read_session.query(self.AllUsers.name,
+                                        self.ActiveUsers.ip_address,
+                                        self.ActiveUsers.port,
+                                        self.ActiveUsers.login_time
+                                        ).join(self.AllUsers)
+        return self.read(query)
 
     # Функция возвращающаяя историю входов по пользователю или всем
     # пользователям
-    def login_history(self, username=None):
-        """Метод возвращающий историю входов"""
-        query = self.session.query(self.AllUsers.name,
-                                   self.LoginHistory.date_time,
-                                   self.LoginHistory.ip,
-                                   self.LoginHistory.port
-                                   ).join(self.AllUsers)
+    def login_history(self, username=None, since=None, until=None):
+        """
+        Метод возвращающий историю входов, всю или за интервал [since, until).
+        Архив разжимается только если задано начало интервала, и только
+        файлы месяцев, попадающих в интервал. Без него возвращаются записи
+        базы - история за срок хранения.
+        """
+        query = self.read_session.query(self.AllUsers.name,
+                                        self.LoginHistory.date_time,
+                                        self.LoginHistory.ip,
+                                        self.LoginHistory.port
+                                        ).join(self.AllUsers)
         if username:
             query = query.filter(self.AllUsers.name == username)
-        return query.all()
+        if since:
+            query = query.filter(self.LoginHistory.date_time >= since)
+        if until:
+            query = query.filter(self.LoginHistory.date_time < until)
+        history = []
+        if since and self.login_archive:
+            history = self.login_archive.read(username, since, until)
+        history.extend(tuple(row) for row in self.read(query.order_by(self.LoginHistory.date_time)))
+        return history
+
+    # Функция возвращает количество входов пользователей по дням
+    def login_stats(self, username=None):
+        """
+        Метод возвращающий количество входов по дням: список (имя, день, количество).
+        Для архивированных дней используется таблица Login_daily.
+        """
+        day = func.date(self.LoginHistory.date_time)
+        live = self.read_session.query(
+            self.AllUsers.name, day, func.count(self.LoginHistory.id)).join(
+            self.AllUsers).group_by(self.AllUsers.name, day)
+        archived = self.read_session.query(
+            self.AllUsers.name, self.login_daily.c.day, self.login_daily.c.logins).join(
+            self.login_daily, self.login_daily.c.user == self.AllUsers.id)
+        if username:
+            live = live.filter(self.AllUsers.name == username)
+            archived = archived.filter(self.AllUsers.name == username)
+        stats = dict()
+        for name, date, logins in self.read(archived) + self.read(live):
+            # День из таблицы истории приходит строкой
+            if isinstance(date, str):
+                date = datetime.date.fromisoformat(date)
+            stats[name, date] = stats.get((name, date), 0) + logins
+        return sorted((name, date, logins) for (name, date), logins in stats.items())
 
     # Функция возвращает список контактов пользователя.
     def get_contacts(self, username):
         """Метод возвращающий список контактов пользователя."""
         # Запрашивааем указанного пользователя
-        user = self.session.query(self.AllUsers).filter_by(name=username).one()
+        user = self.get_user_record(username)
         # Запрашиваем его список контактов
         query = self.session.query(
             self.UserContactList,
@@ -319,14 +768,25 @@ class ServerDatabase:
 
     # Функция возвращает количество переданных и полученных сообщений
     def message_history(self):
-        """Метод возвращающий статистику сообщений."""
-        query = self.session.query(
+        """
+        Метод возвращающий статистику сообщений.
+        К значениям из базы добавляются ещё не записанные счётчики.
+        """
+        query = self.read_session.query(
             self.AllUsers.name,
             self.AllUsers.last_login,
             self.UsersHistory.send,
             self.UsersHistory.accepted).join(
             self.AllUsers)
-        return query.all()
+        with self.flush_lock:
+            rows = self.read(query)
+            with self.counters_lock:
+                counters = {name: tuple(values) for name, values in self.counters.items()}
+        history = []
+        for name, last_login, sent, accepted in rows:
+            sent_delta, accepted_delta = counters.get(name, (0, 0))
+            history.append((name, last_login, sent + sent_delta, accepted + accepted_delta))
+        return history
 
 
 if __name__ == '__main__':
@@ -0,0 +1,105 @@
+"""
+Нагрузочная проверка базы сервера: потоки, опрашивающие базу так же,
+как таймер главного окна, работают одновременно с клиентами, которые
+входят и выходят в цикле, и парой клиентов, обменивающихся сообщениями.
+Выводит количество опросов, входов, ошибок базы и задержку сообщений.
+
+Пример: python stress_bench.py --engine asyncio -g 2 -c 10 -t 8
+"""
+
+import sys
+import os
+import argparse
+import logging
+import threading
+import time
+
+# Пакеты сервера лежат рядом со скриптом, пакет common - уровнем выше
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import log.server_log_config
+from common.variables import ACTION, TIME, USER, GET_CONTACTS
+from bench_client import BenchClient, create_database, start_server, percentile
+
+
+def create_arg_parser():
+    """Парсер аргументов командной строки."""
+    parser = argparse.ArgumentParser(description='Опрос базы из интерфейса при входах и переписке клиентов')
+    parser.add_argument('--engine', default='select', choices=('select', 'asyncio'))
+    parser.add_argument('-g', '--gui', default=2, type=int, help='потоков, опрашивающих базу')
+    parser.add_argument('-i', '--interval', default=0.01, type=float, help='пауза между опросами, сек.')
+    parser.add_argument('-c', '--clients', default=10, type=int, help='клиентов, входящих в цикле')
+    parser.add_argument('-t', '--time', default=8, type=float, help='длительность, сек.')
+    parser.add_argument('--db', default='stress_bench.db3', help='файл базы, создаётся заново')
+    return parser.parse_args(sys.argv[1:])
+
+
+def main():
+    """Основная функция проверки."""
+    namespace = create_arg_parser()
+    logging.getLogger('server').setLevel(logging.WARNING)
+    users = [f'stress_{number}' for number in range(namespace.clients)]
+    database = create_database(namespace.db, ['stress_a', 'stress_b'] + users)
+    server, port = start_server(namespace.engine, database)
+    sender = BenchClient(port, 'stress_a')
+    receiver = BenchClient(port, 'stress_b')
+
+    running = True
+    errors = []
+    counters = {'polls': 0, 'logins': 0}
+
+    def poll():
+        # Те же запросы, что выполняют главное окно и окна статистики
+        while running:
+            try:
+                database.active_users_list()
+                database.users_list()
+                database.message_history()
+                database.login_history()
+                counters['polls'] += 1
+            except Exception as err:
+                errors.append(f'база: {err!r}')
+            time.sleep(namespace.interval)
+
+    def churn(name):
+        while running:
+            try:
+                client = BenchClient(port, name)
+                client.send({ACTION: GET_CONTACTS, TIME: time.time(), USER: name})
+                client.recv()
+                client.close()
+                counters['logins'] += 1
+            except (OSError, ConnectionRefusedError) as err:
+                errors.append(f'клиент: {err!r}')
+                time.sleep(0.1)
+
+    threads = [threading.Thread(target=poll, daemon=True) for _ in range(namespace.gui)]
+    threads += [threading.Thread(target=churn, args=(name,), daemon=True) for name in users]
+    for thread in threads:
+        thread.start()
+
+    latency = []
+    finish = time.monotonic() + namespace.time
+    while time.monotonic() < finish:
+        start = time.perf_counter()
+        sender.message('stress_b', 'x')
+        receiver.recv()
+        sender.recv()
+        latency.append((time.perf_counter() - start) * 1000)
+    running = False
+    for thread in threads:
+        thread.join(3)
+    server.stop()
+
+    latency.sort()
+    print(f'Опросов базы: {counters["polls"]}, входов клиентов: {counters["logins"]}, '
+          f'сообщений: {len(latency)}')
+    print(f'Задержка сообщения, мс: p50 {percentile(latency, 50):.2f}, p99 {percentile(latency, 99):.2f}, '
+          f'макс. {latency[-1]:.2f}')
+    print(f'Ошибок: {len(errors)}')
+    for error in sorted(set(errors))[:5]:
+        print(error)
+
+
+if __name__ == '__main__':
+    main()
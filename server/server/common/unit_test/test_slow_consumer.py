@@ -0,0 +1,87 @@
+"""Тесты отключения медленного получателя сообщений"""
+
+import os
+import sys
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+# Пакеты сервера лежат уровнем выше тестов, пакет common - ещё выше
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from common.utils import encode_message
+from common.variables import ACTION, TIME, USER, GET_CONTACTS, MESSAGE, SENDER, DESTINATION, MESSAGE_TEXT, \
+    SLOW_CONSUMER_DISCONNECT
+from bench_client import BenchClient, create_database, start_server
+
+
+class TestSlowConsumer(unittest.TestCase):
+    """
+    Получатель, не читающий сообщения, отключается при переполнении
+    очереди отправки. Если его сокет готов к чтению в том же проходе
+    цикла сервера, отключённое соединение не должно читаться.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.database = create_database(os.path.join(cls.directory.name, 'server.db3'),
+                                       ['flood_a', 'flood_b', 'flood_c'])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.database.close()
+        cls.directory.cleanup()
+
+    def test_disconnect_in_same_batch(self):
+        server, port = start_server('select', self.database, outbound_limit=2000,
+                                    slow_consumer_policy=SLOW_CONSUMER_DISCONNECT)
+        sender = BenchClient(port, 'flood_a')
+        receiver = BenchClient(port, 'flood_b')
+        receiver.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024)
+        running = True
+
+        def drain():
+            # Ответы отправителю читаются, чтобы медленным был только получатель
+            while running:
+                try:
+                    if not sender.sock.recv(65536):
+                        return
+                except OSError:
+                    return
+
+        def request():
+            # Получатель всё время отправляет запросы, поэтому его сокет
+            # готов к чтению в каждом проходе цикла сервера
+            data = encode_message({ACTION: GET_CONTACTS, TIME: time.time(), USER: 'flood_b'}, True)
+            while running:
+                try:
+                    receiver.sock.sendall(data)
+                except OSError:
+                    return
+
+        threads = [threading.Thread(target=drain, daemon=True), threading.Thread(target=request, daemon=True)]
+        for thread in threads:
+            thread.start()
+        message = encode_message({ACTION: MESSAGE, SENDER: 'flood_a', DESTINATION: 'flood_b',
+                                  TIME: time.time(), MESSAGE_TEXT: 'x' * 1000}, True)
+        deadline = time.monotonic() + 20
+        while server.registry.find('flood_b') is not None and time.monotonic() < deadline:
+            sender.sock.sendall(message * 100)
+        running = False
+
+        self.assertIsNone(server.registry.find('flood_b'))
+        time.sleep(0.5)
+        self.assertTrue(server.is_alive())
+        BenchClient(port, 'flood_c').close()
+        sender.sock.close()
+        receiver.sock.close()
+        server.stop()
+        server.join(3)
+
+
+if __name__ == '__main__':
+    unittest.main()